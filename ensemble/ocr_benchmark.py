@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+import argparse
+import sys
+import textwrap
+from pathlib import Path
+
+from util.pylib import log
+
+from ensemble.pylib import benchmark
+
+
+def main():
+    log.started()
+    args = parse_args()
+    benchmark.EASYOCR = args.easyocr
+
+    if args.update_golden:
+        benchmark.update_golden(args.golden)
+
+    if args.load:
+        rows = benchmark.read_results(args.load)
+    else:
+        rows = benchmark.run(args.benchmark, repeat=args.repeat)
+        if not args.update_golden:
+            rows += benchmark.check_golden(args.golden)
+    benchmark.print_rows(rows)
+
+    if args.save:
+        benchmark.save_results(args.save, rows, args.repeat)
+
+    failed = [r for r in rows if r["benchmark"] == "golden" and r["same"] is False]
+    if args.compare:
+        baseline = benchmark.read_results(args.compare)
+        compared = benchmark.compare(baseline, rows, args.tolerance)
+        print()
+        benchmark.print_rows(compared)
+        failed += benchmark.regressions(compared)
+
+    log.finished()
+    if failed:
+        sys.exit(1)
+
+
+def parse_args() -> argparse.Namespace:
+    arg_parser = argparse.ArgumentParser(
+        fromfile_prefix_chars="@",
+        description=textwrap.dedent(
+            """Time the steps of the OCR pipeline on synthetic labels and check that
+            their outputs have not changed. Exits with an error when a golden
+            output changed or, with --compare, when a step got slower."""
+        ),
+    )
+
+    arg_parser.add_argument(
+        "--benchmark",
+        choices=list(benchmark.BENCHMARKS),
+        nargs="*",
+        default=list(benchmark.BENCHMARKS),
+        help="""Run these benchmarks. (default: all of them)""",
+    )
+
+    arg_parser.add_argument(
+        "--repeat",
+        type=int,
+        default=5,
+        metavar="INT",
+        help="""Time each step this many times and keep the fastest.
+            (default: %(default)s)""",
+    )
+
+    arg_parser.add_argument(
+        "--golden",
+        choices=list(benchmark.GOLDEN),
+        nargs="*",
+        default=list(benchmark.GOLDEN),
+        help="""Check these outputs against the golden outputs.
+            (default: all of them)""",
+    )
+
+    arg_parser.add_argument(
+        "--update-golden",
+        action="store_true",
+        help="""Save the current --golden outputs as the golden outputs. Only do
+            this when a change to the outputs is intended. Outputs that use
+            Tesseract, line-align, or spell-well are saved with their versions and
+            are only checked where the same versions are installed.""",
+    )
+
+    arg_parser.add_argument(
+        "--save",
+        type=Path,
+        metavar="PATH",
+        help="""Save the results to this JSON file.""",
+    )
+
+    arg_parser.add_argument(
+        "--compare",
+        type=Path,
+        metavar="PATH",
+        help="""Compare the results with the results saved in this JSON file and
+            flag the steps that got slower or whose output changed.""",
+    )
+
+    arg_parser.add_argument(
+        "--load",
+        type=Path,
+        metavar="PATH",
+        help="""Use the results saved in this JSON file instead of running the
+            benchmarks, e.g. to --compare two saved runs.""",
+    )
+
+    arg_parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        metavar="FRACTION",
+        help="""With --compare, a step is slower when its time grew by more than
+            this fraction. (default: %(default)s)""",
+    )
+
+    arg_parser.add_argument(
+        "--easyocr",
+        action="store_true",
+        help="""Also time EasyOCR. It needs the EasyOCR models, which it downloads
+            the first time.""",
+    )
+
+    args = arg_parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    main()
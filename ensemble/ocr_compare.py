@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+import argparse
+import textwrap
+from pathlib import Path
+
+from util.pylib import log
+
+from ensemble.pylib import ocr_compare, tesseract_api
+
+
+def main():
+    log.started()
+    args = parse_args()
+    ocr_compare.ocr_compare(args)
+    log.finished()
+
+
+def parse_args() -> argparse.Namespace:
+    arg_parser = argparse.ArgumentParser(
+        fromfile_prefix_chars="@",
+        description=textwrap.dedent(
+            """Score every combination of ensemble members against gold standard
+            label text. Reports the accuracy and the cost of each pipeline so the
+            cheapest one that is accurate enough can be picked."""
+        ),
+    )
+
+    arg_parser.add_argument(
+        "--gold-csv",
+        type=Path,
+        metavar="PATH",
+        required=True,
+        help="""A CSV with the gold standard text. It needs a "label" column with
+            the path to the label image, relative to the CSV, and a "gold_text"
+            column. If the images are whole herbarium sheets, add label_left,
+            label_top, label_right, and label_bottom columns to crop the labels.""",
+    )
+
+    arg_parser.add_argument(
+        "--members",
+        choices=ocr_compare.MEMBERS,
+        nargs="*",
+        default=ocr_compare.MEMBERS,
+        help="""Combine these ensemble members. (default: all of them)""",
+    )
+
+    arg_parser.add_argument(
+        "--ocr-results",
+        type=Path,
+        metavar="PATH",
+        help="""Save each label's OCR text and times for every member to this JSONL
+            file. Labels already in it are not OCRed again, so the scoring can be
+            rerun with other options.""",
+    )
+
+    arg_parser.add_argument(
+        "--output",
+        type=Path,
+        metavar="PATH",
+        help="""Save the accuracy and cost of every pipeline to this CSV file.""",
+    )
+
+    arg_parser.add_argument(
+        "--target",
+        type=float,
+        default=0.95,
+        metavar="FRACTION",
+        help="""Report the cheapest pipeline with at least this character accuracy.
+            (default: %(default)s)""",
+    )
+
+    arg_parser.add_argument(
+        "-P",
+        "--pre-process",
+        action="store_true",
+        help="""Pre-process the OCR text of each member.""",
+    )
+
+    arg_parser.add_argument(
+        "-p",
+        "--post-process",
+        action="store_true",
+        help="""Also score every combination with the consensus text
+            post-processed.""",
+    )
+
+    arg_parser.add_argument(
+        "-L",
+        "--align-lines",
+        action="store_true",
+        help="""Build the consensus sequences one line at a time.""",
+    )
+
+    arg_parser.add_argument(
+        "--workers",
+        type=int,
+        default=4,
+        metavar="INT",
+        help="""OCR and score the labels in this many worker processes.
+            (default: %(default)s)""",
+    )
+
+    arg_parser.add_argument(
+        "--chunk",
+        type=int,
+        default=4,
+        metavar="INT",
+        help="""Send the labels to the scoring workers this many at a time.
+            (default: %(default)s)""",
+    )
+
+    arg_parser.add_argument(
+        "--device",
+        default="cpu",
+        metavar="DEVICE",
+        help="""Run EasyOCR on this device, for example: cpu, cuda, cuda:1, or mps.
+            (default: %(default)s)""",
+    )
+
+    arg_parser.add_argument(
+        "--tesseract-backend",
+        choices=tesseract_api.BACKENDS,
+        default="auto",
+        help="""How to run Tesseract. (default: %(default)s)""",
+    )
+
+    args = arg_parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    main()
@@ -6,7 +6,7 @@ from pathlib import Path
 
 from util.pylib import log
 
-from ensemble.pylib import ocr_labels
+from ensemble.pylib import ocr_labels, tesseract_api, text_sink
 
 
 def main():
@@ -32,16 +32,53 @@ def parse_args() -> argparse.Namespace:
         "--label-dir",
         type=Path,
         metavar="PATH",
-        required=True,
         help="""Directory containing the labels to OCR.""",
     )
 
+    arg_parser.add_argument(
+        "--label-list",
+        type=Path,
+        metavar="PATH",
+        help="""A file with the paths of the labels to OCR, one per line. Use "-" to
+            read the paths from stdin.""",
+    )
+
     arg_parser.add_argument(
         "--text-dir",
         type=Path,
         metavar="PATH",
         required=True,
-        help="""Output OCR text files to this directory.""",
+        help="""Output the OCR text to this directory.""",
+    )
+
+    arg_parser.add_argument(
+        "--sink",
+        choices=text_sink.SINKS,
+        default="text",
+        help="""How to save the OCR results in the --text-dir. "text" writes a text
+            file for each label and the text from each ensemble member in a
+            .members.json file next to it. "jsonl" appends every label to
+            ocr_text.jsonl and "sqlite" saves them in ocr_text.sqlite, with the
+            text from each ensemble member and how long the label took.
+            (default: %(default)s)""",
+    )
+
+    arg_parser.add_argument(
+        "--sink-batch",
+        type=int,
+        default=100,
+        metavar="INT",
+        help="""The jsonl and sqlite sinks save this many labels at a time.
+            (default: %(default)s)""",
+    )
+
+    arg_parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="""Only OCR labels that are new or changed since the last run with the
+            same pipeline, --max-dim, and --tesseract-backend. This keeps a
+            manifest of finished labels in the --text-dir, so an interrupted run
+            can be resumed.""",
     )
 
     arg_parser.add_argument(
@@ -126,7 +163,183 @@ def parse_args() -> argparse.Namespace:
             """,
     )
 
+    arg_parser.add_argument(
+        "-L",
+        "--align-lines",
+        action="store_true",
+        help="""Build the consensus sequence one line at a time. The lines from the
+            ensemble members are matched up and each group of lines is aligned by
+            itself. This is much faster than aligning the whole text of long labels
+            but it may give a slightly different text. Leave it off to align the
+            whole texts.""",
+    )
+
+    arg_parser.add_argument(
+        "-E",
+        "--early-stop",
+        action="store_true",
+        help="""Run the ensemble members from the cheapest to the most expensive and
+            stop as soon as two of them agree, see --stop-distance and --stop-conf.
+            Clean labels only need the first two members. Every sink records
+            which members ran for each label.""",
+    )
+
+    arg_parser.add_argument(
+        "--stop-distance",
+        type=float,
+        default=0.05,
+        metavar="FRACTION",
+        help="""With --early-stop, two members agree when the edit distance between
+            their texts is at most this fraction of the text length.
+            (default: %(default)s)""",
+    )
+
+    arg_parser.add_argument(
+        "--stop-conf",
+        type=float,
+        default=0.8,
+        metavar="FRACTION",
+        help="""With --early-stop, only members whose OCR boxes have at least this
+            mean confidence can agree. (default: %(default)s)""",
+    )
+
+    arg_parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=1,
+        metavar="INT",
+        help="""Run up to this many ensemble members at the same time for each label.
+            Tesseract and EasyOCR calls are run in worker threads.
+            (default: %(default)s)""",
+    )
+
+    arg_parser.add_argument(
+        "--device",
+        default="cpu",
+        metavar="DEVICE",
+        help="""Run EasyOCR on this device, for example: cpu, cuda, cuda:1, or mps.
+            The EasyOCR models are only loaded when an EasyOCR step is in the
+            pipeline. (default: %(default)s)""",
+    )
+
+    arg_parser.add_argument(
+        "--tesseract-backend",
+        choices=tesseract_api.BACKENDS,
+        default="auto",
+        help="""How to run Tesseract. "tesserocr" keeps a Tesseract engine loaded in
+            each thread and passes it images in memory. "pytesseract" starts a
+            tesseract process for every call. "auto" uses tesserocr if it is
+            installed. (default: %(default)s)""",
+    )
+
+    arg_parser.add_argument(
+        "--easyocr-batch",
+        type=int,
+        default=1,
+        metavar="INT",
+        help="""Run the EasyOCR steps for a label together, in batches of this
+            size. Images with the same shape are batched through the detector, and
+            the recognizer batches the text boxes it finds. 1 turns off batching.
+            (default: %(default)s)""",
+    )
+
+    arg_parser.add_argument(
+        "--ocr-cache",
+        type=Path,
+        metavar="PATH",
+        help="""Cache the raw OCR engine results in this SQLite database. Reruns
+            that only change the text processing steps, or which members are used,
+            will not need to OCR the labels again.""",
+    )
+
+    arg_parser.add_argument(
+        "--ocr-cache-mb",
+        type=int,
+        default=1024,
+        metavar="MB",
+        help="""Evict the least recently used OCR results when the cache grows past
+            this size. (default: %(default)s)""",
+    )
+
+    arg_parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        metavar="INT",
+        help="""OCR the labels in this many worker processes. Each worker builds its
+            own ensemble. (default: %(default)s)""",
+    )
+
+    arg_parser.add_argument(
+        "--unordered",
+        action="store_true",
+        help="""When using workers, handle the results as soon as they finish instead
+            of in label order.""",
+    )
+
+    arg_parser.add_argument(
+        "--max-dim",
+        type=int,
+        default=0,
+        metavar="PIXELS",
+        help="""Labels that are at least twice this size on their longest side are
+            shrunk by an integer factor as they are decoded, to no less than this
+            size. JPEGs are shrunk by the decoder itself. (default: %(default)s,
+            OCR labels at full resolution)""",
+    )
+
+    arg_parser.add_argument(
+        "--scan-chunk",
+        type=int,
+        default=0,
+        metavar="INT",
+        help="""Read the --label-dir this many files at a time and sort each chunk,
+            instead of listing and sorting the whole directory before starting.
+            (default: %(default)s, sort the whole directory)""",
+    )
+
+    arg_parser.add_argument(
+        "--prefetch",
+        type=int,
+        default=4,
+        metavar="INT",
+        help="""Decode up to this many labels ahead of the OCR. With --workers,
+            hand out up to this many labels more than the workers are OCRing.
+            (default: %(default)s)""",
+    )
+
+    arg_parser.add_argument(
+        "--decode-threads",
+        type=int,
+        default=2,
+        metavar="INT",
+        help="""Decode the prefetched labels with this many threads.
+            (default: %(default)s)""",
+    )
+
+    arg_parser.add_argument(
+        "--stats-json",
+        type=Path,
+        metavar="PATH",
+        help="""Save the time spent in each pipeline stage, and counts like the
+            boxes per OCR member, to this JSON file at the end of the run. The wall
+            and CPU times have their totals and percentiles.""",
+    )
+
+    arg_parser.add_argument(
+        "--stats-every",
+        type=float,
+        default=0.0,
+        metavar="SECONDS",
+        help="""Also save the --stats-json this often during the run.
+            (default: %(default)s, only at the end)""",
+    )
+
     args = arg_parser.parse_args()
+
+    if not args.label_dir and not args.label_list:
+        arg_parser.error("Give a --label-dir, a --label-list, or both")
+
     return args
 
 
@@ -0,0 +1,1082 @@
+"""
+Benchmarks for the steps of the OCR pipeline using synthetic labels.
+
+Everything runs offline on labels and OCR output generated from fixed seeds, so
+the results of two runs can be compared. The golden outputs catch speedups that
+change the results.
+"""
+
+import asyncio
+import collections
+import csv
+import io
+import json
+import platform
+import time
+from collections.abc import Callable
+from datetime import UTC, datetime
+from importlib import metadata
+from pathlib import Path
+
+import numpy as np
+import regex as re
+from line_align.pylib import char_sub_matrix
+from line_align.pylib.align import LineAlign
+from line_align.pylib.levenshtein import levenshtein_all
+from PIL import Image, ImageDraw, ImageFont
+from PIL.Image import Image as ImageType
+from scipy import ndimage
+from spell_well.pylib.spell_well import SpellWell
+
+from ensemble.pylib import label_builder, ocr_runner, tesseract_api
+from ensemble.pylib import label_transformer as lt
+from ensemble.pylib.ensemble import Ensemble
+
+LABEL_LINES = [
+    "Tarleton State University Herbarium (TAC)",
+    "Aster ericoides L.",
+    "Asteraceae Heath Aster",
+    "Texas, Erath County, Stephenville. Tarleton Agricultural Center. 0.1",
+    "miles from intersection Hwy 8 and College Farm Road. Area near",
+    "stock tank. Coordinates at entrance gate: 32° 14.889N, 98° 12.602W",
+    "Upland open. Scattered.",
+    "A. Nelson",
+    "N-1289 October 20, 2006",
+]
+
+# Scanning every line for every box is so slow that larger sets are timed once
+MAX_REPEATED_BOXES = 1_000
+
+BENCHMARKS: dict[str, Callable[[int], list[dict]]] = {}
+
+
+def benchmark(func):
+    """Register a benchmark. It takes the repeat count and returns result rows."""
+    BENCHMARKS[func.__name__.removeprefix("bench_")] = func
+    return func
+
+
+def best_time(func, *args, repeat: int = 5, **kwargs) -> float:
+    """Get the fastest of several runs in milliseconds."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args, **kwargs)
+        times.append(time.perf_counter() - start)
+    return min(times) * 1000.0
+
+
+def synthetic_label(
+    lines: list[str] | None = None,
+    angle: float = 0.0,
+    font_size: int = 28,
+    noise: float = 0.0,
+    seed: int = 0,
+) -> ImageType:
+    """
+    Render text as a label image.
+
+    The label is rotated counterclockwise by the angle and gaussian noise with the
+    given standard deviation, in gray levels, is added to it.
+    """
+    lines = lines if lines is not None else LABEL_LINES
+    font = ImageFont.load_default(size=font_size)
+    line_height = int(font_size * 1.6)
+
+    width = max(int(font.getlength(ln)) for ln in lines) + 2 * font_size
+    height = line_height * len(lines) + 2 * font_size
+    image = Image.new("L", (width, height), color=255)
+
+    draw = ImageDraw.Draw(image)
+    for i, ln in enumerate(lines):
+        draw.text((font_size, font_size + i * line_height), ln, fill=0, font=font)
+
+    if angle:
+        image = image.rotate(angle, resample=Image.BICUBIC, expand=True, fillcolor=255)
+
+    if noise:
+        rng = np.random.default_rng(seed)
+        pixels = np.asarray(image, dtype=np.float32)
+        pixels = pixels + rng.normal(0.0, noise, pixels.shape)
+        image = Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+
+    return image.convert("RGB")
+
+
+# =============================================================================
+# The implementations that the faster ones replaced. The benchmarks time the
+# faster ones against them and the tests check that they give the same output.
+
+
+def skew_by_rotation(image, horiz_angles: np.ndarray | None = None) -> float:
+    """Find the skew of the label by rotating it to every candidate angle."""
+    if horiz_angles is None:
+        horiz_angles = np.array([0.0, 0.5, -0.5, 1.0, -1.0, 1.5, -1.5, 2.0, -2.0])
+
+    label = np.array(image).astype(np.int8)
+    scores = []
+    for angle in horiz_angles:
+        rotated = ndimage.rotate(label, angle, reshape=False, order=0)
+        proj = np.sum(rotated, axis=1)
+        score = np.sum((proj[1:] - proj[:-1]) ** 2)
+        scores.append(score)
+    best = max(scores)
+    return float(horiz_angles[scores.index(best)])
+
+
+def deskew_by_rotation(image, horiz_angles: np.ndarray | None = None):
+    """Straighten the label using the skew found by skew_by_rotation()."""
+    angle = skew_by_rotation(image, horiz_angles)
+    if angle != lt.NO_ANGLE:
+        image = ndimage.rotate(image, angle, mode="nearest")
+    return image
+
+
+def consensus_by_column(aligned: list[str]) -> str:
+    """Build the consensus one column at a time."""
+    cons = []
+    for i in range(len(aligned[0])):
+        counts = collections.Counter(s[i] for s in aligned).most_common()
+        top = counts[0][1]
+        chars = [c[0] for c in counts if c[1] == top]
+        chars = sorted(chars, key=label_builder._char_key)
+        cons.append(chars[0])
+    return "".join(cons)
+
+
+def filter_lines_by_all(lines: list[str], threshold=128) -> list[str]:
+    """Filter the lines using every pairwise distance."""
+    if len(lines) <= label_builder.MIN_LEN:
+        return lines
+
+    # levenshtein_all() returns a sorted array of Distance named tuples/objects
+    distances = levenshtein_all(lines)
+
+    threshold += distances[0].dist  # Score cannot be more than best score + threshold
+
+    order = {}  # Dicts preserve insertion order, sets do not
+    for score, i, j in distances:
+        if score > threshold:
+            break
+        order[i] = 1
+        order[j] = 1
+
+    return [lines[k] for k in order]
+
+
+def substitute_by_pattern(line: str) -> str:
+    """Run every substitution pattern in turn."""
+    for old, new in label_builder.SUBSTITUTIONS:
+        line = re.sub(old, new, line)
+    return line
+
+
+def split_in_two(token: str, spell_well) -> str:
+    """Split a token in two where the most common word is on one side."""
+    candidates = []
+    for i in range(1, len(token) - 1):
+        freq1 = spell_well.freq(token[:i])
+        freq2 = spell_well.freq(token[i:])
+        if freq1 or freq2:
+            sum_ = freq1 + freq2
+            count = int(freq1 > 0) + int(freq2 > 0)
+            candidates.append((count, sum_, i))
+
+    if not candidates:
+        return token
+
+    i = sorted(candidates, reverse=True)[0][2]
+    return f"{token[:i]} {token[i:]}"
+
+
+def add_spaces_by_split(line, spell_well, vocab_len=3):
+    """Try every split of every non-word in two."""
+    tokens = spell_well.tokenize(line)
+
+    new = []
+    for token in tokens:
+        if token.isspace() or spell_well.is_word(token) or len(token) < vocab_len:
+            new.append(token)
+        else:
+            new.append(split_in_two(token, spell_well))
+
+    return "".join(new)
+
+
+def post_process_by_pass(text, spell_well):
+    """Run each post-processing step over the whole text."""
+    text = label_builder.substitute(text)
+    text = label_builder.add_spaces(text, spell_well)
+    text = label_builder.remove_spaces(text, spell_well)
+    return label_builder.spell_correct(text, spell_well)
+
+
+def get_lines_by_scan(ocr_boxes: ocr_runner.Boxes, vert_overlap=0.3) -> list:
+    """Find lines by comparing every box to the last box of every line."""
+    order = np.argsort(ocr_boxes.left, kind="stable").tolist()
+    lines: list[ocr_runner.Line] = []
+
+    for box in order:
+        overlap = [(find_overlap(ocr_boxes, line, box), line) for line in lines]
+        overlap = sorted(overlap, key=lambda o: -o[0])
+
+        if overlap and overlap[0][0] > vert_overlap:
+            line = overlap[0][1]
+            line.boxes.append(box)
+        else:
+            line = ocr_runner.Line()
+            line.boxes.append(box)
+            lines.append(line)
+
+    return sorted(lines, key=lambda r: ocr_boxes.top[r.boxes[0]])
+
+
+def find_overlap(ocr_boxes: ocr_runner.Boxes, line, box: int) -> float:
+    """Find the vertical overlap between a line's last box and an OCR box."""
+    last = line.boxes[-1]
+    return ocr_runner.overlap_fraction(
+        int(ocr_boxes.top[last]),
+        int(ocr_boxes.bottom[last]),
+        int(ocr_boxes.top[box]),
+        int(ocr_boxes.bottom[box]),
+    )
+
+
+@benchmark
+def bench_deskew(repeat: int) -> list[dict]:
+    """Compare find_skew() with rotating the whole label for every angle."""
+    rows = []
+    for angle in (0.0, 0.5, -1.0, 1.5, -2.0, 0.8, -1.3):
+        label = synthetic_label(angle=angle, noise=8.0)
+        image = lt.scale(lt.blur(lt.image_to_array(label), sigma=0.5), mode="nearest")
+
+        skew = lt.find_skew(image)
+        old_ms = best_time(deskew_by_rotation, image, repeat=repeat)
+        new_ms = best_time(lt.deskew, image, repeat=repeat)
+        search_ms = best_time(lt.find_skew, image, repeat=repeat)
+        rows.append(
+            {
+                "benchmark": "deskew",
+                "case": f"angle={angle:+.1f}",
+                "old_ms": round(old_ms, 2),
+                "new_ms": round(new_ms, 2),
+                "speedup": round(old_ms / new_ms, 1),
+                "search_ms": round(search_ms, 2),
+                "error": round(abs(skew.angle + angle), 2),  # Straightening undoes it
+                "confidence": round(skew.confidence, 2),
+            }
+        )
+    return rows
+
+
+def noisy_copies(text: str, copies: int, error_rate: float, seed: int = 0) -> list[str]:
+    """Make equal length copies of the text with random character substitutions."""
+    rng = np.random.default_rng(seed)
+    chars = [*sorted(set(text)), "⋄"]
+    copied = []
+    for _ in range(copies):
+        copy = [
+            str(rng.choice(chars)) if rng.random() < error_rate else c for c in text
+        ]
+        copied.append("".join(copy))
+    return copied
+
+
+@benchmark
+def bench_consensus(repeat: int) -> list[dict]:
+    """Compare the vectorized consensus() with voting one column at a time."""
+    rows = []
+    text = "\n".join(LABEL_LINES)
+    for copies, length in ((4, 1), (8, 1), (8, 4)):
+        aligned = noisy_copies(text * length, copies, error_rate=0.1)
+        old_ms = best_time(consensus_by_column, aligned, repeat=repeat)
+        new_ms = best_time(label_builder.consensus, aligned, repeat=repeat)
+        new = label_builder.consensus(aligned)
+        same = new == consensus_by_column(aligned)
+        rows.append(
+            {
+                "benchmark": "consensus",
+                "case": f"copies={copies} chars={len(aligned[0])}",
+                "old_ms": round(old_ms, 2),
+                "new_ms": round(new_ms, 2),
+                "speedup": round(old_ms / new_ms, 1),
+                "same": same,
+            }
+        )
+    return rows
+
+
+def member_texts(text: str, members: int, outliers: int = 1, seed: int = 0):
+    """
+    Make OCR output like an ensemble's members.
+
+    Most members drop some characters and substitute others. The outliers read
+    the label as specks and scratches.
+    """
+    rng = np.random.default_rng(seed)
+    copies = noisy_copies(text, members - outliers, error_rate=0.08, seed=seed)
+    texts = [c.replace("⋄", "") for c in copies]
+    specks = list("|/\\_-.,:;'il1I ")
+    for _ in range(outliers):
+        size = int(len(text) * rng.uniform(0.3, 1.0))
+        texts.append("".join(rng.choice(specks, size)))
+    return texts
+
+
+@benchmark
+def bench_filter_lines(repeat: int) -> list[dict]:
+    """Compare the bounded filter_lines() with computing every pairwise distance."""
+    rows = []
+    text = "\n".join(LABEL_LINES)
+    for members, length in ((4, 1), (8, 1), (8, 4), (12, 1)):
+        lines = member_texts(text * length, members, outliers=max(1, members // 4))
+        old_ms = best_time(filter_lines_by_all, lines, repeat=repeat)
+        new_ms = best_time(label_builder.filter_lines, lines, repeat=repeat)
+        new = label_builder.filter_lines(lines)
+        same = new == filter_lines_by_all(lines)
+        rows.append(
+            {
+                "benchmark": "filter_lines",
+                "case": f"members={members} chars={len(text) * length}",
+                "old_ms": round(old_ms, 2),
+                "new_ms": round(new_ms, 2),
+                "speedup": round(old_ms / new_ms, 1),
+                "same": same,
+                "kept": len(new),
+            }
+        )
+    return rows
+
+
+def whole_text_consensus(texts: list[str], aligner: LineAlign) -> str:
+    return label_builder.consensus(aligner.align(texts))
+
+
+@benchmark
+def bench_align_lines(repeat: int) -> list[dict]:
+    """Compare aligning the member texts one line at a time with all at once."""
+    aligner = LineAlign(char_sub_matrix.get(char_set="default"))
+    rows = []
+    for members, length in ((4, 1), (8, 1), (4, 4), (8, 4)):
+        texts = member_texts("\n".join(LABEL_LINES * length), members, outliers=0)
+        old_ms = best_time(whole_text_consensus, texts, aligner, repeat=repeat)
+        new_ms = best_time(
+            label_builder.consensus_by_line, texts, aligner.align, repeat=repeat
+        )
+        old = whole_text_consensus(texts, aligner).replace("⋄", "")
+        new = label_builder.consensus_by_line(texts, aligner.align).replace("⋄", "")
+        diff = label_builder.levenshtein_within(old, new, max(len(old), len(new)))
+        rows.append(
+            {
+                "benchmark": "align_lines",
+                "case": f"members={members} lines={len(LABEL_LINES) * length}",
+                "old_ms": round(old_ms, 2),
+                "new_ms": round(new_ms, 2),
+                "speedup": round(old_ms / new_ms, 1),
+                "same": old == new,
+                "diff_chars": diff,
+            }
+        )
+    return rows
+
+
+# Things OCR engines do to label text that the substitutions clean up
+OCR_SLIPS = [
+    ("Oct", "0ct"),
+    (" ", "  "),
+    (".", " ."),
+    (",", " ,"),
+    ("e", "e⋄"),
+    ("L.", "L'"),
+    ("0", "@"),
+    (" and ", " & "),
+    ("Area", "Area_"),
+]
+
+
+def ocr_label_lines(copies: int, slip_rate: float = 0.5, seed: int = 0) -> list[str]:
+    """Make label lines with the kinds of slips the OCR engines make."""
+    rng = np.random.default_rng(seed)
+    lines = []
+    for _ in range(copies):
+        for line in LABEL_LINES:
+            for old, new in OCR_SLIPS:
+                if rng.random() < slip_rate:
+                    line = line.replace(old, new)
+            lines.append(line)
+    return lines
+
+
+def substitute_each_line(lines: list[str]) -> str:
+    return "\n".join(substitute_by_pattern(ln) for ln in lines)
+
+
+@benchmark
+def bench_substitute(repeat: int) -> list[dict]:
+    """Compare the compiled substitutions on whole texts with one line at a time."""
+    rows = []
+    for copies in (1, 10, 100):
+        lines = ocr_label_lines(copies)
+        text = "\n".join(lines)
+        old_ms = best_time(substitute_each_line, lines, repeat=repeat)
+        new_ms = best_time(label_builder.substitute_lines, text, repeat=repeat)
+        same = label_builder.substitute_lines(text) == substitute_each_line(lines)
+        rows.append(
+            {
+                "benchmark": "substitute",
+                "case": f"lines={len(lines)}",
+                "old_ms": round(old_ms, 3),
+                "new_ms": round(new_ms, 3),
+                "speedup": round(old_ms / new_ms, 1),
+                "same": same,
+            }
+        )
+    return rows
+
+
+def run_together(lines: list[str], join_rate: float = 0.2, seed: int = 0) -> list[str]:
+    """Remove some of the spaces between words like the OCR engines do."""
+    rng = np.random.default_rng(seed)
+    joined = []
+    for line in lines:
+        words = line.split(" ")
+        joined.append(words[0])
+        for word in words[1:]:
+            joined[-1] += word if rng.random() < join_rate else f" {word}"
+    return joined
+
+
+def add_spaces_to_all(lines: list[str], spell_well, func) -> list[str]:
+    return [func(ln, spell_well) for ln in lines]
+
+
+@benchmark
+def bench_add_spaces(repeat: int) -> list[dict]:
+    """Compare the cached word splitter with trying every split in two."""
+    spell_well = SpellWell()
+    rows = [
+        {
+            "benchmark": "add_spaces",
+            "case": "SouthFlorida",
+            "same": label_builder.add_spaces("SouthFlorida", spell_well)
+            == "South Florida",
+        }
+    ]
+    for copies in (1, 10, 100):
+        lines = run_together(ocr_label_lines(copies, slip_rate=0.0))
+        old_ms = best_time(
+            add_spaces_to_all,
+            lines,
+            spell_well,
+            add_spaces_by_split,
+            repeat=repeat,
+        )
+
+        clear_text_caches()
+        start = time.perf_counter()
+        add_spaces_to_all(lines, spell_well, label_builder.add_spaces)
+        cold_ms = (time.perf_counter() - start) * 1000.0
+        stats = label_builder.cache_stats()["Word split"]
+
+        new_ms = best_time(
+            add_spaces_to_all,
+            lines,
+            spell_well,
+            label_builder.add_spaces,
+            repeat=repeat,
+        )
+        rows.append(
+            {
+                "benchmark": "add_spaces",
+                "case": f"lines={len(lines)}",
+                "old_ms": round(old_ms, 2),
+                "new_ms": round(new_ms, 2),
+                "speedup": round(old_ms / new_ms, 1),
+                "cold_ms": round(cold_ms, 2),
+                "hit_rate": round(stats["hits"] / (stats["hits"] + stats["misses"]), 2),
+            }
+        )
+    return rows
+
+
+def clear_text_caches() -> None:
+    for func in label_builder.TEXT_CACHES.values():
+        func.cache_clear()
+
+
+def post_process_uncached(texts: list[str], spell_well) -> list[str]:
+    clear_text_caches()
+    return [post_process_by_pass(t, spell_well) for t in texts]
+
+
+def post_process_all(texts: list[str], spell_well) -> list[str]:
+    return [label_builder.post_process_text(t, spell_well) for t in texts]
+
+
+@benchmark
+def bench_post_process(repeat: int) -> list[dict]:
+    """Compare the fused and cached post-processing with one pass per step."""
+    spell_well = SpellWell()
+    rows = []
+    for labels in (1, 10, 100):
+        lines = run_together(ocr_label_lines(labels))
+        size = len(LABEL_LINES)
+        texts = ["\n".join(lines[i : i + size]) for i in range(0, len(lines), size)]
+
+        old_ms = best_time(post_process_uncached, texts, spell_well, repeat=repeat)
+        clear_text_caches()
+        new_ms = best_time(post_process_all, texts, spell_well, repeat=repeat)
+        stats = label_builder.cache_stats()["Spell correct"]
+        same = post_process_all(texts, spell_well) == post_process_uncached(
+            texts, spell_well
+        )
+        rows.append(
+            {
+                "benchmark": "post_process",
+                "case": f"labels={labels}",
+                "old_ms": round(old_ms, 2),
+                "new_ms": round(new_ms, 2),
+                "speedup": round(old_ms / new_ms, 1),
+                "same": same,
+                "hit_rate": round(stats["hits"] / (stats["hits"] + stats["misses"]), 2),
+            }
+        )
+    return rows
+
+
+def synthetic_boxes(
+    count: int, words_per_line: int = 10, seed: int = 0
+) -> ocr_runner.Boxes:
+    """Lay out OCR boxes in slightly skewed and jittered lines of words."""
+    rng = np.random.default_rng(seed)
+    boxes = []
+    for i in range(count):
+        row, col = divmod(i, words_per_line)
+        left = col * 60 + int(rng.integers(0, 10))
+        top = row * 30 + col + int(rng.integers(-3, 4))  # A little skew
+        boxes.append(
+            {
+                "conf": 0.9,
+                "ocr_left": left,
+                "ocr_top": top,
+                "ocr_right": left + int(rng.integers(20, 55)),
+                "ocr_bottom": top + int(rng.integers(16, 24)),
+                "ocr_text": f"w{i}",
+            }
+        )
+    rng.shuffle(boxes)
+    return ocr_runner.Boxes.from_dicts(boxes)
+
+
+def line_texts(lines: list, boxes: ocr_runner.Boxes) -> list[list[str]]:
+    return [[boxes.text[i] for i in ln.boxes] for ln in lines]
+
+
+@benchmark
+def bench_get_lines(repeat: int) -> list[dict]:
+    """Compare the indexed get_lines() with comparing every box to every line."""
+    rows = []
+    for count in (10, 100, 1_000, 10_000):
+        boxes = synthetic_boxes(count)
+        times = repeat if count <= MAX_REPEATED_BOXES else 1
+        old_ms = best_time(get_lines_by_scan, boxes, repeat=times)
+        new_ms = best_time(ocr_runner.get_lines, boxes, repeat=times)
+        new = line_texts(ocr_runner.get_lines(boxes), boxes)
+        old = line_texts(get_lines_by_scan(boxes), boxes)
+        rows.append(
+            {
+                "benchmark": "get_lines",
+                "case": f"boxes={count}",
+                "old_ms": round(old_ms, 2),
+                "new_ms": round(new_ms, 2),
+                "speedup": round(old_ms / new_ms, 1),
+                "same": new == old,
+            }
+        )
+    return rows
+
+
+TSV_HEADER = (
+    "level\tpage_num\tblock_num\tpar_num\tline_num\tword_num"
+    "\tleft\ttop\twidth\theight\tconf\ttext"
+)
+
+
+def synthetic_tsv(count: int, seed: int = 0) -> str:
+    """Write OCR boxes like Tesseract's TSV output with a line row for each line."""
+    boxes = synthetic_boxes(count, seed=seed)
+    rows = [TSV_HEADER]
+    for i in range(len(boxes)):
+        if i % 10 == 0:
+            rows.append(f"4\t1\t1\t1\t{i // 10}\t0\t0\t0\t0\t0\t-1\t")
+        left, top = int(boxes.left[i]), int(boxes.top[i])
+        width = int(boxes.right[i]) - left
+        height = int(boxes.bottom[i]) - top
+        conf = 91.5 if i % 7 else 0
+        rows.append(
+            f"5\t1\t1\t1\t{i // 10}\t{i % 10}"
+            f"\t{left}\t{top}\t{width}\t{height}\t{conf}\t{boxes.text[i]} "
+        )
+    return "\n".join(rows) + "\n"
+
+
+def tsv_boxes_by_frame(tsv: str) -> ocr_runner.Boxes:
+    """Parse the TSV like pytesseract's data frame output. Used to check tsv_boxes()."""
+    import pandas as pd  # noqa: PLC0415
+
+    df = pd.read_csv(io.StringIO(tsv), quoting=csv.QUOTE_NONE, sep="\t")
+    df = df.loc[df.conf > 0]
+    return ocr_runner.Boxes(
+        conf=df.conf / 100.0,
+        left=df.left,
+        top=df.top,
+        right=df.left + df.width,
+        bottom=df.top + df.height,
+        text=df.text.astype(str).str.strip(),
+    )
+
+
+@benchmark
+def bench_tesseract_tsv(repeat: int) -> list[dict]:
+    """Compare parsing Tesseract's TSV directly with building a pandas data frame."""
+    rows = []
+    for count in (30, 300, 3_000):
+        tsv = synthetic_tsv(count)
+        old_ms = best_time(tsv_boxes_by_frame, tsv, repeat=repeat)
+        new_ms = best_time(ocr_runner.tsv_boxes, tsv, repeat=repeat)
+        new = ocr_runner.tsv_boxes(tsv).to_dict()
+        old = tsv_boxes_by_frame(tsv).to_dict()
+        rows.append(
+            {
+                "benchmark": "tesseract_tsv",
+                "case": f"words={count}",
+                "old_ms": round(old_ms, 2),
+                "new_ms": round(new_ms, 2),
+                "speedup": round(old_ms / new_ms, 1),
+                "same": new == old,
+            }
+        )
+    return rows
+
+
+# Synthetic labels for timing the transforms, engines, and whole ensembles:
+# font size, angle, and noise. The first is smaller than the scale() threshold.
+LABEL_CASES = [(20, 0.0, 0.0), (28, 1.0, 8.0), (48, -1.5, 16.0)]
+
+# Representative ensembles, like the ocr-labels options
+ENSEMBLES = {
+    "-r": {"none_tesseract"},
+    "-rb": {"none_tesseract", "binarize_tesseract"},
+    "-rdbnP": {
+        "none_tesseract",
+        "deskew_tesseract",
+        "binarize_tesseract",
+        "denoise_tesseract",
+        "pre_process",
+    },
+    "-rdbnPL": {
+        "none_tesseract",
+        "deskew_tesseract",
+        "binarize_tesseract",
+        "denoise_tesseract",
+        "pre_process",
+        "align_lines",
+    },
+    "-rdbnPE": {
+        "none_tesseract",
+        "deskew_tesseract",
+        "binarize_tesseract",
+        "denoise_tesseract",
+        "pre_process",
+        "early_stop",
+    },
+}
+
+EASYOCR = False  # EasyOCR needs its models, so it is only timed when asked for
+
+
+def label_case(font_size: int, angle: float, noise: float) -> str:
+    return f"font={font_size} angle={angle:+.1f} noise={noise:g}"
+
+
+def label_size(label: ImageType) -> str:
+    return f"{label.width}x{label.height}"
+
+
+@benchmark
+def bench_transforms(repeat: int) -> list[dict]:
+    """Time each label transform on labels of several sizes, skews, and noise."""
+    rows = []
+    for font_size, angle, noise in LABEL_CASES:
+        label = synthetic_label(font_size=font_size, angle=angle, noise=noise)
+        gray = lt.image_to_array(label)
+        blurred = lt.blur(gray, sigma=0.5)
+        scaled = lt.scale(blurred, mode="nearest")
+        oriented = lt.orient(scaled)
+        deskewed = lt.deskew(oriented)
+        binary = lt.binarize_sauvola(deskewed)
+        steps = [
+            ("image_to_array", lt.image_to_array, label),
+            ("blur", lt.blur, gray),
+            ("scale", lt.scale, blurred),
+            ("orient", lt.orient, scaled),
+            ("find_skew", lt.find_skew, oriented),
+            ("deskew", lt.deskew, oriented),
+            ("binarize_sauvola", lt.binarize_sauvola, deskewed),
+            ("remove_small_holes", lt.remove_small_holes, binary),
+            ("binary_opening", lt.binary_opening, binary),
+            ("array_to_image", lt.array_to_image, binary),
+            ("transform_variants", all_variants, label),
+        ]
+        for name, func, image in steps:
+            rows.append(
+                {
+                    "benchmark": "transforms",
+                    "case": f"{name} {label_case(font_size, angle, noise)}",
+                    "ms": round(best_time(func, image, repeat=repeat), 2),
+                    "size": label_size(label),
+                }
+            )
+    return rows
+
+
+def all_variants(label: ImageType) -> dict:
+    return lt.transform_variants(label, {"deskew_full", "denoise_full"})
+
+
+def engine_steps() -> list[tuple[str, Callable]]:
+    steps = [("tesseract_engine", ocr_runner.tesseract_engine)]
+    if EASYOCR:
+        steps.append(("easyocr_engine", ocr_runner.easyocr_engine))
+        steps.append(("easyocr_batch", lambda i: ocr_runner.easyocr_batch([i, i])[0]))
+    return steps
+
+
+@benchmark
+def bench_engines(repeat: int) -> list[dict]:
+    """Time the OCR engine wrappers and see how much of the label text they read."""
+    truth = "\n".join(LABEL_LINES)
+    rows = []
+    for font_size, angle, noise in LABEL_CASES:
+        label = synthetic_label(font_size=font_size, angle=angle, noise=noise)
+        for name, engine in engine_steps():
+            boxes = engine(label)
+            text = ocr_runner.build_text(boxes, pre_process=False)
+            rows.append(
+                {
+                    "benchmark": "engines",
+                    "case": f"{name} {label_case(font_size, angle, noise)}",
+                    "ms": round(best_time(engine, label, repeat=repeat), 2),
+                    "boxes": len(boxes),
+                    "diff_chars": text_diff(truth, text),
+                }
+            )
+    return rows
+
+
+def text_diff(old: str, new: str) -> int:
+    return label_builder.levenshtein_within(old, new, max(len(old), len(new)))
+
+
+def run_labels(ensemble, labels: list[ImageType]) -> list[str]:
+    return [asyncio.run(ensemble.run(label)) for label in labels]
+
+
+@benchmark
+def bench_throughput(repeat: int) -> list[dict]:
+    """Time whole labels through representative ensembles."""
+    ensembles = dict(ENSEMBLES)
+    if EASYOCR:
+        ensembles["-Rr"] = {"none_easyocr", "none_tesseract"}
+
+    labels = [
+        synthetic_label(font_size=f, angle=a, noise=n, seed=i)
+        for i, (f, a, n) in enumerate(LABEL_CASES)
+    ]
+    truth = "\n".join(LABEL_LINES)
+    rows = []
+    for flags, pipes in ensembles.items():
+        ensemble = Ensemble(**dict.fromkeys(pipes, True))
+        texts = run_labels(ensemble, labels)
+        label_ms = best_time(run_labels, ensemble, labels, repeat=repeat) / len(labels)
+        rows.append(
+            {
+                "benchmark": "throughput",
+                "case": f"{flags} labels={len(labels)}",
+                "ms": round(label_ms, 1),
+                "labels_per_s": round(1000.0 / label_ms, 2),
+                "diff_chars": sum(text_diff(truth, t) for t in texts),
+            }
+        )
+    return rows
+
+
+# =============================================================================
+# Golden outputs: the results of each text stage on fixed synthetic inputs. They
+# are saved with --update-golden and every run checks them, so a speedup cannot
+# silently change what the pipeline outputs. Outputs that depend on Tesseract or
+# on another package are saved with its version, and they are only checked
+# against that version.
+
+GOLDEN_PATH = Path(__file__).with_name("benchmark_golden.json")
+
+GOLDEN: dict[str, Callable[[], object]] = {}
+GOLDEN_NEEDS: dict[str, tuple[str, ...]] = {}
+
+SKIPPED = "skipped"  # The golden cannot be checked here
+
+
+def golden(*needs: str):
+    """
+    Register a golden output. It takes no arguments and returns JSON data.
+
+    The needs are "tesseract" or the names of the packages whose versions can
+    change the output.
+    """
+
+    def register(func):
+        name = func.__name__.removeprefix("golden_")
+        GOLDEN[name] = func
+        GOLDEN_NEEDS[name] = needs
+        return func
+
+    return register
+
+
+@golden()
+def golden_get_lines() -> list[str]:
+    boxes = synthetic_boxes(300)
+    return [" ".join(ln) for ln in line_texts(ocr_runner.get_lines(boxes), boxes)]
+
+
+@golden()
+def golden_tesseract_tsv() -> dict:
+    return ocr_runner.tsv_boxes(synthetic_tsv(300)).to_dict()
+
+
+@golden()
+def golden_filter_lines() -> list[str]:
+    texts = member_texts("\n".join(LABEL_LINES), members=8, outliers=2)
+    return label_builder.filter_lines(texts)
+
+
+@golden()
+def golden_consensus() -> str:
+    return label_builder.consensus(noisy_copies("\n".join(LABEL_LINES), 8, 0.1))
+
+
+@golden()
+def golden_substitute() -> str:
+    return label_builder.substitute_lines("\n".join(ocr_label_lines(3)))
+
+
+@golden()
+def golden_find_skew() -> list[float]:
+    angles = []
+    for font_size, angle, noise in LABEL_CASES:
+        label = synthetic_label(font_size=font_size, angle=angle, noise=noise)
+        angles.append(lt.find_skew(lt.image_to_array(label)).angle)
+    return angles
+
+
+@golden()
+def golden_binarize() -> list[int]:
+    """Count the dark pixels in each binarized label."""
+    counts = []
+    for font_size, angle, noise in LABEL_CASES:
+        label = synthetic_label(font_size=font_size, angle=angle, noise=noise)
+        binary = lt.transform_variants(label, {"binarize"})["binarize"]
+        counts.append(int(binary.size - np.count_nonzero(binary)))
+    return counts
+
+
+@golden("line-align")
+def golden_align_lines() -> str:
+    aligner = LineAlign(char_sub_matrix.get(char_set="default"))
+    texts = member_texts("\n".join(LABEL_LINES), members=6, outliers=0)
+    return label_builder.consensus_by_line(texts, aligner.align)
+
+
+@golden("spell-well")
+def golden_post_process() -> list[str]:
+    spell_well = SpellWell()
+    clear_text_caches()
+    lines = run_together(ocr_label_lines(2))
+    size = len(LABEL_LINES)
+    texts = ["\n".join(lines[i : i + size]) for i in range(0, len(lines), size)]
+    return post_process_all(texts, spell_well)
+
+
+@golden("tesseract", "line-align")
+def golden_label_text() -> dict[str, list[str]]:
+    """OCR the synthetic labels with every representative ensemble."""
+    labels = [
+        synthetic_label(font_size=f, angle=a, noise=n, seed=i)
+        for i, (f, a, n) in enumerate(LABEL_CASES)
+    ]
+    return {
+        flags: run_labels(Ensemble(**dict.fromkeys(pipes, True)), labels)
+        for flags, pipes in ENSEMBLES.items()
+    }
+
+
+def read_golden(path: Path = GOLDEN_PATH) -> dict:
+    if not path.exists():
+        return {}
+    with path.open() as f:
+        return json.load(f)
+
+
+def as_json(value):
+    """Get the value as it will be read back from JSON, e.g. tuples as lists."""
+    return json.loads(json.dumps(value))
+
+
+def need_versions(needs: tuple[str, ...]) -> dict[str, str | None]:
+    """Get the version of everything a golden needs, None when it is missing."""
+    versions = {}
+    for need in needs:
+        if need == "tesseract":
+            versions[need] = tesseract_api.version()
+            continue
+        try:
+            versions[need] = metadata.version(need)
+        except metadata.PackageNotFoundError:
+            versions[need] = None
+    return versions
+
+
+def check_golden(names: list[str], path: Path = GOLDEN_PATH) -> list[dict]:
+    """
+    Compare the outputs with the saved golden outputs.
+
+    An output without a golden, a golden that was saved with other versions of
+    what it needs, and a golden whose needs are missing are skipped.
+    """
+    saved = read_golden(path)
+    rows = []
+    for name in names:
+        versions = need_versions(GOLDEN_NEEDS[name])
+        row = {"benchmark": "golden", "case": name}
+
+        if name not in saved:
+            row |= {"same": SKIPPED, "note": "no golden, save it with --update-golden"}
+        elif missing := [n for n, v in versions.items() if v is None]:
+            row |= {"same": SKIPPED, "note": f"needs {', '.join(missing)}"}
+        elif versions != saved[name]["versions"]:
+            other = ", ".join(f"{k} {v}" for k, v in saved[name]["versions"].items())
+            row |= {"same": SKIPPED, "note": f"saved with {other}"}
+        else:
+            row["same"] = as_json(GOLDEN[name]()) == saved[name]["output"]
+
+        rows.append(row)
+    return rows
+
+
+def update_golden(names: list[str], path: Path = GOLDEN_PATH) -> None:
+    """Save the current outputs as the golden outputs, keeping the others."""
+    versions = {name: need_versions(GOLDEN_NEEDS[name]) for name in names}
+    missing = [f"{n} needs {k}" for n, v in versions.items() for k in v if not v[k]]
+    if missing:
+        msg = f"Cannot save the golden outputs: {'; '.join(missing)}"
+        raise ValueError(msg)
+
+    saved = read_golden(path)
+    for name in names:
+        saved[name] = {"versions": versions[name], "output": as_json(GOLDEN[name]())}
+    with path.open("w") as f:
+        json.dump(dict(sorted(saved.items())), f, indent=2, ensure_ascii=False)
+        f.write("\n")
+
+
+# =============================================================================
+# Saving and comparing results
+
+TIME_KEYS = ("new_ms", "ms")  # The time that is compared in a row
+MIN_MS_DIFF = 0.05  # Smaller changes are timer noise
+
+
+def run(names: list[str], repeat: int = 5) -> list[dict]:
+    rows = []
+    for name in names:
+        rows += BENCHMARKS[name](repeat)
+    return rows
+
+
+def save_results(path: Path, rows: list[dict], repeat: int) -> None:
+    """Save the results as JSON with enough about the machine to compare runs."""
+    results = {
+        "created": datetime.now(UTC).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "machine": platform.platform(),
+        "processor": platform.processor() or platform.machine(),
+        "repeat": repeat,
+        "rows": rows,
+    }
+    with path.open("w") as f:
+        json.dump(results, f, indent=2)
+        f.write("\n")
+
+
+def read_results(path: Path) -> list[dict]:
+    with path.open() as f:
+        return json.load(f)["rows"]
+
+
+def row_ms(row: dict) -> float | None:
+    return next((row[k] for k in TIME_KEYS if k in row), None)
+
+
+def compare(
+    baseline: list[dict], rows: list[dict], tolerance: float = 0.2
+) -> list[dict]:
+    """
+    Compare results with a baseline and flag the regressions.
+
+    A row is slower when its time grew by more than the tolerance, as a fraction
+    of the baseline time. A row whose output stopped matching, "same" became
+    false, is always flagged.
+    """
+    base = {(r["benchmark"], r["case"]): r for r in baseline}
+    compared = []
+    for row in rows:
+        old = base.get((row["benchmark"], row["case"]), {})
+        old_ms, new_ms = row_ms(old), row_ms(row)
+
+        change, status = None, "ok"
+        if old_ms and new_ms is not None:
+            change = round(new_ms / old_ms - 1.0, 3)
+            if change > tolerance and new_ms - old_ms > MIN_MS_DIFF:
+                status = "SLOWER"
+            elif change < -tolerance and old_ms - new_ms > MIN_MS_DIFF:
+                status = "faster"
+        elif not old:
+            status = "new"
+
+        if row.get("same") is False and old.get("same") is not False:
+            status = "CHANGED"
+
+        compared.append(
+            {
+                "benchmark": row["benchmark"],
+                "case": row["case"],
+                "old_ms": "" if old_ms is None else old_ms,
+                "new_ms": "" if new_ms is None else new_ms,
+                "change": f"{change:+.1%}" if change is not None else "",
+                "status": status,
+            }
+        )
+    return compared
+
+
+def regressions(compared: list[dict]) -> list[dict]:
+    return [r for r in compared if r["status"] in ("SLOWER", "CHANGED")]
+
+
+def print_rows(rows: list[dict]) -> None:
+    """Print the results as a simple table."""
+    columns = list(dict.fromkeys(k for r in rows for k in r))
+    widths = {c: max(len(c), *(len(str(r.get(c, ""))) for r in rows)) for c in columns}
+    print("  ".join(c.ljust(widths[c]) for c in columns))
+    for row in rows:
+        print("  ".join(str(row.get(c, "")).ljust(widths[c]) for c in columns))
@@ -1,11 +1,19 @@
+import asyncio
 from typing import ClassVar
 
 from line_align.pylib import char_sub_matrix
 from line_align.pylib.align import LineAlign
 from spell_well.pylib.spell_well import SpellWell
 
-from ensemble.pylib import label_builder, ocr_runner
+from ensemble.pylib import (
+    label_builder,
+    label_reader,
+    ocr_runner,
+    stage_stats,
+    tesseract_api,
+)
 from ensemble.pylib import label_transformer as lt
+from ensemble.pylib.ocr_cache import OcrCache, image_hash
 
 
 class Ensemble:
@@ -20,72 +28,295 @@ class Ensemble:
         "denoise_tesseract": "[denoise,tesseract]",
         "pre_process": "[pre_process]",
         "post_process": "[post_process]",
+        "align_lines": "[align_lines]",
+        "early_stop": "[early_stop]",
+    }
+
+    # The relative cost of a member's transform & engine, for --early-stop
+    transform_costs: ClassVar[dict[str, int]] = {
+        "none": 0,
+        "deskew": 1,
+        "binarize": 2,
+        "denoise": 3,
+    }
+    engine_costs: ClassVar[dict[str, int]] = {"tesseract": 0, "easyocr": 4}
+
+    engines: ClassVar[dict] = {
+        "easyocr": ocr_runner.easyocr_engine,
+        "tesseract": ocr_runner.tesseract_engine,
     }
 
     def __init__(self, **kwargs):
-        self.pipes = {k for k in self.all_pipes if kwargs.get(k, False)}
+        self.pipes = self.select_pipes(**kwargs)
         if not self.pipes:
             msg = "No pipes given"
             raise ValueError(msg)
 
+        ocr_runner.EngineConfig.device = kwargs.get("device") or "cpu"
+        tesseract_api.set_backend(kwargs.get("tesseract_backend") or "auto")
+
+        # How many ensemble members may run their OCR engines at the same time
+        self.concurrency = max(1, kwargs.get("concurrency") or 1)
+        tesseract_api.set_max_engines(self.concurrency)
+
+        # Run EasyOCR on this many of a label's images at once, 1 = no batching
+        self.easyocr_batch = max(1, kwargs.get("easyocr_batch") or 1)
+
+        # Decode labels no larger than needed, 0 = full resolution
+        self.max_dim = max(0, kwargs.get("max_dim") or 0)
+        self.image_stats = {"labels": 0, "bytes": 0, "max_bytes": 0}
+
+        # Stop adding members once two of them read the label alike
+        self.stop_distance = kwargs.get("stop_distance", 0.05)  # Fraction of length
+        self.stop_conf = kwargs.get("stop_conf", 0.8)  # Mean box confidence
+
+        cache, cache_mb = kwargs.get("ocr_cache"), kwargs.get("ocr_cache_mb", 1024)
+        self.cache = OcrCache(cache, cache_mb) if cache else None
+
         matrix = char_sub_matrix.get(char_set="default")
         self.aligner = LineAlign(matrix)
+        self.align = stage_stats.timed("align")(self.aligner.align)
         self.spell_well = SpellWell()
 
     @property
-    def needs_deskew(self):
-        deskew = any(1 for p in self.pipes if p.startswith("deskew"))
-        return deskew or self.needs_binarize or self.needs_denoise
+    def members(self) -> list[str]:
+        """Get the selected image transform + OCR engine pipes in a stable order."""
+        engines = tuple(self.engines)
+        return [p for p in self.all_pipes if p in self.pipes and p.endswith(engines)]
 
     @property
-    def needs_denoise(self):
-        return any(1 for p in self.pipes if p.startswith("denoise"))
+    def members_by_cost(self) -> list[str]:
+        """Get the members from the cheapest to the most expensive to run."""
+
+        def cost(member):
+            transform, engine = member.split("_")
+            return self.transform_costs[transform] + self.engine_costs[engine]
+
+        return sorted(self.members, key=cost)
 
     @property
-    def needs_binarize(self):
-        binarize = any(1 for p in self.pipes if p.startswith("binarize"))
-        return binarize or self.needs_denoise
+    def image_mode(self) -> str:
+        """Only members that OCR the untransformed label need it in color."""
+        return "RGB" if any(m.startswith("none_") for m in self.members) else "L"
 
     @property
     def pipeline(self):
-        pipes = [v for k, v in self.all_pipes.items() if k in self.pipes]
-        return ",".join(pipes)
+        return self.build_pipeline(self.pipes)
+
+    @classmethod
+    def select_pipes(cls, **kwargs) -> set[str]:
+        return {k for k in cls.all_pipes if kwargs.get(k, False)}
+
+    @classmethod
+    def build_pipeline(cls, pipes: set[str]) -> str:
+        """Get the pipeline signature without building an ensemble."""
+        return ",".join(v for k, v in cls.all_pipes.items() if k in pipes)
+
+    @classmethod
+    def build_signature(cls, **kwargs) -> str:
+        """
+        Get the pipeline signature with the other options that change the text.
+
+        These are the size the labels are decoded at and how Tesseract is run.
+        """
+        pipes = cls.select_pipes(**kwargs)
+        signature = [cls.build_pipeline(pipes)]
+        if max_dim := kwargs.get("max_dim"):
+            signature.append(f"[max_dim={max_dim}]")
+        if any(p.endswith("_tesseract") for p in pipes):
+            backend = tesseract_api.backend_name(
+                kwargs.get("tesseract_backend") or "auto"
+            )
+            signature.append(f"[backend={backend}]")
+        return ",".join(signature)
 
     async def run(self, image):
-        lines = list(await self.ocr(image))
-        lines = label_builder.filter_lines(lines)
-        text = self.aligner.align(lines)
-        text = label_builder.consensus(text)
+        result = await self.run_label(image)
+        return result["text"]
+
+    async def run_label(self, image, label_hash: str | None = None) -> dict:
+        """
+        OCR the label and keep the text from every member with the consensus.
+
+        The label hash is the hash of the label's file, see cache_keys().
+        """
+        if "early_stop" in self.pipes:
+            members = await self.ocr_until_agreed(image, label_hash)
+        else:
+            texts = await self.ocr(image, label_hash)
+            members = dict(zip(self.members, texts, strict=True))
+        texts = list(members.values())
+        stage_stats.count("members run", len(texts))
+
+        with stage_stats.timer("filter_lines"):
+            lines = label_builder.filter_lines(texts)
+        stage_stats.count("members dropped", len(texts) - len(lines))
+
+        if "align_lines" in self.pipes:  # Its time includes the align times
+            with stage_stats.timer("consensus_by_line"):
+                text = label_builder.consensus_by_line(lines, self.align)
+        else:
+            text = self.align(lines)
+            with stage_stats.timer("consensus"):
+                text = label_builder.consensus(text)
+
         if "post_process" in self.pipes:
-            text = label_builder.post_process_text(text, self.spell_well)
-        return text
-
-    async def ocr(self, image):
-        deskew = lt.transform_label("deskew", image) if self.needs_deskew else None
-        binary = lt.transform_label("binarize", deskew) if self.needs_binarize else None
-        denoise = lt.transform_label("denoise", binary) if self.needs_denoise else None
-
-        deskew = lt.array_to_image(deskew) if deskew is not None else None
-        binary = lt.array_to_image(binary) if binary is not None else None
-        denoise = lt.array_to_image(denoise) if denoise is not None else None
-
-        pre_process = "preprocess" in self.pipes
-
-        lines = []
-        if "none_easyocr" in self.pipes:
-            lines.append(await ocr_runner.easy_text(image, pre_process=pre_process))
-        if "none_tesseract" in self.pipes:
-            lines.append(await ocr_runner.tess_text(image, pre_process=pre_process))
-        if "deskew_easyocr" in self.pipes:
-            lines.append(await ocr_runner.easy_text(deskew, pre_process=pre_process))
-        if "deskew_tesseract" in self.pipes:
-            lines.append(await ocr_runner.tess_text(deskew, pre_process=pre_process))
-        if "binarize_easyocr" in self.pipes:
-            lines.append(await ocr_runner.easy_text(binary, pre_process=pre_process))
-        if "binarize_tesseract" in self.pipes:
-            lines.append(await ocr_runner.tess_text(binary, pre_process=pre_process))
-        if "denoise_easyocr" in self.pipes:
-            lines.append(await ocr_runner.easy_text(denoise, pre_process=pre_process))
-        if "denoise_tesseract" in self.pipes:
-            lines.append(await ocr_runner.tess_text(denoise, pre_process=pre_process))
-        return lines
+            with stage_stats.timer("post_process"):
+                text = label_builder.post_process_text(text, self.spell_well)
+
+        stage_stats.count("text length", len(text))
+        return {"text": text, "members": members}
+
+    async def ocr(self, image, label_hash: str | None = None):
+        """
+        OCR the image with every ensemble member.
+
+        The results are returned in member order, so the output is the same as
+        running each member one after the other.
+        """
+        transforms = lt.LabelTransforms(image)
+        keys = self.cache_keys(image, label_hash)
+        boxes = await self.ocr_boxes(image, self.members, transforms, keys)
+        self.add_image_stats(transforms.nbytes)
+        return [self.build_text(boxes[m]) for m in self.members]
+
+    async def ocr_until_agreed(
+        self, image, label_hash: str | None = None
+    ) -> dict[str, str]:
+        """
+        OCR the image with the cheapest members until two of them agree.
+
+        The members run from the cheapest to the most expensive, as many at a
+        time as the concurrency setting allows. Two members agree when the edit
+        distance between their texts is within the stop distance, as a fraction
+        of the text length, and the mean confidence of both of their boxes is at
+        least the stop confidence. The members after that are skipped, along with
+        the image transforms that only they need. The texts of the members that
+        ran are returned in the order they ran.
+        """
+        transforms = lt.LabelTransforms(image)
+        keys = self.cache_keys(image, label_hash)
+        texts, confs = {}, {}
+
+        order = self.members_by_cost
+        for beg in range(0, len(order), self.concurrency):
+            members = order[beg : beg + self.concurrency]
+            boxes = await self.ocr_boxes(image, members, transforms, keys)
+            for member in members:
+                texts[member] = self.build_text(boxes[member])
+                confs[member] = boxes[member].mean_conf
+            if self.agreed(texts, confs):
+                break
+
+        self.add_image_stats(transforms.nbytes)
+        return texts
+
+    def agreed(self, texts: dict[str, str], confs: dict[str, float]) -> bool:
+        """Check if any two confident members read the label alike."""
+        sure = [m for m in texts if confs[m] >= self.stop_conf]
+        for i, member1 in enumerate(sure):
+            for member2 in sure[i + 1 :]:
+                text1, text2 = texts[member1], texts[member2]
+                cutoff = int(self.stop_distance * max(len(text1), len(text2)))
+                if label_builder.levenshtein_within(text1, text2, cutoff) <= cutoff:
+                    return True
+        return False
+
+    def build_text(self, boxes: ocr_runner.Boxes) -> str:
+        pre_process = "pre_process" in self.pipes
+        return ocr_runner.build_text(boxes, pre_process=pre_process)
+
+    async def ocr_boxes(
+        self,
+        image,
+        members: list[str],
+        transforms: lt.LabelTransforms,
+        keys: dict[str, str],
+    ) -> dict[str, ocr_runner.Boxes]:
+        """
+        Get the OCR boxes for the members.
+
+        Members are dispatched together and limited by the concurrency setting.
+
+        Engine results are looked up in the OCR cache first. The image transforms
+        are only run, in a worker thread, when a member needs a transformed image
+        that is not cached. Transform stages shared by several members are only
+        run once. When EasyOCR batching is on, the EasyOCR members that are not
+        cached are run as one batch.
+        """
+        limit = asyncio.Semaphore(self.concurrency)
+        cached = {m: self.cache.get(keys[m]) for m in members} if self.cache else {}
+
+        async def get_image(transform):
+            if transform == "none":
+                return image
+            return await asyncio.to_thread(transforms.__getitem__, f"{transform}_full")
+
+        async def run_batch(members):
+            images = [await get_image(m.split("_")[0]) for m in members]
+            async with limit:
+                results = await asyncio.to_thread(
+                    ocr_runner.easyocr_batch, images, self.easyocr_batch
+                )
+            return dict(zip(members, results, strict=True))
+
+        batched = []
+        if self.easyocr_batch > 1:
+            batched = [
+                m for m in members if m.endswith("easyocr") and cached.get(m) is None
+            ]
+        batch = asyncio.create_task(run_batch(batched)) if len(batched) > 1 else None
+
+        async def run_member(member):
+            transform, engine = member.split("_")
+            boxes = cached.get(member)
+
+            if boxes is None:
+                if batch and member in batched:
+                    boxes = (await batch)[member]
+                else:
+                    source = await get_image(transform)
+                    async with limit:
+                        boxes = await asyncio.to_thread(self.engines[engine], source)
+                if self.cache:
+                    self.cache.put(keys[member], boxes)
+
+            return boxes
+
+        boxes = await asyncio.gather(*(run_member(m) for m in members))
+        return dict(zip(members, boxes, strict=True))
+
+    def add_image_stats(self, nbytes: int) -> None:
+        self.image_stats["labels"] += 1
+        self.image_stats["bytes"] += nbytes
+        self.image_stats["max_bytes"] = max(self.image_stats["max_bytes"], nbytes)
+
+    def cache_keys(self, image, label_hash: str | None = None) -> dict[str, str]:
+        """
+        Get the OCR cache key for every member.
+
+        The key is built from the hash of the label's file and the settings that
+        decode it. Members that OCR the untransformed label get it in RGB. The
+        transforms always start from the label in grayscale, which decode() makes
+        the same whichever mode the label was decoded in. So selecting other
+        members does not change the keys of the members that stay. Without the
+        file's hash, the decoded image is hashed instead.
+        """
+        if not self.cache:
+            return {}
+        label_hash = label_hash or image_hash(image)
+        decoder = f"decode={label_reader.DECODE_VERSION} max_dim={self.max_dim}"
+        keys = {}
+        for member in self.members:
+            transform, engine = member.split("_")
+            config = ocr_runner.EngineConfig.signature(engine)
+            if transform == "none":
+                version = f"{decoder} mode=RGB"
+            else:
+                version = (
+                    f"{decoder} mode=L {lt.transform_version(f'{transform}_full')}"
+                )
+            keys[member] = self.cache.key(
+                label_hash, transform, engine, config, version
+            )
+        return keys
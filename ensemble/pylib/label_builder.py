@@ -1,11 +1,19 @@
 import collections
+import functools
+import itertools
 import unicodedata
 
+import numpy as np
 import regex as re
-from line_align.pylib.levenshtein import levenshtein_all
 
 MIN_LEN = 2
 
+SPLIT_CACHE_SIZE = 65_536  # Tokens
+MAX_WORD_LEN = 32  # The longest word add_spaces() looks for
+MIN_PIECE_LEN = 2  # The shortest word add_spaces() splits a token into
+MIN_PIECE_FREQ = 5  # How common a word must be for add_spaces() to split it off
+WORD_CACHE_SIZE = 262_144  # Tokens
+
 # When there is no clear "winner" for a character in the multiple alignment of
 # a set of strings I sort the characters by unicode category as a tiebreaker
 CATEGORY = {
@@ -77,19 +85,19 @@ SUBSTITUTIONS = [
 
 
 def filter_lines(lines: list[str], threshold=128) -> list[str]:
-    """Sort the lines by Levenshtein distance and filter out the outliers."""
+    """
+    Sort the lines by Levenshtein distance and filter out the outliers.
+
+    Only the pairs within the best distance + threshold matter, so this skips the
+    pairs that are sure to be farther apart and stops computing a distance once
+    it is over the cutoff. The lines are in the same order as when every pairwise
+    distance is sorted.
+    """
     if len(lines) <= MIN_LEN:
         return lines
 
-    # levenshtein_all() returns a sorted array of Distance named tuples/objects
-    distances = levenshtein_all(lines)
-
-    threshold += distances[0].dist  # Score cannot be more than best score + threshold
-
     order = {}  # Dicts preserve insertion order, sets do not
-    for score, i, j in distances:
-        if score > threshold:
-            break
+    for _, i, j in bounded_distances(lines, threshold):
         order[i] = 1
         order[j] = 1
 
@@ -97,6 +105,97 @@ def filter_lines(lines: list[str], threshold=128) -> list[str]:
     return ordered
 
 
+def bounded_distances(lines: list[str], threshold: int) -> list[tuple[int, int, int]]:
+    """
+    Get the sorted (distance, i, j) of the pairs within best distance + threshold.
+
+    The character counts give a lower bound for every pair's distance, the larger of
+    the characters one line has that the other one lacks and the other way round.
+    The best distance is found first, looking at the pairs with the lowest bounds.
+    Then only the pairs with a bound within the cutoff are computed.
+    """
+    counts = [collections.Counter(ln) for ln in lines]
+    pairs = []
+    for i, j in itertools.combinations(range(len(lines)), 2):
+        extra = sum((counts[i] - counts[j]).values())
+        missing = sum((counts[j] - counts[i]).values())
+        pairs.append((max(extra, missing), i, j))
+    pairs.sort()
+
+    exact = {}
+    best = max(len(ln) for ln in lines)  # No distance can be larger
+    for bound, i, j in pairs:
+        if bound >= best:
+            break
+        dist = levenshtein_within(lines[i], lines[j], best)
+        if dist <= best:
+            exact[i, j] = dist
+            best = dist
+
+    cutoff = best + threshold
+    distances = []
+    for bound, i, j in pairs:
+        if bound > cutoff:
+            break
+        dist = exact.get((i, j))
+        if dist is None:
+            dist = levenshtein_within(lines[i], lines[j], cutoff)
+        if dist <= cutoff:
+            distances.append((dist, i, j))
+
+    return sorted(distances)
+
+
+def levenshtein_within(line1: str, line2: str, cutoff: int) -> int:
+    """
+    Get the Levenshtein distance, or cutoff + 1 if it is more than the cutoff.
+
+    This is Myers' bit-vector algorithm, as described by Hyyrö, with one line
+    packed into the bits of a Python int. It updates a whole column of the dynamic
+    programming table at once with a few bit operations for every character of the
+    other line. The bottom row can only fall by one per character, so it stops as
+    soon as the distance cannot come back down to the cutoff.
+    """
+    if len(line1) < len(line2):
+        line1, line2 = line2, line1
+
+    if len(line1) - len(line2) > cutoff:
+        return cutoff + 1
+
+    if not line2:
+        return len(line1)
+
+    peq = {}  # The bits for where each character is in the shorter line
+    for i, char in enumerate(line2):
+        peq[char] = peq.get(char, 0) | (1 << i)
+
+    mask = (1 << len(line2)) - 1
+    high = 1 << (len(line2) - 1)
+    pv, mv = mask, 0  # Vertical +1 & -1 differences
+    dist = len(line2)
+    left = len(line1)
+
+    for char in line1:
+        eq = peq.get(char, 0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | ~(xh | pv)
+        mh = pv & xh
+        if ph & high:
+            dist += 1
+        elif mh & high:
+            dist -= 1
+        ph = (ph << 1) | 1
+        mh <<= 1
+        pv = (mh | ~(xv | ph)) & mask
+        mv = ph & xv
+        left -= 1
+        if dist - left > cutoff:
+            return cutoff + 1
+
+    return dist
+
+
 def _char_key(char):
     """Get the character sort order."""
     order = CATEGORY.get(unicodedata.category(char), 100)
@@ -104,28 +203,202 @@ def _char_key(char):
     return order, char
 
 
+@functools.cache
+def _char_order(code: int) -> int:
+    """Get the character sort order as one number, lower sorts first."""
+    order = _char_key(chr(code))[0]
+    return order * 0x110000 + code  # Ties are broken by the character itself
+
+
 def consensus(aligned: list[str]) -> str:
     """
     Build a consensus string from the aligned copies.
 
     Look at all characters of the multiple alignment and choose the most common one,
     using heuristics as a tiebreaker.
+
+    The aligned strings are encoded as a 2-D array of code points and all columns
+    are voted on at once. Ties are broken with the same sort order as _char_key().
+    """
+    width = len(aligned[0])
+    if width == 0:
+        return ""
+
+    codes = np.array(
+        [np.frombuffer(s.encode("utf-32-le"), dtype=np.uint32) for s in aligned]
+    )
+
+    # How many copies agree with each copy's character in every column
+    votes = (codes[:, None, :] == codes[None, :, :]).sum(axis=1)
+    top = votes == votes.max(axis=0)
+
+    uniq, inverse = np.unique(codes, return_inverse=True)
+    orders = np.array([_char_order(int(c)) for c in uniq], dtype=np.int64)
+    keys = np.where(top, orders[inverse.reshape(codes.shape)], np.iinfo(np.int64).max)
+
+    winners = codes[keys.argmin(axis=0), np.arange(width)]
+    return winners.astype("<u4").tobytes().decode("utf-32-le")
+
+
+def consensus_by_line(texts: list[str], align) -> str:
+    """
+    Build a consensus text one line at a time.
+
+    The lines of every text are matched up first and then each group of lines is
+    aligned and voted on by itself. Aligning many short lines is much faster than
+    aligning the whole texts at once and the alignment only needs memory for the
+    longest line. A line that fewer than half of the texts have is dropped, like a
+    column where most of the aligned texts have a gap.
+    """
+    quorum = (len(texts) + 1) // 2
+    consensus_lines = []
+    for group in match_lines(texts):
+        lines = [ln for ln in group if ln is not None]
+        if len(lines) < quorum:
+            continue
+        line = consensus(align(lines)) if len(lines) > 1 else lines[0]
+        consensus_lines.append(line)
+    return "\n".join(consensus_lines)
+
+
+def match_lines(
+    texts: list[str], max_diff: float = 0.5, window: int = 3
+) -> list[list[str | None]]:
+    """
+    Group the corresponding lines of the texts.
+
+    Each text's lines are matched, in order, to the groups found so far using their
+    edit distance to the group's first line. A line is only compared with groups at
+    about the same relative position in their texts, within the window of lines.
+    Lines that differ by more than the max_diff fraction of their length do not
+    match. A line with no match starts a new group where it is in the text. Every
+    group has a slot for every text and it is None when a text lacks that line.
+    """
+    groups: list[list[str | None]] = []
+    firsts: list[str] = []  # The first line in each group
+    places: list[float] = []  # Where that line is in its text, from 0 to 1
+
+    for t, text in enumerate(texts):
+        lines = text.splitlines()
+        reach = (window + 0.5) / max(1, len(lines))
+
+        sims = {}
+        for i, (first, place) in enumerate(zip(firsts, places, strict=True)):
+            for j, line in enumerate(lines):
+                if abs(place - j / len(lines)) > reach:
+                    continue
+                longest = max(len(first), len(line))
+                cutoff = int(longest * max_diff)
+                dist = levenshtein_within(first, line, cutoff)
+                if dist <= cutoff:
+                    sims[i, j] = 1.0 - dist / longest if longest else 1.0
+
+        merged, merged_firsts, merged_places = [], [], []
+        for i, j in match_pairs(len(groups), len(lines), sims):
+            if i is None:
+                group = [None] * len(texts)
+                merged_firsts.append(lines[j])
+                merged_places.append(j / len(lines))
+            else:
+                group = groups[i]
+                merged_firsts.append(firsts[i])
+                merged_places.append(places[i])
+            if j is not None:
+                group[t] = lines[j]
+            merged.append(group)
+        groups, firsts, places = merged, merged_firsts, merged_places
+
+    return groups
+
+
+def match_pairs(
+    rows: int, cols: int, sims: dict[tuple[int, int], float]
+) -> list[tuple[int | None, int | None]]:
+    """
+    Match two lists of lines without crossing matches.
+
+    This is a global alignment of the lines scored by the similarities of the line
+    pairs that may match. It returns pairs of line indexes in order, with None for
+    an unmatched line.
     """
-    cons = []
-    for i in range(len(aligned[0])):
-        counts = collections.Counter(s[i] for s in aligned).most_common()
-        top = counts[0][1]
-        chars = [c[0] for c in counts if c[1] == top]
-        chars = sorted(chars, key=_char_key)
-        cons.append(chars[0])
-    return "".join(cons)
+    score = [[0.0] * (cols + 1) for _ in range(rows + 1)]
+    for i in range(1, rows + 1):
+        above, row = score[i - 1], score[i]
+        for j in range(1, cols + 1):
+            row[j] = max(above[j], row[j - 1])
+            if (sim := sims.get((i - 1, j - 1))) is not None:
+                row[j] = max(row[j], above[j - 1] + sim)
+
+    pairs = []
+    i, j = rows, cols
+    while i or j:
+        sim = sims.get((i - 1, j - 1))
+        if i and j and sim is not None and score[i][j] == score[i - 1][j - 1] + sim:
+            i, j = i - 1, j - 1
+            pairs.append((i, j))
+        elif i and (not j or score[i][j] == score[i - 1][j]):
+            i -= 1
+            pairs.append((i, None))
+        else:
+            j -= 1
+            pairs.append((None, j))
+
+    return pairs[::-1]
+
+
+def compile_substitutions(rules: list[tuple[str, str]], *, one_line: bool = False):
+    """
+    Turn the substitution rules into steps that are run in order.
+
+    Runs of single character literal rules are fused into one str.translate()
+    table, other literal rules use str.replace(), and the rest are compiled regular
+    expressions. With one_line, whitespace in a pattern does not match a newline,
+    so every line of a text is handled as if it was substituted by itself.
+    """
+    steps = []
+    for old, new in rules:
+        literal = re.escape(old) == old and "\\" not in new
+        table = steps[-1][1] if steps and steps[-1][0] == "translate" else None
+        if literal and len(old) == 1 and table is not None and can_fuse(old, table):
+            table[ord(old)] = new
+        elif literal and len(old) == 1:
+            steps.append(("translate", {ord(old): new}))
+        elif literal:
+            steps.append(("replace", (old, new)))
+        else:
+            pattern = old.replace(r"\s", r"[^\S\n]") if one_line else old
+            steps.append(("sub", (re.compile(pattern), new)))
+    return steps
+
+
+def can_fuse(char: str, table: dict[int, str]) -> bool:
+    """Only fuse a rule if an earlier rule in the table cannot create its character."""
+    return all(char not in new for new in table.values())
+
+
+SUBSTITUTE_STEPS = compile_substitutions(SUBSTITUTIONS)
+SUBSTITUTE_LINE_STEPS = compile_substitutions(SUBSTITUTIONS, one_line=True)
+
+
+def run_substitutions(text: str, steps) -> str:
+    for kind, step in steps:
+        if kind == "translate":
+            text = text.translate(step)
+        elif kind == "replace":
+            text = text.replace(*step)
+        else:
+            text = step[0].sub(step[1], text)
+    return text
 
 
 def substitute(line: str) -> str:
     """Perform simple substitutions on a consensus string."""
-    for old, new in SUBSTITUTIONS:
-        line = re.sub(old, new, line)
-    return line
+    return run_substitutions(line, SUBSTITUTE_STEPS)
+
+
+def substitute_lines(text: str) -> str:
+    """Substitute every line of the text as if each one was done by itself."""
+    return run_substitutions(text, SUBSTITUTE_LINE_STEPS)
 
 
 def add_spaces(line, spell_well, vocab_len=3):
@@ -133,33 +406,64 @@ def add_spaces(line, spell_well, vocab_len=3):
     Add spaces between words.
 
     OCR engines will remove spaces between words. This function looks for a non-word
-    and sees if adding a space will create 2 (or 1) word.
+    and sees if adding spaces will split it into words.
     For example: "SouthFlorida" becomes "South Florida".
     """
     tokens = spell_well.tokenize(line)
+    return "".join(add_space_tokens(tokens, spell_well, vocab_len))
+
 
+def add_space_tokens(tokens: list[str], spell_well, vocab_len=3) -> list[str]:
     new = []
     for token in tokens:
-        if token.isspace() or spell_well.is_word(token) or len(token) < vocab_len:
+        if token.isspace() or len(token) < vocab_len or is_word(token, spell_well):
             new.append(token)
+        elif (split := split_token(token, spell_well)) != token:
+            new += spell_well.tokenize(split)
         else:
-            candidates = []
-            for i in range(1, len(token) - 1):
-                freq1 = spell_well.freq(token[:i])
-                freq2 = spell_well.freq(token[i:])
-                if freq1 or freq2:
-                    sum_ = freq1 + freq2
-                    count = int(freq1 > 0) + int(freq2 > 0)
-                    candidates.append((count, sum_, i))
-            if candidates:
-                i = sorted(candidates, reverse=True)[0][2]
-                new.append(token[:i])
-                new.append(" ")
-                new.append(token[i:])
-            else:
-                new.append(token)
+            new.append(token)
+    return new
 
-    return line
+
+@functools.lru_cache(maxsize=SPLIT_CACHE_SIZE)
+def split_token(token: str, spell_well) -> str:
+    """
+    Split a non-word into words.
+
+    The same garbled tokens turn up on label after label, so the splits are cached.
+    The split with the fewest words, and then the most common words, is found with
+    dynamic programming over the end of each word. Words are looked up for every
+    start within MAX_WORD_LEN characters of the end, so the work grows linearly
+    with the length of the token.
+
+    Only words of at least MIN_PIECE_LEN characters that are at least
+    MIN_PIECE_FREQ common are split off. Otherwise a taxon or a place name missing
+    from the vocabulary is easily shredded into short or rare words. A token that
+    cannot be split into such words only is left alone.
+    """
+    size = len(token)
+    best = [None] * (size + 1)  # (word count, -total frequency, previous end)
+    best[0] = (0, 0, 0)
+
+    for end in range(MIN_PIECE_LEN, size + 1):
+        for beg in range(max(0, end - MAX_WORD_LEN), end - MIN_PIECE_LEN + 1):
+            if best[beg] is None:
+                continue
+            if (freq := spell_well.freq(token[beg:end])) < MIN_PIECE_FREQ:
+                continue
+            score = (best[beg][0] + 1, best[beg][1] - freq, beg)
+            if best[end] is None or score[:2] < best[end][:2]:
+                best[end] = score
+
+    if best[size] is None:
+        return token
+
+    words, end = [], size
+    while end:
+        beg = best[end][2]
+        words.append(token[beg:end])
+        end = beg
+    return " ".join(reversed(words))
 
 
 def remove_spaces(line, spell_well):
@@ -171,9 +475,12 @@ def remove_spaces(line, spell_well):
     For example: "w est" becomes "west".
     """
     tokens = spell_well.tokenize(line)
+    return "".join(remove_space_tokens(tokens, spell_well))
 
+
+def remove_space_tokens(tokens: list[str], spell_well) -> list[str]:
     if len(tokens) <= MIN_LEN:
-        return line
+        return tokens
 
     new = tokens[:2]
 
@@ -184,8 +491,8 @@ def remove_spaces(line, spell_well):
 
         if (
             between.isspace()
-            and spell_well.is_word(prev + curr)
-            and not (spell_well.is_word(prev) or spell_well.is_word(curr))
+            and is_word(prev + curr, spell_well)
+            and not (is_word(prev, spell_well) or is_word(curr, spell_well))
         ):
             new.pop()  # Remove between
             new.pop()  # Remove prev
@@ -193,21 +500,64 @@ def remove_spaces(line, spell_well):
         else:
             new.append(tokens[i])
 
-    return "".join(new)
+    return new
 
 
 def spell_correct(line, spell_well):
+    return "".join(correct_tokens(spell_well.tokenize(line), spell_well))
+
+
+def correct_tokens(tokens: list[str], spell_well) -> list[str]:
     new = []
-    for token in spell_well.tokenize(line):
+    for token in tokens:
         if spell_well.is_letters(token):
-            token = spell_well.correct(token)
+            token = correct(token, spell_well)
         new.append(token)
-    return "".join(new)
+    return new
+
+
+@functools.lru_cache(maxsize=WORD_CACHE_SIZE)
+def is_word(token: str, spell_well) -> bool:
+    return spell_well.is_word(token)
+
+
+@functools.lru_cache(maxsize=WORD_CACHE_SIZE)
+def correct(token: str, spell_well) -> str:
+    """Spell check a token, the same taxa, places and people are on many labels."""
+    return spell_well.correct(token)
+
+
+# The functions with LRU caches of text processing results
+TEXT_CACHES = {
+    "Word split": split_token,
+    "Is word": is_word,
+    "Spell correct": correct,
+}
+
+
+def cache_stats() -> dict[str, dict]:
+    """Get the hits, misses, and evictions of the text caches in this process."""
+    stats = {}
+    for name, func in TEXT_CACHES.items():
+        info = func.cache_info()
+        stats[name] = {
+            "hits": info.hits,
+            "misses": info.misses,
+            "evictions": info.misses - info.currsize,  # cache_clear() resets all 3
+        }
+    return stats
 
 
 def post_process_text(text, spell_well):
+    """
+    Clean up the consensus text.
+
+    The text is tokenized once and the space fixes and spelling corrections are all
+    done on the same tokens. The spell checker results are cached for the run.
+    """
     text = substitute(text)
-    text = add_spaces(text, spell_well)
-    text = remove_spaces(text, spell_well)
-    text = spell_correct(text, spell_well)
-    return text
+    tokens = spell_well.tokenize(text)
+    tokens = add_space_tokens(tokens, spell_well)
+    tokens = remove_space_tokens(tokens, spell_well)
+    tokens = correct_tokens(tokens, spell_well)
+    return "".join(tokens)
@@ -0,0 +1,136 @@
+"""
+Stream label images to the OCR ensemble.
+
+Labels are found lazily, either by scanning a directory or by reading a list of
+paths, and are decoded in background threads a few labels ahead of the OCR. Only
+the labels waiting in the prefetch queue are held in memory.
+"""
+
+import itertools
+import os
+import sys
+import warnings
+from collections import deque
+from collections.abc import Iterable, Iterator
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+
+from PIL import Image
+from PIL.Image import Image as ImageType
+
+from ensemble.pylib import stage_stats
+
+# Turn off PIL's EXIF warnings once for the process. Changing the warning filters
+# while decoding, with catch_warnings(), is not safe in the decode threads.
+warnings.filterwarnings("ignore", category=UserWarning, module="PIL")
+
+# Bump this whenever a change to decode() changes the decoded images, so OCR
+# results cached for the old images are not used
+DECODE_VERSION = 4  # Decoding in RGB or L and then converting to the mode
+
+IMAGE_EXTENSIONS = {
+    ".bmp",
+    ".gif",
+    ".jp2",
+    ".jpeg",
+    ".jpg",
+    ".png",
+    ".tif",
+    ".tiff",
+    ".webp",
+}
+
+
+def is_image(path: Path) -> bool:
+    return path.suffix.lower() in IMAGE_EXTENSIONS
+
+
+def scan_dir(label_dir: Path, chunk: int = 0) -> Iterator[Path]:
+    """
+    Find the label images in a directory.
+
+    With a chunk size the directory is read that many entries at a time and each
+    chunk is sorted, so a huge directory never has to be listed in full before the
+    first label is OCRed. A chunk of 0 sorts the whole directory.
+    """
+    with os.scandir(label_dir) as entries:
+        paths = (Path(e) for e in entries if e.is_file() and is_image(Path(e.name)))
+        if not chunk:
+            yield from sorted(paths)
+            return
+        while batch := list(itertools.islice(paths, chunk)):
+            yield from sorted(batch)
+
+
+def read_list(list_path: Path) -> Iterator[Path]:
+    """Read label paths, one per line, from a file or from stdin for "-"."""
+    if str(list_path) == "-":
+        yield from parse_list(sys.stdin)
+        return
+    with list_path.open() as f:
+        yield from parse_list(f)
+
+
+def parse_list(lines: Iterable[str]) -> Iterator[Path]:
+    for ln in lines:
+        if ln := ln.strip():
+            yield Path(ln)
+
+
+def label_paths(
+    label_dir: Path | None = None, label_list: Path | None = None, chunk: int = 0
+) -> Iterator[Path]:
+    """Get the label images from a directory and/or a list of paths."""
+    if label_dir:
+        yield from scan_dir(label_dir, chunk)
+    if label_list:
+        yield from (p for p in read_list(label_list) if is_image(p))
+
+
+@stage_stats.timed("decode")
+def decode(path: Path, mode: str = "RGB", max_dim: int = 0) -> ImageType:
+    """
+    Decode the label into the color mode the ensemble works in.
+
+    With a max_dim, labels that are at least twice as large are reduced by an
+    integer factor while decoding, down to no less than max_dim on the longest
+    side. JPEGs skip the discarded detail entirely with draft().
+
+    A label is decoded and reduced in RGB, or in L when it is grayscale, and only
+    then converted to the mode. So a label decoded in L has the same pixels as
+    the label decoded in RGB and then converted to L, like the image transforms
+    do. The transformed images do not depend on the mode the ensemble needs.
+    """
+    with Image.open(path) as image:
+        width, height = image.size
+        factor = max(width, height) // max_dim if max_dim else 1
+        base = "L" if image.mode in ("L", "1") else "RGB"
+        image.draft(base, (width // max(1, factor), height // max(1, factor)))
+        image.load()
+        if image.mode != base:  # Palette and 1-bit images cannot be reduced
+            image = image.convert(base)
+        if factor > 1 and image.size == (width, height):
+            image = image.reduce(factor)  # Only JPEGs can be drafted smaller
+        return image if image.mode == mode else image.convert(mode)
+
+
+def prefetch(
+    paths: Iterable[Path], threads: int = 2, depth: int = 4, **kwargs
+) -> Iterator[tuple[Path, Future]]:
+    """
+    Decode labels in background threads ahead of when they are needed.
+
+    At most depth labels are queued or decoded at a time. The labels are returned
+    in path order with a future holding the image or the decoding error. The
+    keyword arguments are passed to decode().
+    """
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        queue = deque()
+        paths = iter(paths)
+        for path in itertools.islice(paths, max(1, depth)):
+            queue.append((path, pool.submit(decode, path, **kwargs)))
+
+        while queue:
+            yield queue.popleft()
+            for path in itertools.islice(paths, 1):
+                queue.append((path, pool.submit(decode, path, **kwargs)))
@@ -1,37 +1,41 @@
 """Image transforms performed on labels before OCR."""
+
 import functools
 import re
+import threading
+import time
+from dataclasses import dataclass
 
 import numpy as np
-import pytesseract
 from numpy import typing as npt
 from PIL import Image
 from PIL.Image import Image as ImageType
-from pytesseract.pytesseract import TesseractError
 from scipy import ndimage
-from scipy.ndimage import interpolation as interp
 from skimage import filters
 from skimage import morphology as morph
 
+from ensemble.pylib import stage_stats, tesseract_api
+
 CHANNELS = 3
 PIX_MAX = 255.0
 NO_ANGLE = 0.0
 
 
 def image_to_array(image):
-    image = image.convert("L")
+    """Get the label as a uint8 grayscale array, converting it only if needed."""
+    if image.mode != "L":
+        image = image.convert("L")
     return np.asarray(image)
 
 
 def array_to_image(image: npt.NDArray) -> ImageType:
-    if hasattr(image, "dtype") and image.dtype == "float64":
-        mode: str | None = "L" if len(image.shape) < CHANNELS else "RGB"
-        return Image.fromarray(image * 255.0, mode)
-    if hasattr(image, "dtype") and image.dtype == "bool":
-        image = (image * 255).astype("uint8")
-        mode = "L" if len(image.shape) < PIX_MAX else "RGB"
-        return Image.fromarray(image, mode)
-    return Image.fromarray(image, "L")
+    """Convert the array to a uint8 image without any int64 or float64 temporaries."""
+    if image.dtype == np.bool_:
+        image = image.view(np.uint8) * np.uint8(PIX_MAX)
+    elif image.dtype != np.uint8:
+        image = np.clip(image * np.float32(PIX_MAX), 0, PIX_MAX).astype(np.uint8)
+    mode = "L" if len(image.shape) < CHANNELS else "RGB"
+    return Image.fromarray(image, mode)
 
 
 def scale(
@@ -49,23 +53,33 @@ def blur(image: npt.NDArray, sigma: float = 1.0) -> npt.NDArray:
     return ndimage.gaussian_filter(image, sigma)
 
 
+@stage_stats.timed("orient")
 def orient(
     image: npt.NDArray,
     conf_low: float = 15.0,
     conf_high: float = 100.0,
 ) -> npt.NDArray:
-    try:
-        osd = pytesseract.image_to_osd(image)
-    except TesseractError:
-        return image
+    if tesseract_api.USE_TESSEROCR:
+        osd = tesseract_api.image_to_osd(image)
+        if osd is None:
+            return image
+        angle, conf = osd
+
+    else:
+        import pytesseract  # noqa: PLC0415 Only the pytesseract backend needs it
 
-    angle = 0
-    if match := re.search(r"Rotate: (\d+)", osd):
-        angle = int(match.group(1))
+        try:
+            osd = pytesseract.image_to_osd(image)
+        except pytesseract.TesseractError:
+            return image
 
-    conf = 0.0
-    if match := re.search(r"Orientation confidence: ([\d.]+)", osd):
-        conf = float(match.group(1))
+        angle = 0
+        if match := re.search(r"Rotate: (\d+)", osd):
+            angle = int(match.group(1))
+
+        conf = 0.0
+        if match := re.search(r"Orientation confidence: ([\d.]+)", osd):
+            conf = float(match.group(1))
 
     if angle != 0 and conf_low <= conf <= conf_high:
         image = ndimage.rotate(image, angle, mode="nearest")
@@ -73,28 +87,84 @@ def orient(
     return image
 
 
-def deskew(image: npt.NDArray, horiz_angles: npt.NDArray | None = None) -> npt.NDArray:
+@dataclass
+class Skew:
+    angle: float  # Rotate the label by this many degrees to straighten it
+    confidence: float  # How much the best angle stands out from the others, 0-1
+
+
+def find_skew(
+    image: npt.NDArray,
+    angle_range: float = 2.0,
+    resolution: float = 0.1,
+    coarse_step: float = 0.5,
+    max_dim: int = 1024,
+) -> Skew:
     """
-    Find the skew of the label.
+    Find the skew of the label from the projection profiles of its dark pixels.
+
+    Rotating the whole label for every candidate angle is slow. Instead, the label
+    is downsampled and binarized, and the coordinates of the dark pixels are
+    projected onto the rows of each candidate angle. Each angle then only costs a
+    bincount. The angles are searched coarse to fine: every coarse_step degrees
+    within +/- angle_range, then down to the resolution around the best one.
 
-    This method is looking for sharp breaks between the characters and spaces.
-    It will work best with binary images.
+    Like the original search that rotated the label, the best angle has the
+    sharpest breaks between the lines of text and the spaces between them.
     """
-    if not horiz_angles:
-        horiz_angles = np.array([0.0, 0.5, -0.5, 1.0, -1.0, 1.5, -1.5, 2.0, -2.0])
-
-    label = np.array(image).astype(np.int8)
-    scores = []
-    for angle in horiz_angles:
-        rotated = interp.rotate(label, angle, reshape=False, order=0)
-        proj = np.sum(rotated, axis=1)
-        score = np.sum((proj[1:] - proj[:-1]) ** 2)
-        scores.append(score)
-    best = max(scores)
-    angle = horiz_angles[scores.index(best)]
-
-    if angle != NO_ANGLE:
-        image = ndimage.rotate(image, angle, mode="nearest")
+    label = np.asarray(image)
+    if label.ndim == CHANNELS:
+        label = label.mean(axis=2)
+
+    step = max(1, -(-max(label.shape) // max_dim))
+    label = label[::step, ::step]
+
+    if label.dtype == bool:
+        dark = ~label
+    elif np.ptp(label) == 0:
+        return Skew(NO_ANGLE, 0.0)
+    else:
+        dark = label < filters.threshold_otsu(label)
+
+    ys, xs = np.nonzero(dark)
+    if ys.size == 0:
+        return Skew(NO_ANGLE, 0.0)
+
+    def score(angle: float) -> float:
+        theta = np.deg2rad(angle)
+        rows = np.rint(ys * np.cos(theta) - xs * np.sin(theta)).astype(np.intp)
+        proj = np.bincount(rows - rows.min()).astype(np.int64)
+        return float(np.sum(np.diff(proj) ** 2))
+
+    # Search the smallest angles first so that ties go to the smaller rotation
+    coarse = np.arange(-angle_range, angle_range + coarse_step / 2, coarse_step)
+    coarse = sorted(coarse, key=abs)
+    coarse_scores = [score(a) for a in coarse]
+    best = coarse[int(np.argmax(coarse_scores))]
+
+    low, high = best - coarse_step, best + coarse_step
+    fine = np.arange(low, high + resolution / 2, resolution)
+    fine = sorted((a for a in fine if abs(a) <= angle_range + 1e-9), key=abs)
+    fine_scores = [score(a) for a in fine]
+    top = max(fine_scores)
+    angle = round(float(fine[fine_scores.index(top)]), 6) + 0.0  # No -0.0
+
+    median = float(np.median(coarse_scores))
+    confidence = (top - median) / top if top > 0.0 else 0.0
+
+    return Skew(angle=angle, confidence=confidence)
+
+
+def deskew(
+    image: npt.NDArray,
+    angle_range: float = 2.0,
+    resolution: float = 0.1,
+) -> npt.NDArray:
+    """Straighten the label using the skew found by find_skew()."""
+    skew = find_skew(image, angle_range=angle_range, resolution=resolution)
+
+    if skew.angle != NO_ANGLE:
+        image = ndimage.rotate(image, skew.angle, mode="nearest")
 
     return image
 
@@ -177,3 +247,93 @@ TRANSFORM_PIPELINES = {
 def transform_label(pipeline: str, image):
     """Transform the label to improve OCR results."""
     return TRANSFORM_PIPELINES[pipeline](image)
+
+
+# The transforms as a DAG: each stage is built from its parent stage. Every
+# variant of a label shares the expensive TRANSFORM_START prefix.
+TRANSFORM_STAGES = {
+    "deskew": ("none", TRANSFORM_START),
+    "binarize": ("deskew", binarize_sauvola),
+    "denoise": ("binarize", compose(remove_small_holes, binary_opening)),
+    "deskew_full": ("deskew", array_to_image),
+    "binarize_full": ("binarize", array_to_image),
+    "denoise_full": ("denoise", array_to_image),
+}
+
+# Bump a stage's version whenever a change to it changes its output, so OCR
+# results cached for the old output are not used. A variant's version includes the
+# versions of the stages it is built from.
+STAGE_VERSIONS = {
+    "none": 1,
+    "deskew": 3,  # The projection profile skew search, with a cubic rotation
+    "binarize": 1,
+    "denoise": 1,
+    "deskew_full": 1,
+    "binarize_full": 1,
+    "denoise_full": 1,
+}
+
+
+class LabelTransforms:
+    """
+    Build transformed variants of one label, computing each stage only once.
+
+    Stages are memoized, so asking for "binarize_full" and then "denoise_full"
+    reuses the deskewed and binarized images. It is safe to ask for variants from
+    several threads. Each stage is timed without its parents, except that the
+    deskew stage includes orient.
+    """
+
+    def __init__(self, image):
+        self.stages = {"none": image}
+        self.seconds = {"none": 0.0}  # How long each stage took to build
+        self.lock = threading.RLock()
+
+    def __getitem__(self, name: str):
+        with self.lock:
+            if name not in self.stages:
+                parent, func = TRANSFORM_STAGES[name]
+                image = self[parent]
+                start = time.perf_counter()
+                with stage_stats.timer(f"transform {name}"):
+                    self.stages[name] = func(image)
+                self.seconds[name] = time.perf_counter() - start
+            return self.stages[name]
+
+    @property
+    def nbytes(self) -> int:
+        """Get the memory used by the label and every stage built from it."""
+        with self.lock:
+            return sum(image_bytes(image) for image in self.stages.values())
+
+
+def image_bytes(image) -> int:
+    if isinstance(image, ImageType):
+        return image.width * image.height * len(image.getbands())
+    return image.nbytes
+
+
+def transform_cost(seconds: dict[str, float], names) -> float:
+    """Add up the stage times for building the variants, counting each stage once."""
+    needed = set()
+    for name in names:
+        while name != "none":
+            needed.add(name)
+            name = TRANSFORM_STAGES[name][0]
+    return sum(seconds.get(n, 0.0) for n in needed)  # Failed stages have no time
+
+
+def transform_version(name: str) -> str:
+    """Get the version of a variant and every stage it is built from."""
+    versions = []
+    while name != "none":
+        versions.append(f"{name}={STAGE_VERSIONS[name]}")
+        name = TRANSFORM_STAGES[name][0]
+    versions.append(f"none={STAGE_VERSIONS['none']}")
+    return " ".join(reversed(versions))
+
+
+def transform_variants(image, names: set[str]) -> dict:
+    """Transform the label into all of the requested variants."""
+    transforms = LabelTransforms(image)
+    return {name: transforms[name] for name in names}
@@ -0,0 +1,108 @@
+"""Track which labels have been OCRed so that interrupted runs can resume."""
+
+import hashlib
+import json
+import logging
+import threading
+from collections.abc import Iterable, Iterator
+from pathlib import Path
+
+MANIFEST_NAME = "ocr_manifest.jsonl"
+
+
+def file_hash(path: Path) -> str:
+    with path.open("rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+class Manifest:
+    """
+    A record of every label that was OCRed into a text directory.
+
+    Each line of the manifest holds the label's file name, content hash, size,
+    mtime, and the ensemble pipeline used to OCR it. Lines are only appended, after
+    the label's text file is written, and the last line for a label wins. A line
+    cut off by a crash is ignored, so that label is simply redone.
+    """
+
+    def __init__(self, text_dir: Path, pipeline: str):
+        self.path = text_dir / MANIFEST_NAME
+        self.pipeline = pipeline
+        self.entries: dict[str, dict] = {}
+        self.lock = threading.Lock()  # Labels may be checked in another thread
+        self.load()
+
+    def load(self) -> None:
+        if not self.path.exists():
+            return
+
+        count = 0
+        with self.path.open() as f:
+            for ln in f:
+                count += 1
+                try:
+                    entry = json.loads(ln)
+                except json.JSONDecodeError:
+                    continue
+                self.entries[entry["name"]] = entry
+
+        if count > 2 * len(self.entries):
+            self.compact()
+
+    def compact(self) -> None:
+        """Rewrite the manifest with only the latest line for each label."""
+        temp = self.path.with_name(f".{self.path.name}.tmp")
+        with temp.open("w") as f:
+            for entry in self.entries.values():
+                f.write(json.dumps(entry) + "\n")
+        temp.replace(self.path)
+
+    def is_done(self, path: Path, sink) -> bool:
+        """
+        Check if a label is unchanged since it was last OCRed with this pipeline.
+
+        Its text must also still be in the output sink. A matching size and mtime
+        is enough. If only the mtime changed, the label is hashed to see if its
+        contents did. The image is never decoded.
+        """
+        entry = self.entries.get(path.name)
+        if not entry or entry["pipeline"] != self.pipeline or not sink.has(path):
+            return False
+
+        stat = path.stat()
+        if stat.st_size != entry["size"]:
+            return False
+        if stat.st_mtime_ns == entry["mtime"]:
+            return True
+
+        if file_hash(path) != entry["hash"]:
+            return False
+
+        self.add(path)  # Remember the new mtime
+        return True
+
+    def add(self, path: Path) -> None:
+        stat = path.stat()
+        entry = {
+            "name": path.name,
+            "hash": file_hash(path),
+            "size": stat.st_size,
+            "mtime": stat.st_mtime_ns,
+            "pipeline": self.pipeline,
+        }
+        with self.lock:
+            self.entries[path.name] = entry
+            with self.path.open("a") as f:
+                f.write(json.dumps(entry) + "\n")
+
+    def remaining(self, paths: Iterable[Path], sink) -> Iterator[Path]:
+        """Filter out labels that do not need to be OCRed again, as they are read."""
+        count = skipped = 0
+        for path in paths:
+            count += 1
+            if self.is_done(path, sink):
+                skipped += 1
+            else:
+                yield path
+        msg = f"Skipped {skipped} of {count} unchanged labels"
+        logging.info(msg)
@@ -0,0 +1,132 @@
+"""An on-disk cache of the raw OCR boxes returned by each engine."""
+
+import hashlib
+import json
+import logging
+import sqlite3
+import time
+from pathlib import Path
+
+from PIL.Image import Image as ImageType
+
+from ensemble.pylib.ocr_runner import Boxes
+
+MB = 1024 * 1024
+
+
+def image_hash(image: ImageType) -> str:
+    digest = hashlib.sha256(f"{image.mode}{image.size}".encode())
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+
+class OcrCache:
+    """
+    Cache OCR engine results keyed by the label + image transform + engine config.
+
+    The key includes the versions of the decoder and of the image transform, so
+    results cached before either of them changed are not used.
+
+    The cache is a SQLite database so several worker processes can share it. When
+    the stored boxes grow past the size cap the least recently used entries are
+    evicted.
+    """
+
+    def __init__(self, path: Path, max_mb: int = 1024):
+        self.path = path
+        self.max_bytes = max_mb * MB
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.cxn = sqlite3.connect(path, timeout=60)
+        self.cxn.execute("PRAGMA journal_mode = WAL")
+        self.cxn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS boxes (
+                key   TEXT PRIMARY KEY,
+                boxes TEXT,
+                bytes INTEGER,
+                used  REAL
+            )
+            """
+        )
+        self.cxn.execute("CREATE INDEX IF NOT EXISTS boxes_used ON boxes (used)")
+        self.cxn.commit()
+        self.total = self.stored_bytes()
+
+    @staticmethod
+    def key(
+        label_hash: str, transform: str, engine: str, config: str, version: str = ""
+    ) -> str:
+        """
+        Build the key for an engine's result.
+
+        The version is the version of the decoder and of the image transform. It
+        changes whenever they return different images for the same label.
+        """
+        raw = f"{label_hash}\t{transform}\t{engine}\t{config}\t{version}"
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    @property
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+    def get(self, key: str) -> Boxes | None:
+        row = self.cxn.execute(
+            "SELECT boxes FROM boxes WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.cxn.execute("UPDATE boxes SET used = ? WHERE key = ?", (time.time(), key))
+        self.cxn.commit()
+        return Boxes.from_dict(json.loads(row[0]))
+
+    def put(self, key: str, boxes: Boxes) -> None:
+        data = json.dumps(boxes.to_dict())
+        self.cxn.execute(
+            "INSERT OR REPLACE INTO boxes (key, boxes, bytes, used) VALUES (?,?,?,?)",
+            (key, data, len(data), time.time()),
+        )
+        self.cxn.commit()
+        self.total += len(data)
+        if self.total > self.max_bytes:
+            self.evict()
+
+    def stored_bytes(self) -> int:
+        return int(self.cxn.execute("SELECT TOTAL(bytes) FROM boxes").fetchone()[0])
+
+    def evict(self) -> None:
+        """Remove the least recently used entries until the cache is under its cap."""
+        self.total = self.stored_bytes()  # Other processes may have changed it
+        excess = self.total - self.max_bytes
+        if excess <= 0:
+            return
+
+        removed, freed = [], 0
+        for key, size in self.cxn.execute("SELECT key, bytes FROM boxes ORDER BY used"):
+            if freed >= excess:
+                break
+            removed.append((key,))
+            freed += size
+
+        self.cxn.executemany("DELETE FROM boxes WHERE key = ?", removed)
+        self.cxn.commit()
+        self.total -= freed
+        self.evictions += len(removed)
+
+
+def log_stats(stats: list[dict], name: str = "OCR") -> None:
+    """Log the combined cache stats from every process."""
+    hits = sum(s["hits"] for s in stats)
+    misses = sum(s["misses"] for s in stats)
+    evictions = sum(s["evictions"] for s in stats)
+    rate = hits / (hits + misses) if hits + misses else 0.0
+    msg = (
+        f"{name} cache: {hits} hits, {misses} misses ({rate:.1%} hit rate), "
+        f"{evictions} evictions"
+    )
+    logging.info(msg)
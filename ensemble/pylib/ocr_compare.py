@@ -1,168 +1,402 @@
-# import json
-# import warnings
-# from copy import copy
-# from itertools import chain, combinations
-# from multiprocessing import Pool
-#
-# import pandas as pd
-# from PIL import Image
-# from tqdm import tqdm
-# from spell.pylib.spell_well import SpellWell
-#
-# from ensemble.pylib import label_builder, ocr_runner, label_transformer
-# from line_align import char_sub_matrix as subs
-# from line_align.align import LineAlign
-#
-# IMAGE_TRANSFORMS = ["", "deskew_full", "binarize_full", "denoise_full"]
-#
-#
-# def ocr(gold_std):
-#     golden = []
-#     for gold in tqdm(gold_std, desc="ocr"):
-#         gold["gold_text"] = " ".join(gold["gold_text"].split())
-#         gold["pipe_text"] = {}
-#
-#         original = get_label(gold)
-#         for transform in IMAGE_TRANSFORMS:
-#             image = transform_image(original, transform)
-#
-#             text = ocr_runner.easy_text(image)
-#             gold["pipe_text"][f"[{transform}, easyocr]"] = " ".join(text.split())
-#
-#             text = ocr_runner.tess_text(image)
-#             gold["pipe_text"][f"[{transform}, tesseract]"] = " ".join(text.split())
-#
-#         golden.append(gold)
-#     return golden
-#
-#
-# def score(golden, score_set, gold_set, processes=8, chunk=10):
-#     batches = [golden[i : i + chunk] for i in range(0, len(golden), chunk)]
-#     scores, results = [], []
-#
-#     with Pool(processes=processes) as pool, tqdm(total=len(batches)) as bar:
-#         for batch in batches:
-#             results.append(
-#                 pool.apply_async(
-#                     score_batch,
-#                     args=(batch, score_set, gold_set),
-#                     callback=lambda _: bar.update(),
-#                 )
-#             )
-#         scores = [r.get() for r in results]
-#         scores = list(chain(*list(scores)))
-#
-#     return scores
-#
-#
-# def score_batch(golden, score_set, gold_set) -> list[dict]:
-#     scores: list[dict] = []
-#     pipelines = get_pipelines(golden[0])
-#
-#     matrix = subs.select_char_sub_matrix(char_set="default")
-#     aligner = LineAlign(matrix)
-#     spell_well = SpellWell()
-#
-#     for gold in golden:
-#         for pipes in pipelines:
-#             pipeline = copy(pipes)
-#
-#             lines = [gold["pipe_text"][p] for p in pipeline]
-#             lines = label_builder.filter_lines(lines)
-#
-#             aligned = aligner.align(lines)
-#
-#             # Pipeline without post-processing
-#             text = label_builder.consensus(aligned)
-#             scores.append(
-#                 score_rec(gold, text, pipeline, score_set, gold_set, aligner)
-#             )
-#
-#             # Pipeline with post-processing
-#             text = label_builder.post_process_text(text, spell_well)
-#             pipeline.append("[post_process]")
-#             scores.append(
-#                 score_rec(gold, text, pipeline, score_set, gold_set, aligner)
-#             )
-#
-#     return scores
-#
-#
-# def insert_scores(scores, database, score_set):
-#     with db.connect(database) as cxn:
-#         db.canned_delete(cxn, "ocr_scores", score_set=score_set)
-#         db.canned_insert(cxn, "ocr_scores", scores)
-#
-#
-# def select_scores(database, score_set):
-#     with db.connect(database) as cxn:
-#         results = db.canned_select(cxn, "ocr_scores", score_set=score_set)
-#         scores = [dict(r) for r in results]
-#     return scores
-#
-#
-# def score_rec(gold, text, pipeline, score_set, gold_set, aligner):
-#     text = text.replace("⋄", "")  # Remove gaps
-#     return {
-#         "score_set": score_set,
-#         "label_id": gold["label_id"],
-#         "gold_id": gold["gold_id"],
-#         "gold_set": gold_set,
-#         "pipeline": json.dumps(pipeline),
-#         "score_text": text,
-#         "score": aligner.levenshtein(gold["gold_text"], text),
-#     }
-#
-#
-# def get_pipelines(gold) -> list[list[str]]:
-#     pipelines = []
-#     keys = sorted(gold["pipe_text"].keys())
-#     for r in range(1, len(keys) + 1):
-#         pipelines += [list(c) for c in combinations(keys, r)]
-#     return pipelines
-#
-#
-# def get_label(gold: dict):
-#     with warnings.catch_warnings():  # Turn off EXIF warnings
-#         warnings.filterwarnings("ignore", category=UserWarning)
-#         path = const.ROOT_DIR / gold["path"]
-#         sheet = Image.open(path)
-#         label = sheet.crop(
-#             (
-#                 gold["label_left"],
-#                 gold["label_top"],
-#                 gold["label_right"],
-#                 gold["label_bottom"],
-#             )
-#         )
-#     return label
-#
-#
-# def transform_image(image, transform):
-#     if not transform:
-#         return image
-#     return label_transformer.transform_label(transform, image)
-#
-#
-# # ##################################################################################
-# def select_gold_std(database, gold_set):
-#     with db.connect(database) as cxn:
-#         gold = db.canned_select(cxn, "gold_standard", gold_set=gold_set)
-#     return gold
-#
-#
-# def insert_gold_std(csv_path, database, gold_set):
-#     df = pd.read_csv(csv_path).fillna("")
-#     df = df.loc[df.gold_text != ""]
-#
-#     df["label_id"] = df["label"].str.split("_").str[2]
-#     df["label_id"] = df["label_id"].str.split(".").str[0].astype(int)
-#
-#     df["sheet_id"] = df["label"].str.split("_").str[1]
-#
-#     df["gold_set"] = gold_set
-#
-#     df = df.drop(["sheet", "label"], axis="columns")
-#
-#     with db.connect(database) as cxn:
-#         df.to_sql("gold_standard", cxn, if_exists="append", index=False)
+"""
+Score every combination of ensemble members against gold standard label text.
+
+Each gold standard label is OCRed once by every member and the engine and
+transform times are kept. Then every combination of the members, with and
+without post-processing, is scored against the gold text in a pool of worker
+processes. Each worker builds its aligner and spell checker once. The members'
+pairwise distances are computed once per label and combinations that keep the
+same texts share their alignment. The result is the accuracy and the cost of
+every combination, so the cheapest ensemble that is accurate enough can be
+picked.
+"""
+
+import argparse
+import collections
+import csv
+import itertools
+import json
+import logging
+import multiprocessing
+import signal
+import time
+from contextlib import nullcontext
+from pathlib import Path
+
+from line_align.pylib import char_sub_matrix
+from line_align.pylib.align import LineAlign
+from PIL import Image
+from spell_well.pylib.spell_well import SpellWell
+from tqdm import tqdm
+
+from ensemble.pylib import label_builder, label_reader, ocr_runner, tesseract_api
+from ensemble.pylib import label_transformer as lt
+from ensemble.pylib.ensemble import Ensemble
+
+CROP = ("label_left", "label_top", "label_right", "label_bottom")
+
+MEMBERS = [m for m in Ensemble.all_pipes if m.endswith(tuple(Ensemble.engines))]
+
+# Each scoring worker builds these once in init_score_worker()
+WORKER: dict = {}
+
+
+def ocr_compare(args: argparse.Namespace) -> None:
+    golds = read_gold(args.gold_csv)
+    results = ocr_golds(args, golds)
+    golds = [g for g in golds if g["label"] in results]
+
+    combos = member_combos(args.members)
+    distances = score_golds(args, golds, results, combos)
+
+    rows = summarize(args, golds, results, combos, distances)
+    write_rows(args.output, rows)
+    log_best(rows, args.target)
+
+
+def read_gold(csv_path: Path) -> list[dict]:
+    """
+    Read the gold standard labels.
+
+    The CSV needs a "label" column with the label's image file, relative to the
+    CSV, and a "gold_text" column. When the image is a whole herbarium sheet the
+    label_left, label_top, label_right, and label_bottom columns crop the label
+    out of it. Rows without gold text are skipped.
+    """
+    with csv_path.open() as f:
+        rows = list(csv.DictReader(f))
+
+    golds = []
+    for row in rows:
+        if not (row.get("gold_text") or "").strip():
+            continue
+        gold = {"label": row["label"], "gold_text": row["gold_text"]}
+        gold["path"] = csv_path.parent / row["label"]
+        if all((row.get(c) or "").strip() for c in CROP):
+            gold["crop"] = tuple(int(float(row[c])) for c in CROP)
+        golds.append(gold)
+    return golds
+
+
+def ocr_golds(args: argparse.Namespace, golds: list[dict]) -> dict[str, dict]:
+    """
+    OCR every gold standard label with every member.
+
+    With --ocr-results the results are appended to a JSONL file as they finish.
+    Labels that are already in it, for all of the members, are not OCRed again.
+    """
+    results = read_results(args.ocr_results, args.members)
+    todo = [g for g in golds if g["label"] not in results]
+    jobs = [(g, args.members, args.pre_process) for g in todo]
+
+    if jobs:
+        ocr_jobs(args, jobs, results)
+
+    failed = collections.Counter(
+        m for r in results.values() for m in r.get("failed", [])
+    )
+    for member, count in failed.items():
+        msg = f"{member} failed on {count} labels, they are scored as empty"
+        logging.warning(msg)
+
+    return results
+
+
+def ocr_jobs(args: argparse.Namespace, jobs: list[tuple], results: dict) -> None:
+    """OCR the labels that are not in the results yet in a pool of workers."""
+    context = multiprocessing.get_context("spawn")
+    with (
+        context.Pool(
+            processes=args.workers, initializer=init_ocr_worker, initargs=(vars(args),)
+        ) as pool,
+        args.ocr_results.open("a") if args.ocr_results else nullcontext() as out,
+    ):
+        for result in tqdm(pool.imap(ocr_gold, jobs), total=len(jobs), desc="ocr"):
+            if result is None:
+                continue
+            results[result["label"]] = result
+            if out:
+                out.write(json.dumps(result, ensure_ascii=False) + "\n")
+                out.flush()
+
+
+def read_results(path: Path | None, members: list[str]) -> dict[str, dict]:
+    results = {}
+    if not path or not path.exists():
+        return results
+    with path.open() as f:
+        for ln in f:
+            try:
+                result = json.loads(ln)
+            except json.JSONDecodeError:
+                continue  # A line cut off by a crash
+            if all(m in result["texts"] for m in members):
+                results[result["label"]] = result
+    return results
+
+
+def init_ocr_worker(kwargs: dict) -> None:
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # The parent handles Ctrl-C
+    ocr_runner.EngineConfig.device = kwargs.get("device") or "cpu"
+    tesseract_api.set_backend(kwargs.get("tesseract_backend") or "auto")
+
+    # Load the engines now so that loading them is not counted as a member's cost
+    members = kwargs.get("members") or []
+    if any(m.endswith("tesseract") for m in members):
+        ocr_runner.tesseract_engine(Image.new("L", (32, 32), color=255))
+    if any(m.endswith("easyocr") for m in members):
+        ocr_runner.get_easyocr(ocr_runner.EngineConfig.device)
+
+
+def ocr_gold(job: tuple[dict, list[str], bool]) -> dict | None:
+    """
+    OCR the label with each member and time the engines and the transforms.
+
+    A member that fails is logged and its text is left empty, so it is scored as
+    reading nothing instead of stopping the run.
+    """
+    gold, members, pre_process = job
+    try:
+        image = label_reader.decode(gold["path"])
+    except OSError as err:
+        msg = f"Could not read {gold['label']}: {err}"
+        logging.error(msg)  # noqa: TRY400
+        return None
+    if "crop" in gold:
+        image = image.crop(gold["crop"])
+
+    transforms = lt.LabelTransforms(image)
+    texts, seconds, failed = {}, {}, []
+    for member in members:
+        transform, engine = member.split("_")
+        seconds[member] = 0.0  # The engine does not run when the transform fails
+        try:
+            source = image if transform == "none" else transforms[f"{transform}_full"]
+            start = time.perf_counter()
+            try:
+                boxes = Ensemble.engines[engine](source)
+            finally:
+                seconds[member] = time.perf_counter() - start
+            texts[member] = ocr_runner.build_text(boxes, pre_process=pre_process)
+        except Exception:
+            msg = f"{member} failed on {gold['label']}, its text is left empty"
+            logging.exception(msg)
+            texts[member] = ""
+            failed.append(member)
+
+    return {
+        "label": gold["label"],
+        "texts": texts,
+        "failed": failed,
+        "engine_seconds": seconds,
+        "transform_seconds": transforms.seconds,
+    }
+
+
+def member_combos(members: list[str]) -> list[tuple[str, ...]]:
+    """Get every combination of the members, keeping them in member order."""
+    members = [m for m in MEMBERS if m in members]
+    combos = []
+    for size in range(1, len(members) + 1):
+        combos += itertools.combinations(members, size)
+    return combos
+
+
+def score_golds(
+    args: argparse.Namespace,
+    golds: list[dict],
+    results: dict[str, dict],
+    combos: list[tuple[str, ...]],
+) -> list[tuple[list[int], list[float]]]:
+    """
+    Get each label's distances from its gold text, for every combination.
+
+    Each label also gets the post-processing time of every combination.
+    """
+    jobs = [(g["gold_text"], results[g["label"]]["texts"]) for g in golds]
+    options = {"post_process": args.post_process, "align_lines": args.align_lines}
+
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(
+        processes=args.workers,
+        initializer=init_score_worker,
+        initargs=(combos, options),
+    ) as pool:
+        return list(
+            tqdm(
+                pool.imap(score_label, jobs, chunksize=args.chunk),
+                total=len(jobs),
+                desc="score",
+            )
+        )
+
+
+def init_score_worker(combos: list[tuple[str, ...]], options: dict) -> None:
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # The parent handles Ctrl-C
+    WORKER["combos"] = combos
+    WORKER["options"] = options
+    WORKER["aligner"] = LineAlign(char_sub_matrix.get(char_set="default"))
+    WORKER["spell_well"] = SpellWell()
+
+
+def score_label(job: tuple[str, dict[str, str]]) -> tuple[list[int], list[float]]:
+    """
+    Score every combination of the members for one label.
+
+    The distances are in combination order. With post-processing each
+    combination has its distance without and then with post-processing, and the
+    time it took to post-process the combination's text.
+    """
+    gold_text, texts = job
+    gold_text = normalize(gold_text)
+    options = WORKER["options"]
+
+    members = [m for m in MEMBERS if m in texts]
+    distances = {
+        (a, b): distance(texts[a], texts[b])
+        for a, b in itertools.combinations(members, 2)
+    }
+
+    consensuses = {}  # Combinations that keep the same texts share the alignment
+    processed = {}  # The post-processed text and how long it took
+    scores, post_seconds = [], []
+    for combo in WORKER["combos"]:
+        kept = tuple(texts[m] for m in filter_members(combo, distances))
+        if kept not in consensuses:
+            consensuses[kept] = consensus(list(kept), options["align_lines"])
+        text = consensuses[kept]
+        scores.append(distance(gold_text, normalize(text)))
+
+        if options["post_process"]:
+            if text not in processed:
+                start = time.perf_counter()
+                post = label_builder.post_process_text(text, WORKER["spell_well"])
+                processed[text] = (post, time.perf_counter() - start)
+            post, seconds = processed[text]
+            scores.append(distance(gold_text, normalize(post)))
+            post_seconds.append(seconds)
+
+    return scores, post_seconds
+
+
+def filter_members(
+    combo: tuple[str, ...], distances: dict[tuple[str, str], int], threshold=128
+) -> tuple[str, ...]:
+    """Filter the members like filter_lines() using the label's distances."""
+    if len(combo) <= label_builder.MIN_LEN:
+        return combo
+
+    pairs = sorted(
+        (distances[a, b], i, j)
+        for (i, a), (j, b) in itertools.combinations(enumerate(combo), 2)
+    )
+    cutoff = pairs[0][0] + threshold
+
+    order = {}  # Dicts preserve insertion order, sets do not
+    for dist, i, j in pairs:
+        if dist > cutoff:
+            break
+        order[combo[i]] = 1
+        order[combo[j]] = 1
+    return tuple(order)
+
+
+def consensus(lines: list[str], align_lines: bool) -> str:  # noqa: FBT001
+    aligner = WORKER["aligner"]
+    if align_lines:
+        return label_builder.consensus_by_line(lines, aligner.align)
+    return label_builder.consensus(aligner.align(lines))
+
+
+def normalize(text: str) -> str:
+    """Remove the alignment gaps and compare the words only."""
+    return " ".join(text.replace("⋄", "").split())
+
+
+def distance(text1: str, text2: str) -> int:
+    return label_builder.levenshtein_within(text1, text2, max(len(text1), len(text2)))
+
+
+def summarize(
+    args: argparse.Namespace,
+    golds: list[dict],
+    results: dict[str, dict],
+    combos: list[tuple[str, ...]],
+    distances: list[tuple[list[int], list[float]]],
+) -> list[dict]:
+    """
+    Get the accuracy and the cost per label of every pipeline, cheapest first.
+
+    The cost of a post-processed pipeline includes the post-processing time.
+    """
+    chars = sum(len(normalize(g["gold_text"])) for g in golds) or 1
+    labels = len(golds) or 1
+    steps = 2 if args.post_process else 1
+
+    rows = []
+    for c, combo in enumerate(combos):
+        transforms = {f"{m.split('_')[0]}_full" for m in combo} - {"none_full"}
+        engine_s = transform_s = 0.0
+        for gold in golds:
+            result = results[gold["label"]]
+            engine_s += sum(result["engine_seconds"][m] for m in combo)
+            transform_s += lt.transform_cost(result["transform_seconds"], transforms)
+
+        for step in range(steps):
+            dists = [d[c * steps + step] for d, _ in distances]
+            post_s = sum(p[c] for _, p in distances) if step else 0.0
+            pipes = set(combo)
+            if step:
+                pipes.add("post_process")
+            if args.align_lines:
+                pipes.add("align_lines")
+            rows.append(
+                {
+                    "pipeline": Ensemble.build_pipeline(pipes),
+                    "members": len(combo),
+                    "accuracy": round(1.0 - sum(dists) / chars, 4),
+                    "exact": sum(d == 0 for d in dists),
+                    "engine_s": round(engine_s / labels, 3),
+                    "transform_s": round(transform_s / labels, 3),
+                    "post_s": round(post_s / labels, 3),
+                    "cost_s": round((engine_s + transform_s + post_s) / labels, 3),
+                }
+            )
+
+    rows.sort(key=lambda r: (r["cost_s"], -r["accuracy"]))
+
+    best = -1.0
+    for row in rows:  # The frontier: more accurate than anything cheaper
+        row["frontier"] = row["accuracy"] > best
+        best = max(best, row["accuracy"])
+
+    return rows
+
+
+def write_rows(path: Path | None, rows: list[dict]) -> None:
+    if path and rows:
+        with path.open("w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
+
+    for row in rows:
+        if row["frontier"]:
+            msg = (
+                f"{row['accuracy']:.2%} accurate, {row['cost_s']:.2f}s per label: "
+                f"{row['pipeline']}"
+            )
+            logging.info(msg)
+
+
+def log_best(rows: list[dict], target: float) -> None:
+    """Log the cheapest pipeline that is accurate enough."""
+    best = next((r for r in rows if r["accuracy"] >= target), None)
+    if best:
+        msg = (
+            f"Cheapest pipeline with {target:.2%} accuracy: {best['pipeline']} "
+            f"({best['accuracy']:.2%}, {best['cost_s']:.2f}s per label)"
+        )
+    else:
+        msg = f"No pipeline has {target:.2%} accuracy"
+    logging.info(msg)
@@ -1,11 +1,30 @@
 import argparse
+import asyncio
+import collections
+import itertools
 import logging
-import warnings
+import multiprocessing
+import multiprocessing.pool
+import os
+import queue
+import signal
+import time
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import Future
+from pathlib import Path
 
-from PIL import Image, UnidentifiedImageError
+from PIL import UnidentifiedImageError
 from tqdm import tqdm
 
+from ensemble.pylib import (
+    label_builder,
+    label_reader,
+    ocr_cache,
+    stage_stats,
+    text_sink,
+)
 from ensemble.pylib.ensemble import Ensemble
+from ensemble.pylib.manifest import Manifest, file_hash
 
 IMAGE_EXCEPTIONS = (
     UnidentifiedImageError,
@@ -15,25 +34,217 @@ IMAGE_EXCEPTIONS = (
     OSError,
 )
 
+MB = 1024 * 1024
+
+# Each worker process builds its own ensemble once in init_worker()
+WORKER_ENSEMBLE: Ensemble | None = None
+
 
 async def ocr_labels(args: argparse.Namespace) -> None:
-    args.text_dir.mkdir(parents=True, exist_ok=True)
+    pipeline = Ensemble.build_signature(**vars(args))
+    paths = label_reader.label_paths(args.label_dir, args.label_list, args.scan_chunk)
+
+    with text_sink.open_sink(
+        args.sink, args.text_dir, pipeline, args.sink_batch
+    ) as sink:
+        manifest = None
+        if args.incremental:
+            manifest = Manifest(args.text_dir, pipeline)
+            paths = manifest.remaining(paths, sink)
 
+        if args.workers > 1:
+            ocr_parallel(args, paths, sink, manifest)
+        else:
+            await ocr_serial(args, paths, sink, manifest)
+
+
+async def ocr_serial(
+    args: argparse.Namespace,
+    paths: Iterable[Path],
+    sink: text_sink.TextSink,
+    manifest: Manifest | None,
+) -> None:
+    """OCR the labels in this process while the next ones are being decoded."""
     ensemble = Ensemble(**vars(args))
+    report = stage_stats.Report(args.stats_json, args.stats_every)
+
+    labels = label_reader.prefetch(
+        paths,
+        args.decode_threads,
+        args.prefetch,
+        mode=ensemble.image_mode,
+        max_dim=ensemble.max_dim,
+    )
+    for path, image in tqdm(labels):
+        result = await ocr_label(ensemble, path, image)
+        save_result(sink, path, result, manifest)
+        report.snapshot([stage_stats.STATS.to_dict()])
+
+    stats = [run_stats(ensemble)]
+    log_run_stats(stats)
+    report.write([s["stages"] for s in stats])
+
+
+def ocr_parallel(
+    args: argparse.Namespace,
+    paths: Iterable[Path],
+    sink: text_sink.TextSink,
+    manifest: Manifest | None,
+) -> None:
+    """
+    Fan the labels out to a pool of worker processes.
+
+    Workers only OCR the labels, this process writes all of the results. So when
+    the run is interrupted there are no half-written files left behind. Only the
+    labels the workers are on, and up to --prefetch more, are handed out at a
+    time, so the labels are still streamed.
+    """
+    context = multiprocessing.get_context("spawn")
+    report = stage_stats.Report(args.stats_json, args.stats_every)
+
+    with context.Pool(
+        processes=args.workers, initializer=init_worker, initargs=(vars(args),)
+    ) as pool:
+        results = imap_bounded(
+            pool,
+            ocr_worker,
+            paths,
+            window=args.workers + args.prefetch,
+            ordered=not args.unordered,
+        )
+        worker_stats = {}  # The latest stats from each worker
+        try:
+            for path, result, stats in tqdm(results):
+                save_result(sink, path, result, manifest)
+                worker_stats[stats["pid"]] = stats
+                report.snapshot([s["stages"] for s in worker_stats.values()])
+
+        except KeyboardInterrupt:
+            logging.warning("Interrupted, stopping the workers")
+            pool.terminate()
+            pool.join()
+
+    stats = list(worker_stats.values())
+    log_run_stats(stats)
+    report.write([s["stages"] for s in stats])
+
+
+def imap_bounded(
+    pool: multiprocessing.pool.Pool,
+    func: Callable,
+    items: Iterable,
+    window: int,
+    *,
+    ordered: bool = True,
+) -> Iterator:
+    """
+    Map the function over the items in the pool with at most window items queued.
+
+    Pool.imap() reads every item into its task queue right away, so a stream of
+    labels would all be held in memory. Here the next item is only read when a
+    result is taken. The results are in item order, or in the order they finish
+    when not ordered.
+    """
+    items = iter(items)
+    pending = collections.deque()  # The results in item order
+    finished = queue.SimpleQueue()  # The results in the order they finish
+    callbacks = {}
+    if not ordered:
+        callbacks = {
+            "callback": lambda result: finished.put((result, None)),
+            "error_callback": lambda err: finished.put((None, err)),
+        }
+
+    def submit(count: int) -> None:
+        for item in itertools.islice(items, count):
+            pending.append(pool.apply_async(func, (item,), **callbacks))
+
+    submit(max(1, window))
+    while pending:
+        if ordered:
+            result = pending.popleft().get()  # Raises the worker's error
+        else:
+            result, err = finished.get()
+            pending.popleft()  # Only the number of pending results matters here
+            if err:
+                raise err
+        yield result
+        submit(1)
+
+
+def init_worker(kwargs: dict) -> None:
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # The parent handles Ctrl-C
+    global WORKER_ENSEMBLE
+    WORKER_ENSEMBLE = Ensemble(**kwargs)
+
+
+def ocr_worker(path: Path) -> tuple[Path, dict | None, dict]:
+    result = asyncio.run(ocr_label(WORKER_ENSEMBLE, path))
+    return path, result, run_stats(WORKER_ENSEMBLE)
+
+
+def run_stats(ensemble: Ensemble) -> dict:
+    """Get the cache, label image, and stage stats for this process."""
+    caches = label_builder.cache_stats()
+    if ensemble.cache:
+        caches["OCR"] = ensemble.cache.stats
+    return {
+        "pid": os.getpid(),
+        "caches": caches,
+        "images": ensemble.image_stats,
+        "stages": stage_stats.STATS.to_dict(),
+    }
+
+
+def log_run_stats(stats: list[dict]) -> None:
+    """Log the stats combined from every process."""
+    names = dict.fromkeys(k for s in stats for k in s["caches"])
+    for name in names:
+        used = [s["caches"][name] for s in stats if name in s["caches"]]
+        if name == "OCR" or any(u["hits"] + u["misses"] for u in used):
+            ocr_cache.log_stats(used, name)
+
+    labels = sum(s["images"]["labels"] for s in stats)
+    if labels:
+        mean = sum(s["images"]["bytes"] for s in stats) / labels
+        most = max(s["images"]["max_bytes"] for s in stats)
+        msg = f"Label images: {mean / MB:.1f} MB per label, {most / MB:.1f} MB at most"
+        logging.info(msg)
+
+    stage_stats.log_summary(stage_stats.summarize([s["stages"] for s in stats]))
+
+
+async def ocr_label(
+    ensemble: Ensemble, path: Path, image: Future | None = None
+) -> dict | None:
+    """OCR a label that is being decoded in the background, or decode it now."""
+    start = time.perf_counter()
+    try:
+        if image:
+            label = await asyncio.wrap_future(image)
+        else:
+            label = label_reader.decode(path, ensemble.image_mode, ensemble.max_dim)
+        label_hash = None
+        if ensemble.cache:
+            label_hash = await asyncio.to_thread(file_hash, path)
+        result = await ensemble.run_label(label, label_hash)
 
-    paths = sorted(args.label_dir.glob("*"))
-    for path in tqdm(paths):
-        with warnings.catch_warnings():  # Turn off EXIF warnings
-            warnings.filterwarnings("ignore", category=UserWarning)
+    except IMAGE_EXCEPTIONS as err:
+        msg = f"Could not prepare {path.name}: {err}"
+        logging.exception(msg)
+        return None
 
-            try:
-                label = Image.open(path).convert("RGB")
-                text = await ensemble.run(label)
+    result["seconds"] = time.perf_counter() - start
+    stage_stats.count("label seconds", result["seconds"])
+    return result
 
-            except IMAGE_EXCEPTIONS as err:
-                msg = f"Could not prepare {path.name}: {err}"
-                logging.exception(msg)
-                continue
 
-        with (args.text_dir / f"{path.stem}.txt").open("w") as f:
-            f.write(text)
+def save_result(
+    sink: text_sink.TextSink, path: Path, result: dict | None, manifest: Manifest | None
+) -> None:
+    """Write the label's text and only then mark the label as done."""
+    if result is None:
+        return
+    sink.write(path, result)
+    if manifest:
+        manifest.add(path)
@@ -1,21 +1,77 @@
+import collections
+import functools
+import threading
 from dataclasses import dataclass, field
 
-import easyocr
 import numpy as np
-import pytesseract
 
-from ensemble.pylib import label_builder
+from ensemble.pylib import label_builder, stage_stats, tesseract_api
+
+
+class Boxes:
+    """
+    OCR bounding boxes stored as columns.
+
+    The confidences are float32, the coordinates are int32 columns, and the texts
+    are kept in a separate list. This is far smaller than a dict per box, and it is
+    cheap to cache or to send to another process.
+    """
+
+    __slots__ = ("bottom", "conf", "left", "right", "text", "top")
+
+    def __init__(self, *, conf=(), left=(), top=(), right=(), bottom=(), text=()):
+        self.conf = np.asarray(conf, dtype=np.float32)
+        self.left = np.asarray(left, dtype=np.int32)
+        self.top = np.asarray(top, dtype=np.int32)
+        self.right = np.asarray(right, dtype=np.int32)
+        self.bottom = np.asarray(bottom, dtype=np.int32)
+        self.text = [str(t) for t in text]
+
+    def __len__(self) -> int:
+        return len(self.text)
+
+    @property
+    def mean_conf(self) -> float:
+        return float(self.conf.mean()) if len(self.conf) else 0.0
+
+    @classmethod
+    def from_dicts(cls, records: list[dict]) -> "Boxes":
+        """Build boxes from dicts with conf, ocr_left, ..., ocr_text keys."""
+        return cls(
+            conf=[r["conf"] for r in records],
+            left=[r["ocr_left"] for r in records],
+            top=[r["ocr_top"] for r in records],
+            right=[r["ocr_right"] for r in records],
+            bottom=[r["ocr_bottom"] for r in records],
+            text=[r["ocr_text"] for r in records],
+        )
+
+    @classmethod
+    def from_dict(cls, columns: dict) -> "Boxes":
+        return cls(**columns)
+
+    def to_dict(self) -> dict:
+        """Get the columns as lists, e.g. for JSON."""
+        return {
+            "conf": self.conf.tolist(),
+            "left": self.left.tolist(),
+            "top": self.top.tolist(),
+            "right": self.right.tolist(),
+            "bottom": self.bottom.tolist(),
+            "text": self.text,
+        }
 
 
 @dataclass
 class Line:
     """Holds data for building one line of OCR text."""
 
-    boxes: list[dict] = field(default_factory=list)
+    boxes: list[int] = field(default_factory=list)  # Indexes into the Boxes
 
 
 class EngineConfig:
-    easy_ocr = easyocr.Reader(["en"], gpu=True)
+    device = "cpu"  # The device EasyOCR runs on: cpu, cuda, cuda:1, mps, etc.
+    easy_lock = threading.Lock()  # Only one thread at a time uses the reader
 
     char_blacklist = "¥€£¢$«»®©™§{}|~”"
     tess_lang = "eng"
@@ -26,118 +82,214 @@ class EngineConfig:
         ]
     )
 
+    @classmethod
+    def signature(cls, engine: str) -> str:
+        """Describe the engine settings that change what an engine returns."""
+        if engine == "tesseract":
+            if tesseract_api.USE_TESSEROCR:
+                fixed = " ".join(
+                    f"-c {k}={v}" for k, v in tesseract_api.FIXED_VARIABLES.items()
+                )
+                return f"{cls.tess_config} {fixed} backend=tesserocr"
+            return f"{cls.tess_config} backend=pytesseract"
+        return f"-l en blocklist={cls.char_blacklist}"
+
+
+@functools.cache
+def get_easyocr(device: str):
+    """
+    Build the EasyOCR reader the first time this process needs it.
+
+    Loading the models is slow and uses a lot of memory, so runs without any
+    EasyOCR members, and every worker process until it OCRs a label, skip it.
+    """
+    import easyocr  # noqa: PLC0415
 
-async def tesseract_engine(image) -> list[dict]:
-    df = pytesseract.image_to_data(
-        image, config=EngineConfig.tess_config, output_type="data.frame"
-    )
+    gpu = False if device == "cpu" else device
+    return easyocr.Reader(["en"], gpu=gpu)
 
-    df = df.loc[df.conf > 0]
-
-    if df.shape[0] > 0:
-        df.text = df.text.astype(str)
-        df.text = df.text.str.strip()
-        df.conf /= 100.0
-        df["right"] = df.left + df.width
-        df["bottom"] = df.top + df.height
-    else:
-        df["right"] = None
-        df["bottom"] = None
-
-    df = df.loc[:, ["conf", "left", "top", "right", "bottom", "text"]]
-
-    df = df.rename(
-        columns={
-            "left": "ocr_left",
-            "top": "ocr_top",
-            "right": "ocr_right",
-            "bottom": "ocr_bottom",
-            "text": "ocr_text",
-        }
-    )
 
-    results = df.to_dict("records")
-    return results
+@stage_stats.timed("tesseract")
+def tesseract_engine(image) -> Boxes:
+    if tesseract_api.USE_TESSEROCR:
+        columns = tesseract_api.image_to_boxes(
+            image, EngineConfig.tess_lang, EngineConfig.char_blacklist
+        )
+        return Boxes(**columns)
+
+    import pytesseract  # noqa: PLC0415 It imports pandas when pandas is installed
+
+    tsv = pytesseract.image_to_data(image, config=EngineConfig.tess_config)
+    return tsv_boxes(tsv)
+
 
+def tsv_boxes(tsv: str) -> Boxes:
+    """
+    Parse Tesseract's TSV output into OCR boxes.
 
-async def easyocr_engine(image) -> list[dict]:
-    results = []
+    Only words with a confidence > 0 are kept and the confidence is scaled to 0-1.
+    This is much lighter than having pytesseract build a pandas data frame for
+    a few dozen words, and it does not need pandas.
+    """
+    header, *rows = tsv.splitlines()
+    cols = {name: i for i, name in enumerate(header.split("\t"))}
+    conf_col, text_col = cols["conf"], cols["text"]
+    left_col, top_col = cols["left"], cols["top"]
+    width_col, height_col = cols["width"], cols["height"]
+
+    conf, left, top, right, bottom, text = [], [], [], [], [], []
+    for row in rows:
+        fields = row.split("\t")
+        if len(fields) <= conf_col or float(fields[conf_col]) <= 0:
+            continue
+        x, y = int(fields[left_col]), int(fields[top_col])
+        conf.append(float(fields[conf_col]) / 100.0)
+        left.append(x)
+        top.append(y)
+        right.append(x + int(fields[width_col]))
+        bottom.append(y + int(fields[height_col]))
+        text.append(fields[text_col].strip() if len(fields) > text_col else "")
+
+    return Boxes(conf=conf, left=left, top=top, right=right, bottom=bottom, text=text)
+
+
+@stage_stats.timed("easyocr")
+def easyocr_engine(image) -> Boxes:
     image = np.asarray(image)
-    raw = EngineConfig.easy_ocr.readtext(image, blocklist=EngineConfig.char_blacklist)
-    for item in raw:
-        pos = item[0]
-        results.append(
-            {
-                "conf": item[2],
-                "ocr_left": int(pos[0][0]),
-                "ocr_top": int(pos[0][1]),
-                "ocr_right": int(pos[1][0]),
-                "ocr_bottom": int(pos[2][1]),
-                "ocr_text": item[1],
-            }
-        )
-    return results
+    with EngineConfig.easy_lock:
+        reader = get_easyocr(EngineConfig.device)
+        raw = reader.readtext(image, blocklist=EngineConfig.char_blacklist)
+    return easyocr_boxes(raw)
+
 
+@stage_stats.timed("easyocr batch")
+def easyocr_batch(images: list, batch_size: int = 8) -> list[Boxes]:
+    """
+    Run EasyOCR on several images at once.
+
+    The ensemble passes the EasyOCR variants of one label, not images from other
+    labels. EasyOCR can only batch images with the same shape, so the images are
+    grouped by shape and each group is fed through in batches. A lone image is run by
+    itself. The recognizer also batches the text boxes it finds in each image.
+    The box lists are returned in the same order as the images.
+    """
+    arrays = [np.asarray(i) for i in images]
+
+    groups = collections.defaultdict(list)
+    for i, array in enumerate(arrays):
+        groups[array.shape].append(i)
+
+    results = [Boxes() for _ in arrays]
+    with EngineConfig.easy_lock:
+        reader = get_easyocr(EngineConfig.device)
+        for group in groups.values():
+            for beg in range(0, len(group), batch_size):
+                batch = group[beg : beg + batch_size]
+                if len(batch) == 1:
+                    raw = [
+                        reader.readtext(
+                            arrays[batch[0]],
+                            batch_size=batch_size,
+                            blocklist=EngineConfig.char_blacklist,
+                        )
+                    ]
+                else:
+                    raw = reader.readtext_batched(
+                        [arrays[i] for i in batch],
+                        batch_size=batch_size,
+                        blocklist=EngineConfig.char_blacklist,
+                    )
+                for i, boxes in zip(batch, raw, strict=True):
+                    results[i] = easyocr_boxes(boxes)
+
+    return results
 
-async def easy_text(image, pre_process=True) -> str:  # noqa: FBT002
-    ocr_boxes = await easyocr_engine(image)
-    return build_text(ocr_boxes, pre_process=pre_process)
 
+def easyocr_boxes(raw: list) -> Boxes:
+    """Convert EasyOCR output into OCR boxes."""
+    return Boxes(
+        conf=[item[2] for item in raw],
+        left=[int(item[0][0][0]) for item in raw],
+        top=[int(item[0][0][1]) for item in raw],
+        right=[int(item[0][1][0]) for item in raw],
+        bottom=[int(item[0][2][1]) for item in raw],
+        text=[item[1] for item in raw],
+    )
 
-async def tess_text(image, pre_process=True) -> str:  # noqa: FBT002
-    ocr_boxes = await tesseract_engine(image)
-    return build_text(ocr_boxes, pre_process=pre_process)
 
+def build_text(ocr_boxes: Boxes, pre_process=True):  # noqa: FBT002
+    stage_stats.count("boxes", len(ocr_boxes))
+    with stage_stats.timer("get_lines"):
+        lines = get_lines(ocr_boxes)
 
-def build_text(ocr_boxes, pre_process=True):  # noqa: FBT002
-    lines = get_lines(ocr_boxes)
+    text = [" ".join([ocr_boxes.text[i] for i in ln.boxes]) for ln in lines]
 
-    text = []
-    for ln in lines:
-        line = " ".join([b["ocr_text"] for b in ln.boxes])
-        if pre_process:
-            line = line.strip()
-            line = label_builder.substitute(line)
-        text.append(line)
+    if pre_process:  # Substitute all of the lines in one pass
+        text = [ln.strip() for ln in text]
+        return label_builder.substitute_lines("\n".join(text))
 
     text = "\n".join(text)
     return text
 
 
-def get_lines(ocr_boxes, vert_overlap=0.3):
-    """Find lines of text from an OCR bounding boxes."""
-    boxes = sorted(ocr_boxes, key=lambda b: b["ocr_left"])
+def get_lines(ocr_boxes: Boxes, vert_overlap=0.3) -> list[Line]:
+    """
+    Find lines of text from an OCR bounding boxes.
+
+    This sweeps the boxes from left to right. A box only joins a line if it
+    overlaps the vertical extent of the line's last box, so the lines are indexed
+    by that extent in horizontal bands as tall as a typical box. Each box is then
+    only compared with the lines in the bands it spans instead of with every line.
+    With a negative vert_overlap a box can join a line it does not overlap at all,
+    so it is compared with every line.
+    """
+    order = np.argsort(ocr_boxes.left, kind="stable").tolist()
+    tops, bottoms = ocr_boxes.top.tolist(), ocr_boxes.bottom.tolist()
     lines: list[Line] = []
 
-    for box in boxes:
-        overlap = [(find_overlap(line, box), line) for line in lines]
-        overlap = sorted(overlap, key=lambda o: -o[0])
+    heights = np.sort(ocr_boxes.bottom - ocr_boxes.top)
+    band = max(1, int(heights[len(heights) // 2])) if len(heights) else 1
+    index = collections.defaultdict(set)  # Band -> lines with a last box in it
 
-        if overlap and overlap[0][0] > vert_overlap:
-            line = overlap[0][1]
-            line.boxes.append(box)
+    def bands(box):
+        return range(tops[box] // band, -(-bottoms[box] // band))
+
+    for box in order:
+        if vert_overlap < 0.0:
+            candidates = set(range(len(lines)))
+        else:
+            candidates = set()
+            for row in bands(box):
+                candidates |= index.get(row, set())
+
+        # Keep the first line created with the highest overlap, like a stable sort
+        best, best_overlap = None, vert_overlap
+        for i in sorted(candidates):
+            last = lines[i].boxes[-1]
+            overlap = overlap_fraction(
+                tops[last], bottoms[last], tops[box], bottoms[box]
+            )
+            if overlap > best_overlap:
+                best, best_overlap = i, overlap
+
+        if best is None:
+            best = len(lines)
+            lines.append(Line())
         else:
-            line = Line()
-            line.boxes.append(box)
-            lines.append(line)
+            for row in bands(lines[best].boxes[-1]):
+                index[row].discard(best)
 
-    lines = sorted(lines, key=lambda r: r.boxes[0]["ocr_top"])
-    return lines
+        lines[best].boxes.append(box)
+        for row in bands(box):
+            index[row].add(best)
 
+    lines = sorted(lines, key=lambda r: tops[r.boxes[0]])
+    return lines
 
-def find_overlap(line: Line, ocr_box, eps=1e-6):
-    """
-    Find the vertical overlap between a line and an OCR bounding box.
 
-    This is expressed as a fraction of the smallest height of the line
-    & OCR bounding box.
-    """
-    last = line.boxes[-1]
-    min_height = min(
-        last["ocr_bottom"] - last["ocr_top"],
-        ocr_box["ocr_bottom"] - ocr_box["ocr_top"],
-    )
-    y_min = max(last["ocr_top"], ocr_box["ocr_top"])
-    y_max = min(last["ocr_bottom"], ocr_box["ocr_bottom"])
+def overlap_fraction(top1, bottom1, top2, bottom2, eps=1e-6):
+    min_height = min(bottom1 - top1, bottom2 - top2)
+    y_min = max(top1, top2)
+    y_max = min(bottom1, bottom2)
     inter = max(0, y_max - y_min)
     return inter / (min_height + eps)
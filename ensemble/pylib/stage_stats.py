@@ -0,0 +1,236 @@
+"""
+Time every stage of the OCR pipeline and count what goes through it.
+
+Each process records into its own STATS. A stage records its wall time and the
+CPU time of the thread it ran in, so stages run in worker threads are measured
+correctly. The times and counts go into histograms with log-scale buckets. They
+are small and cheap to add to, and histograms from several worker processes can
+be merged before their percentiles are taken.
+"""
+
+import collections
+import contextlib
+import functools
+import json
+import logging
+import math
+import threading
+import time
+from pathlib import Path
+
+BUCKETS_PER_DOUBLING = 8  # Percentiles are within about 9% of the true value
+PERCENTILES = (50, 90, 99)
+
+
+class Histogram:
+    """A histogram of positive values in log-scale buckets."""
+
+    __slots__ = ("buckets", "count", "high", "low", "total", "zeros")
+
+    def __init__(self):
+        self.buckets: dict[int, int] = {}
+        self.count = 0
+        self.total = 0.0
+        self.low = math.inf
+        self.high = -math.inf
+        self.zeros = 0  # Values <= 0 have no log bucket
+
+    def add(self, value: float) -> None:
+        self.count += 1
+        self.total += value
+        self.low = min(self.low, value)
+        self.high = max(self.high, value)
+        if value <= 0:
+            self.zeros += 1
+        else:
+            key = math.floor(math.log2(value) * BUCKETS_PER_DOUBLING)
+            self.buckets[key] = self.buckets.get(key, 0) + 1
+
+    def merge(self, other: "Histogram") -> None:
+        self.count += other.count
+        self.total += other.total
+        self.low = min(self.low, other.low)
+        self.high = max(self.high, other.high)
+        self.zeros += other.zeros
+        for key, count in other.buckets.items():
+            self.buckets[key] = self.buckets.get(key, 0) + count
+
+    def percentile(self, pct: float) -> float:
+        """Get the middle of the bucket holding the percentile."""
+        if not self.count:
+            return 0.0
+        rank = max(1, math.ceil(pct / 100.0 * self.count))
+        seen = self.zeros
+        if seen >= rank:
+            return min(0.0, self.high)
+        for key in sorted(self.buckets):
+            seen += self.buckets[key]
+            if seen >= rank:
+                middle = 2.0 ** ((key + 0.5) / BUCKETS_PER_DOUBLING)
+                return min(max(middle, self.low), self.high)
+        return self.high
+
+    def summary(self) -> dict:
+        if not self.count:
+            return {"count": 0}
+        stats = {
+            "count": self.count,
+            "total": self.total,
+            "mean": self.total / self.count,
+            "min": self.low,
+            "max": self.high,
+        }
+        stats |= {f"p{p}": self.percentile(p) for p in PERCENTILES}
+        return stats
+
+    def to_dict(self) -> dict:
+        return {
+            "buckets": list(self.buckets.items()),  # JSON keys must be strings
+            "count": self.count,
+            "total": self.total,
+            "low": self.low,
+            "high": self.high,
+            "zeros": self.zeros,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Histogram":
+        hist = cls()
+        hist.buckets = {int(k): c for k, c in data["buckets"]}
+        hist.count = data["count"]
+        hist.total = data["total"]
+        hist.low = data["low"]
+        hist.high = data["high"]
+        hist.zeros = data["zeros"]
+        return hist
+
+
+class StageStats:
+    """The stage times and counts for one process. It is safe to use from threads."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.wall = collections.defaultdict(Histogram)
+        self.cpu = collections.defaultdict(Histogram)
+        self.counts = collections.defaultdict(Histogram)
+
+    @contextlib.contextmanager
+    def timer(self, stage: str):
+        """Time a block of synchronous code. Do not await inside of it."""
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - wall, time.thread_time() - cpu)
+
+    def timed(self, stage: str):
+        """Time every call to the decorated function."""
+
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.timer(stage):
+                    return func(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def add_time(self, stage: str, wall: float, cpu: float) -> None:
+        with self.lock:
+            self.wall[stage].add(wall)
+            self.cpu[stage].add(cpu)
+
+    def count(self, name: str, value: float) -> None:
+        with self.lock:
+            self.counts[name].add(value)
+
+    def to_dict(self) -> dict:
+        """Get a snapshot that can be sent to another process or saved as JSON."""
+        with self.lock:
+            return {
+                "wall": {k: h.to_dict() for k, h in self.wall.items()},
+                "cpu": {k: h.to_dict() for k, h in self.cpu.items()},
+                "counts": {k: h.to_dict() for k, h in self.counts.items()},
+            }
+
+    def clear(self) -> None:
+        with self.lock:
+            self.wall.clear()
+            self.cpu.clear()
+            self.counts.clear()
+
+
+STATS = StageStats()  # This process's stats
+
+timer = STATS.timer
+timed = STATS.timed
+count = STATS.count
+
+
+def merge(snapshots: list[dict]) -> dict[str, dict[str, Histogram]]:
+    """Merge the snapshots from every process into histograms."""
+    merged = {"wall": {}, "cpu": {}, "counts": {}}
+    for snapshot in snapshots:
+        for kind, hists in merged.items():
+            for name, data in snapshot[kind].items():
+                hists.setdefault(name, Histogram()).merge(Histogram.from_dict(data))
+    return merged
+
+
+def summarize(snapshots: list[dict]) -> dict:
+    """Summarize the stats from every process for the JSON report."""
+    merged = merge(snapshots)
+    stages = {
+        name: {"wall": wall.summary(), "cpu": merged["cpu"][name].summary()}
+        for name, wall in sorted(merged["wall"].items(), key=lambda s: -s[1].total)
+    }
+    counts = {name: h.summary() for name, h in sorted(merged["counts"].items())}
+    return {
+        "processes": len(snapshots),
+        "time": time.time(),
+        "stages": stages,
+        "counts": counts,
+    }
+
+
+def log_summary(summary: dict) -> None:
+    """Log the stages, slowest first, and the counts."""
+    for name, stage in summary["stages"].items():
+        wall, cpu = stage["wall"], stage["cpu"]
+        msg = (
+            f"Stage {name}: {wall['count']} calls, {wall['total']:.1f}s wall, "
+            f"{cpu['total']:.1f}s CPU, p50 {wall['p50'] * 1000:.1f}ms, "
+            f"p90 {wall['p90'] * 1000:.1f}ms, p99 {wall['p99'] * 1000:.1f}ms"
+        )
+        logging.info(msg)
+
+    for name, hist in summary["counts"].items():
+        msg = (
+            f"Count {name}: mean {hist['mean']:.1f}, p50 {hist['p50']:.1f}, "
+            f"p90 {hist['p90']:.1f}, p99 {hist['p99']:.1f}, max {hist['max']:.1f}"
+        )
+        logging.info(msg)
+
+
+class Report:
+    """Write the summary to a JSON file every so often and at the end of the run."""
+
+    def __init__(self, path: Path | None = None, every: float = 0.0):
+        self.path = path
+        self.every = every  # Seconds between snapshots, 0 = only at the end
+        self.last = time.monotonic()
+
+    def snapshot(self, snapshots: list[dict]) -> None:
+        """Write the summary if it is time for the next snapshot."""
+        if self.path and self.every and time.monotonic() - self.last >= self.every:
+            self.write(snapshots)
+
+    def write(self, snapshots: list[dict]) -> None:
+        self.last = time.monotonic()
+        if not self.path:
+            return
+        temp = self.path.with_name(f".{self.path.name}.tmp")
+        with temp.open("w") as f:
+            json.dump(summarize(snapshots), f, indent=2)
+        temp.replace(self.path)
@@ -0,0 +1,150 @@
+"""
+Long-lived Tesseract engines that are given images in memory.
+
+pytesseract writes a temp image and starts a new tesseract process, which
+reloads the language model, for every call. When tesserocr is installed a few
+engines stay loaded and the threads take turns using them for every label
+instead.
+"""
+
+import contextlib
+import threading
+
+from PIL import Image
+from PIL.Image import Image as ImageType
+
+try:
+    import tesserocr
+except ImportError:
+    tesserocr = None
+
+BACKENDS = ("auto", "tesserocr", "pytesseract")
+
+USE_TESSEROCR = tesserocr is not None
+
+# Engines are not thread safe, so each one is used by one thread at a time. At
+# most MAX_ENGINES are loaded for each setting in a process.
+MAX_ENGINES = 1
+ENGINES = threading.Condition()
+IDLE: dict[tuple, list] = {}  # The loaded engines that no thread is using
+LOADED: dict[tuple, int] = {}  # How many engines are loaded for each setting
+
+# Tesseract's adaptive classifier learns from every page it reads, so an engine's
+# output would depend on the labels it read before. Turn the learning off.
+FIXED_VARIABLES = {"classify_enable_learning": "0"}
+
+
+def set_backend(backend: str = "auto") -> None:
+    global USE_TESSEROCR
+    if backend == "tesserocr" and tesserocr is None:
+        msg = "The tesserocr backend needs the tesserocr package"
+        raise ValueError(msg)
+    USE_TESSEROCR = backend_name(backend) == "tesserocr"
+
+
+def backend_name(backend: str = "auto") -> str:
+    """Get the backend that the --tesseract-backend option runs."""
+    if backend == "tesserocr" or (backend == "auto" and tesserocr):
+        return "tesserocr"
+    return "pytesseract"
+
+
+def version() -> str | None:
+    """Get the version of Tesseract that the backend runs, or None if there is none."""
+    if USE_TESSEROCR:
+        return tesserocr.tesseract_version().split()[1]  # "tesseract 5.3.0\n ..."
+
+    import pytesseract  # noqa: PLC0415 It imports pandas when pandas is installed
+
+    try:
+        return str(pytesseract.get_tesseract_version())
+    except pytesseract.TesseractNotFoundError:
+        return None
+
+
+def set_max_engines(count: int) -> None:
+    """Load up to this many engines for each setting, e.g. one per OCR thread."""
+    global MAX_ENGINES
+    with ENGINES:
+        MAX_ENGINES = max(1, count)
+        ENGINES.notify_all()
+
+
+@contextlib.contextmanager
+def get_api(lang: str, psm: int, variables: dict[str, str]):
+    """
+    Borrow an engine for the settings, loading it when none is free.
+
+    When MAX_ENGINES are already loaded for the settings this waits for one of
+    them. The engine is cleared before it is given back.
+    """
+    key = (lang, psm, tuple(sorted(variables.items())))
+    with ENGINES:
+        while not IDLE.get(key) and LOADED.get(key, 0) >= MAX_ENGINES:
+            ENGINES.wait()
+        api = IDLE[key].pop() if IDLE.get(key) else None
+        if api is None:
+            LOADED[key] = LOADED.get(key, 0) + 1
+
+    if api is None:
+        try:
+            api = tesserocr.PyTessBaseAPI(
+                lang=lang, psm=psm, variables=FIXED_VARIABLES | variables
+            )
+        except Exception:
+            with ENGINES:
+                LOADED[key] -= 1
+                ENGINES.notify()
+            raise
+
+    try:
+        yield api
+    finally:
+        api.Clear()
+        with ENGINES:
+            IDLE.setdefault(key, []).append(api)
+            ENGINES.notify()
+
+
+def to_image(image) -> ImageType:
+    return image if isinstance(image, ImageType) else Image.fromarray(image)
+
+
+def image_to_boxes(image, lang: str, char_blacklist: str) -> dict[str, list]:
+    """OCR the image and return the columns of the word boxes with confidence > 0."""
+    variables = {"tessedit_char_blacklist": char_blacklist}
+    columns = {k: [] for k in ("conf", "left", "top", "right", "bottom", "text")}
+    with get_api(lang, tesserocr.PSM.AUTO, variables) as api:
+        api.SetImage(to_image(image))
+        api.Recognize()
+
+        level = tesserocr.RIL.WORD
+        for word in tesserocr.iterate_level(api.GetIterator(), level):
+            conf = word.Confidence(level)
+            if conf <= 0:
+                continue
+            left, top, right, bottom = word.BoundingBox(level)
+            columns["conf"].append(conf / 100.0)
+            columns["left"].append(left)
+            columns["top"].append(top)
+            columns["right"].append(right)
+            columns["bottom"].append(bottom)
+            columns["text"].append((word.GetUTF8Text(level) or "").strip())
+    return columns
+
+
+def image_to_osd(image) -> tuple[int, float] | None:
+    """
+    Find the label's orientation.
+
+    Returns the clockwise rotation needed to make the label upright and the
+    confidence, like the "Rotate" & "Orientation confidence" in Tesseract's OSD
+    output. Returns None when Tesseract cannot tell.
+    """
+    with get_api("osd", tesserocr.PSM.OSD_ONLY, {}) as api:
+        api.SetImage(to_image(image))
+        osd = api.DetectOrientationScript()
+    if not osd:
+        return None
+    rotate = (360 - osd["orient_deg"]) % 360
+    return rotate, osd["orient_conf"]
@@ -0,0 +1,276 @@
+"""
+Where the OCR text of the labels is written.
+
+The text sink writes a text file per label, like always, with the text each
+ensemble member read in a JSON file next to it. The JSONL and SQLite sinks gather
+every label into one file. They also keep the text each ensemble member read and
+how long the label took. They buffer the results and a writer
+thread saves them in batches, so writing never holds up the OCR.
+"""
+
+import abc
+import json
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+SINKS = ("text", "jsonl", "sqlite")
+
+FLUSH = object()  # Tells the writer to save a partial batch
+
+MEMBERS_SUFFIX = ".members.json"
+JSONL_NAME = "ocr_text.jsonl"
+SQLITE_NAME = "ocr_text.sqlite"
+
+
+def open_sink(sink: str, text_dir: Path, pipeline: str, batch: int = 100):
+    """Get the output sink for the --sink option."""
+    text_dir.mkdir(parents=True, exist_ok=True)
+    if sink == "jsonl":
+        return JsonlSink(text_dir / JSONL_NAME, pipeline, batch)
+    if sink == "sqlite":
+        return SqliteSink(text_dir / SQLITE_NAME, pipeline, batch)
+    return TextSink(text_dir)
+
+
+def write_text(path: Path, text: str) -> None:
+    """Write the text to a temp file and rename it, so the write is atomic."""
+    temp = path.with_name(f".{path.name}.tmp")
+    try:
+        with temp.open("w") as f:
+            f.write(text)
+        temp.replace(path)
+    finally:
+        temp.unlink(missing_ok=True)
+
+
+class TextSink:
+    """
+    Write each label's text to its own file in the text directory.
+
+    The member texts are written first, so a label with a text file is complete.
+    """
+
+    def __init__(self, text_dir: Path):
+        self.text_dir = text_dir
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def has(self, path: Path) -> bool:
+        return (self.text_dir / f"{path.stem}.txt").exists()
+
+    def write(self, path: Path, result: dict) -> None:
+        members = json.dumps(result["members"], ensure_ascii=False, indent=2)
+        write_text(self.text_dir / f"{path.stem}{MEMBERS_SUFFIX}", members)
+        write_text(self.text_dir / f"{path.stem}.txt", result["text"])
+
+    def close(self) -> None:
+        pass
+
+
+class BatchSink(TextSink, abc.ABC):
+    """
+    Save the results in batches from a writer thread.
+
+    A batch is saved when it is full or when no more results come in for a moment,
+    so a slow run still saves its results often. Closing the sink saves the rest.
+    If the writer thread stops, e.g. when the file cannot be opened or a batch
+    cannot be saved, writing to or closing the sink raises its error instead of
+    waiting on a queue nobody empties.
+    """
+
+    wait = 2.0  # Seconds to wait for more results before saving a partial batch
+    put_wait = 1.0  # Seconds between checks that the writer is still running
+
+    def __init__(self, path: Path, pipeline: str, batch: int = 100):
+        super().__init__(path.parent)
+        self.path = path
+        self.pipeline = pipeline
+        self.batch = max(1, batch)
+        self.error: Exception | None = None  # Why the writer stopped
+        self.queue = queue.Queue(maxsize=4 * self.batch)
+        self.writer = threading.Thread(target=self.write_batches, daemon=True)
+        self.writer.start()
+
+    def write(self, path: Path, result: dict) -> None:
+        record = {
+            "name": path.name,
+            "pipeline": self.pipeline,
+            "text": result["text"],
+            "members": result["members"],
+            "seconds": round(result["seconds"], 3),
+        }
+        self.put(record)
+
+    def put(self, record: dict | None) -> None:
+        """Queue the record for the writer, as long as the writer is running."""
+        while True:
+            self.check_writer()
+            try:
+                self.queue.put(record, timeout=self.put_wait)
+            except queue.Full:
+                continue
+            return
+
+    def check_writer(self) -> None:
+        if not self.writer.is_alive():
+            msg = f"The writer for {self.path} is not running"
+            raise RuntimeError(msg) from self.error
+
+    def close(self) -> None:
+        if self.writer.is_alive():
+            self.put(None)
+            self.writer.join()
+        if self.error:
+            msg = f"The writer for {self.path} failed"
+            raise RuntimeError(msg) from self.error
+
+    def write_batches(self) -> None:
+        try:
+            self.open_writer()
+            self.save_batches()
+            self.close_writer()
+        except Exception as err:
+            self.error = err
+            raise
+
+    def save_batches(self) -> None:
+        records = []
+        while True:
+            try:
+                record = self.queue.get(timeout=self.wait)
+            except queue.Empty:
+                record = FLUSH
+
+            if record not in (None, FLUSH):
+                records.append(record)
+
+            if records and (record in (None, FLUSH) or len(records) >= self.batch):
+                try:
+                    self.save(records)
+                except (OSError, sqlite3.Error) as err:
+                    msg = f"Could not save {len(records)} labels to {self.path}: {err}"
+                    logging.exception(msg)
+                    self.error = err  # Stop so the labels are not marked as done
+                    return
+                records = []
+
+            if record is None:
+                break
+
+    def open_writer(self) -> None:
+        """Get ready to save, this runs in the writer thread."""
+
+    @abc.abstractmethod
+    def save(self, records: list[dict]) -> None:
+        """Save a batch of records, this runs in the writer thread."""
+
+    def close_writer(self) -> None:
+        """Clean up after saving, this runs in the writer thread."""
+
+
+class JsonlSink(BatchSink):
+    """
+    Append the results to a JSONL file, one line per label.
+
+    The names already in the file are read once, so checking for a label is a set
+    lookup. The last line for a label wins.
+    """
+
+    def __init__(self, path: Path, pipeline: str, batch: int = 100):
+        self.names = set()
+        if path.exists():
+            with path.open() as f:
+                for ln in f:
+                    try:
+                        self.names.add(json.loads(ln)["name"])
+                    except (json.JSONDecodeError, KeyError):
+                        continue  # A line cut off by a crash
+        super().__init__(path, pipeline, batch)
+
+    def has(self, path: Path) -> bool:
+        return path.name in self.names
+
+    def save(self, records: list[dict]) -> None:
+        lines = "".join(json.dumps(r, ensure_ascii=False) + "\n" for r in records)
+        with self.path.open("a") as f:
+            f.write(lines)
+        self.names.update(r["name"] for r in records)
+
+
+class SqliteSink(BatchSink):
+    """
+    Save the results in a SQLite database with one row per label and pipeline.
+
+    Checking for a label is a primary key lookup. Each batch is one transaction.
+    """
+
+    def __init__(self, path: Path, pipeline: str, batch: int = 100):
+        self.lock = threading.Lock()
+        self.cxn = self.connect(path)  # For lookups, the writer has its own
+        self.cxn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS texts (
+                name     TEXT,
+                pipeline TEXT,
+                text     TEXT,
+                members  TEXT,
+                seconds  REAL,
+                saved    REAL,
+                PRIMARY KEY (name, pipeline)
+            );
+            """
+        )
+        super().__init__(path, pipeline, batch)
+
+    @staticmethod
+    def connect(path: Path) -> sqlite3.Connection:
+        cxn = sqlite3.connect(path, check_same_thread=False)
+        cxn.execute("PRAGMA journal_mode = WAL")
+        return cxn
+
+    def has(self, path: Path) -> bool:
+        with self.lock:
+            row = self.cxn.execute(
+                "SELECT 1 FROM texts WHERE name = ? AND pipeline = ?",
+                (path.name, self.pipeline),
+            ).fetchone()
+        return row is not None
+
+    def open_writer(self) -> None:
+        self.writer_cxn = self.connect(self.path)
+
+    def save(self, records: list[dict]) -> None:
+        now = time.time()
+        rows = [
+            (
+                r["name"],
+                r["pipeline"],
+                r["text"],
+                json.dumps(r["members"], ensure_ascii=False),
+                r["seconds"],
+                now,
+            )
+            for r in records
+        ]
+        with self.writer_cxn:
+            self.writer_cxn.executemany(
+                "INSERT OR REPLACE INTO texts VALUES (?, ?, ?, ?, ?, ?)", rows
+            )
+
+    def close_writer(self) -> None:
+        self.writer_cxn.close()
+
+    def close(self) -> None:
+        try:
+            super().close()
+        finally:
+            with self.lock:
+                self.cxn.close()
@@ -0,0 +1,87 @@
+import unittest
+
+from ensemble.pylib import benchmark as bm
+from ensemble.pylib import label_builder as lb
+from ensemble.pylib import label_transformer as lt
+from ensemble.pylib import ocr_runner
+from tests.test_label_builder import FakeSpellWell
+
+SEEDS = range(5)
+LABEL = "\n".join(bm.LABEL_LINES)
+
+
+class FakeSpellChecker(FakeSpellWell):
+    """A spell checker with a tiny vocabulary that fixes one word."""
+
+    def is_letters(self, token):
+        return token.isalpha()
+
+    def correct(self, word):
+        return "Florida" if word == "Flarida" else word
+
+
+class TestReference(unittest.TestCase):
+    """The faster implementations give the same output as the ones they replaced."""
+
+    def test_consensus_01(self):
+        for seed in SEEDS:
+            aligned = bm.noisy_copies(LABEL, 8, error_rate=0.2, seed=seed)
+            with self.subTest(seed=seed):
+                self.assertEqual(lb.consensus(aligned), bm.consensus_by_column(aligned))
+
+    def test_filter_lines_01(self):
+        for seed in SEEDS:
+            lines = bm.member_texts(LABEL, members=6, outliers=2, seed=seed)
+            with self.subTest(seed=seed):
+                self.assertEqual(lb.filter_lines(lines), bm.filter_lines_by_all(lines))
+
+    def test_filter_lines_02(self):
+        lines = bm.member_texts(LABEL, members=6, outliers=2)
+        self.assertEqual(
+            lb.filter_lines(lines, threshold=8),
+            bm.filter_lines_by_all(lines, threshold=8),
+        )
+
+    def test_substitute_01(self):
+        lines = bm.ocr_label_lines(5)
+        self.assertEqual(
+            lb.substitute_lines("\n".join(lines)),
+            "\n".join(bm.substitute_by_pattern(ln) for ln in lines),
+        )
+
+    def test_post_process_01(self):
+        spell_well = FakeSpellChecker()
+        text = "Palm Beach  County,SouthFlorida\nw est of the Flarida line"
+        bm.clear_text_caches()
+        self.assertEqual(
+            lb.post_process_text(text, spell_well),
+            bm.post_process_by_pass(text, spell_well),
+        )
+
+    def test_get_lines_01(self):
+        for seed in SEEDS:
+            boxes = bm.synthetic_boxes(200, seed=seed)
+            with self.subTest(seed=seed):
+                self.assertEqual(
+                    bm.line_texts(ocr_runner.get_lines(boxes), boxes),
+                    bm.line_texts(bm.get_lines_by_scan(boxes), boxes),
+                )
+
+    def test_get_lines_02(self):
+        """With a negative overlap, boxes join lines they do not overlap."""
+        boxes = bm.synthetic_boxes(50)
+        lines = ocr_runner.get_lines(boxes, vert_overlap=-0.1)
+        self.assertEqual(
+            bm.line_texts(lines, boxes),
+            bm.line_texts(bm.get_lines_by_scan(boxes, vert_overlap=-0.1), boxes),
+        )
+        self.assertEqual(len(lines), 1)
+
+    def test_find_skew_01(self):
+        """Both searches find the skew of labels that are rotated by a grid angle."""
+        for angle in (0.0, 1.0, -1.5):
+            label = bm.synthetic_label(angle=angle)
+            image = lt.image_to_array(label)
+            with self.subTest(angle=angle):
+                skew = lt.find_skew(image)
+                self.assertAlmostEqual(skew.angle, bm.skew_by_rotation(image), 1)
@@ -0,0 +1,62 @@
+import unittest
+
+from ensemble.pylib.ensemble import Ensemble
+from ensemble.pylib.ocr_runner import Boxes
+
+
+def boxes(*words: str) -> Boxes:
+    """Put the words on one line."""
+    lefts = [i * 50 for i in range(len(words))]
+    return Boxes(
+        conf=[0.9] * len(words),
+        left=lefts,
+        top=[10] * len(words),
+        right=[x + 40 for x in lefts],
+        bottom=[30] * len(words),
+        text=words,
+    )
+
+
+class TestEnsemble(unittest.TestCase):
+    def test_build_text_01(self):
+        """It pre-processes the text with the pre_process pipe."""
+        ensemble = Ensemble(none_tesseract=True, pre_process=True)
+        self.assertEqual(
+            ensemble.build_text(boxes("Collected", "0ct", "1990")),
+            "Collected Oct 1990",
+        )
+
+    def test_build_text_02(self):
+        """It leaves the text alone without the pre_process pipe."""
+        ensemble = Ensemble(none_tesseract=True)
+        self.assertEqual(
+            ensemble.build_text(boxes("Collected", "0ct", "1990")),
+            "Collected 0ct 1990",
+        )
+
+    def test_members_by_cost_01(self):
+        ensemble = Ensemble(
+            denoise_easyocr=True, binarize_tesseract=True, none_tesseract=True
+        )
+        self.assertEqual(
+            ensemble.members_by_cost,
+            ["none_tesseract", "binarize_tesseract", "denoise_easyocr"],
+        )
+
+    def test_agreed_01(self):
+        """Two confident members that read the label alike agree."""
+        ensemble = Ensemble(none_tesseract=True, deskew_tesseract=True)
+        texts = {"none_tesseract": "Lake Placid", "deskew_tesseract": "Lake Placid"}
+        self.assertTrue(ensemble.agreed(texts, dict.fromkeys(texts, 0.9)))
+
+    def test_agreed_02(self):
+        """Members that are not confident do not agree."""
+        ensemble = Ensemble(none_tesseract=True, deskew_tesseract=True)
+        texts = {"none_tesseract": "Lake Placid", "deskew_tesseract": "Lake Placid"}
+        self.assertFalse(ensemble.agreed(texts, dict.fromkeys(texts, 0.5)))
+
+    def test_agreed_03(self):
+        """Confident members that read the label differently do not agree."""
+        ensemble = Ensemble(none_tesseract=True, deskew_tesseract=True)
+        texts = {"none_tesseract": "Lake Placid", "deskew_tesseract": "Highlands Co."}
+        self.assertFalse(ensemble.agreed(texts, dict.fromkeys(texts, 0.9)))
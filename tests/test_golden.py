@@ -0,0 +1,14 @@
+import unittest
+
+from ensemble.pylib import benchmark
+
+
+class TestGolden(unittest.TestCase):
+    def test_golden_01(self):
+        """Every pipeline stage still gives its golden output."""
+        for name in benchmark.GOLDEN:
+            with self.subTest(golden=name):
+                row = benchmark.check_golden([name])[0]
+                if row["same"] == benchmark.SKIPPED:
+                    self.skipTest(row["note"])
+                self.assertTrue(row["same"], row.get("note"))
@@ -0,0 +1,165 @@
+import unittest
+
+import regex as re
+
+from ensemble.pylib import label_builder as lb
+
+WORDS = {
+    "south": 900,
+    "florida": 500,
+    "west": 400,
+    "southwest": 100,
+    "palm": 300,
+    "beach": 300,
+    "county": 800,
+    "the": 9000,
+    "as": 4000,
+    "see": 700,
+    "tall": 200,
+    "ah": 3,
+    "o": 50,
+    "kee": 10,
+    "cho": 10,
+    "bee": 60,
+}
+
+
+class FakeSpellWell:
+    """A spell checker with a tiny vocabulary."""
+
+    def tokenize(self, text):
+        return re.findall(r"\p{L}+|\s+|[^\p{L}\s]+", text)
+
+    def is_word(self, word):
+        return word.lower() in WORDS
+
+    def freq(self, word):
+        return WORDS.get(word.lower(), 0)
+
+
+class TestAddSpaces(unittest.TestCase):
+    def setUp(self):
+        lb.split_token.cache_clear()
+        self.spell_well = FakeSpellWell()
+
+    def test_add_spaces_01(self):
+        self.assertEqual(
+            lb.add_spaces("SouthFlorida", self.spell_well), "South Florida"
+        )
+
+    def test_add_spaces_02(self):
+        """It splits a token into more than two words."""
+        self.assertEqual(
+            lb.add_spaces("WestPalmBeach County", self.spell_well),
+            "West Palm Beach County",
+        )
+
+    def test_add_spaces_03(self):
+        """It leaves words in the vocabulary alone."""
+        self.assertEqual(
+            lb.add_spaces("South Florida", self.spell_well), "South Florida"
+        )
+
+    def test_add_spaces_04(self):
+        """It keeps the punctuation and spaces around a split token."""
+        self.assertEqual(
+            lb.add_spaces("(SouthFlorida),  the", self.spell_well),
+            "(South Florida),  the",
+        )
+
+    def test_split_token_01(self):
+        """It leaves a token alone when part of it is not a word."""
+        self.assertEqual(
+            lb.split_token("SouthFloridax", self.spell_well), "SouthFloridax"
+        )
+
+    def test_split_token_02(self):
+        """It does not shred a name into single letters."""
+        self.assertEqual(lb.split_token("Okeechobee", self.spell_well), "Okeechobee")
+
+    def test_split_token_03(self):
+        """It does not shred a name into rare words."""
+        self.assertEqual(lb.split_token("Tallahassee", self.spell_well), "Tallahassee")
+
+    def test_split_token_04(self):
+        """It splits a token into the fewest words."""
+        self.assertEqual(
+            lb.split_token("SouthwestFlorida", self.spell_well), "Southwest Florida"
+        )
+
+    def test_split_token_05(self):
+        """Splits are cached."""
+        lb.split_token("SouthFlorida", self.spell_well)
+        lb.split_token("SouthFlorida", self.spell_well)
+        lb.split_token("WestPalm", self.spell_well)
+        info = lb.split_token.cache_info()
+        self.assertEqual((info.hits, info.misses), (1, 2))
+        self.assertEqual(lb.cache_stats()["Word split"]["hits"], 1)
+
+
+def pad(lines: list[str]) -> list[str]:
+    """Align lines that only have substitutions by padding their ends."""
+    width = max(len(ln) for ln in lines)
+    return [ln.ljust(width, "⋄") for ln in lines]
+
+
+class TestMatchLines(unittest.TestCase):
+    def test_match_lines_01(self):
+        """Lines are matched even when a text has an extra line."""
+        texts = [
+            "Aster ericoides\nTexas, Erath County\nA. Nelson",
+            "Herbarium\nAster ericoldes\nTexas, Erath Conty\nA. Nelsen",
+        ]
+        self.assertEqual(
+            lb.match_lines(texts),
+            [
+                [None, "Herbarium"],
+                ["Aster ericoides", "Aster ericoldes"],
+                ["Texas, Erath County", "Texas, Erath Conty"],
+                ["A. Nelson", "A. Nelsen"],
+            ],
+        )
+
+    def test_match_lines_02(self):
+        """Lines that differ too much are not matched."""
+        self.assertCountEqual(
+            lb.match_lines(["Aster ericoides", "Upland open"]),
+            [["Aster ericoides", None], [None, "Upland open"]],
+        )
+
+    def test_match_lines_03(self):
+        self.assertEqual(lb.match_lines(["a\nb", ""]), [["a", None], ["b", None]])
+        self.assertEqual(lb.match_lines([]), [])
+
+    def test_match_pairs_01(self):
+        """Matches do not cross."""
+        self.assertEqual(
+            lb.match_pairs(2, 2, {(0, 1): 0.9, (1, 0): 0.9}),
+            [(None, 0), (0, 1), (1, None)],
+        )
+
+
+class TestConsensusByLine(unittest.TestCase):
+    def test_consensus_by_line_01(self):
+        """Each line is voted on by itself."""
+        texts = [
+            "Aster ericoides\nA. Nelson",
+            "Aster ericoldes\nA. Nelson",
+            "Aster ericoides\nA. Nelsen",
+        ]
+        self.assertEqual(lb.consensus_by_line(texts, pad), "Aster ericoides\nA. Nelson")
+
+    def test_consensus_by_line_02(self):
+        """A line that fewer than half of the texts have is dropped."""
+        texts = [
+            "Herbarium\nAster ericoides",
+            "Aster ericoides",
+            "Aster ericoides\n|||",
+            "Aster ericoides",
+        ]
+        self.assertEqual(lb.consensus_by_line(texts, pad), "Aster ericoides")
+
+    def test_consensus_by_line_03(self):
+        """A line that half of the texts have is kept."""
+        texts = ["Herbarium\nAster ericoides", "Aster ericoides"]
+        self.assertEqual(lb.consensus_by_line(texts, pad), "Herbarium\nAster ericoides")
@@ -0,0 +1,135 @@
+import tempfile
+import threading
+import time
+import unittest
+from pathlib import Path
+from unittest.mock import patch
+
+import numpy as np
+from PIL import Image
+
+from ensemble.pylib import label_reader
+
+DEPTH = 3
+DECODE_SECONDS = 0.01  # Long enough for the decodes to pile up
+
+
+class TestLabelReader(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.dir = Path(self.temp_dir.name)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def save(self, name: str, mode: str, size=(400, 200)) -> Path:
+        path = self.dir / name
+        Image.new(mode, size).save(path)
+        return path
+
+    def save_noise(self, name: str, size=(400, 200)) -> Path:
+        """Save a color label with every pixel different."""
+        path = self.dir / name
+        data = np.random.default_rng(0).integers(0, 256, (size[1], size[0], 3))
+        Image.fromarray(data.astype(np.uint8), "RGB").save(path)
+        return path
+
+    def test_decode_01(self):
+        """It decodes into the mode it is asked for."""
+        path = self.save("label.png", "RGB")
+        self.assertEqual(label_reader.decode(path, "L").mode, "L")
+        self.assertEqual(label_reader.decode(path, "RGB").mode, "RGB")
+
+    def test_decode_02(self):
+        """It shrinks large labels by an integer factor, to no less than max_dim."""
+        path = self.save("label.png", "RGB")
+        image = label_reader.decode(path, "RGB", max_dim=120)
+        self.assertEqual(image.size, (134, 67))
+
+    def test_decode_03(self):
+        """It does not shrink labels smaller than twice max_dim."""
+        path = self.save("label.png", "RGB")
+        self.assertEqual(label_reader.decode(path, "L", max_dim=300).size, (400, 200))
+
+    def test_decode_04(self):
+        """It shrinks palette and 1-bit labels."""
+        for mode, name in (("P", "label.gif"), ("1", "label.tif"), ("P", "p.png")):
+            with self.subTest(mode=mode, name=name):
+                path = self.save(name, mode)
+                image = label_reader.decode(path, "L", max_dim=100)
+                self.assertEqual((image.mode, image.size), ("L", (100, 50)))
+
+    def test_decode_05(self):
+        """JPEGs are shrunk while they are decoded."""
+        path = self.save("label.jpg", "RGB", size=(800, 400))
+        image = label_reader.decode(path, "L", max_dim=200)
+        self.assertEqual((image.mode, image.size), ("L", (200, 100)))
+
+    def test_decode_06(self):
+        """A label decoded in L is the label decoded in RGB then converted to L."""
+        for name in ("label.jpg", "label.png"):
+            path = self.save_noise(name, size=(800, 400))
+            for max_dim in (0, 150):
+                with self.subTest(name=name, max_dim=max_dim):
+                    gray = label_reader.decode(path, "L", max_dim)
+                    color = label_reader.decode(path, "RGB", max_dim).convert("L")
+                    self.assertEqual(gray.tobytes(), color.tobytes())
+
+    def test_scan_dir_01(self):
+        """Only the images are found and they are sorted."""
+        for name in ("b.jpg", "a.PNG", "c.txt", "d.tif"):
+            (self.dir / name).touch()
+        (self.dir / "e.jpg").mkdir()
+        names = [p.name for p in label_reader.scan_dir(self.dir)]
+        self.assertEqual(names, ["a.PNG", "b.jpg", "d.tif"])
+
+    def test_scan_dir_02(self):
+        """Reading the directory in chunks finds the same images."""
+        names = [f"{i:02d}.jpg" for i in range(10)]
+        for name in names:
+            (self.dir / name).touch()
+        found = [p.name for p in label_reader.scan_dir(self.dir, chunk=3)]
+        self.assertCountEqual(found, names)
+
+    def test_label_paths_01(self):
+        """The listed paths are stripped and the ones that are not images dropped."""
+        (self.dir / "a.jpg").touch()
+        label_list = self.dir / "labels.txt"
+        label_list.write_text("  x/b.jpg\n\nx/c.csv\nx/d.png\n")
+        paths = label_reader.label_paths(self.dir, label_list)
+        self.assertEqual(
+            list(paths), [self.dir / "a.jpg", Path("x/b.jpg"), Path("x/d.png")]
+        )
+
+    def test_prefetch_01(self):
+        """Labels come back in order and a bad label's error is in its future."""
+        good = self.save("good.png", "RGB")
+        bad = self.dir / "bad.png"
+        bad.write_text("not an image")
+        paths = [good, bad, good]
+        results = list(label_reader.prefetch(paths, mode="L"))
+        self.assertEqual([p for p, _ in results], paths)
+        self.assertEqual(results[0][1].result().mode, "L")
+        self.assertIsInstance(results[1][1].exception(), OSError)
+
+    def test_prefetch_02(self):
+        """No more than depth labels are decoded ahead of the caller."""
+        started = []
+        lock = threading.Lock()
+
+        def decode(path, **_):
+            with lock:
+                started.append(path)
+            time.sleep(DECODE_SECONDS)
+            return path
+
+        paths = [Path(f"{i}.jpg") for i in range(10)]
+        with patch.object(label_reader, "decode", decode):
+            for i, (_, future) in enumerate(
+                label_reader.prefetch(paths, threads=DEPTH, depth=DEPTH)
+            ):
+                future.result()
+                time.sleep(DECODE_SECONDS)
+                with lock:
+                    self.assertLessEqual(len(started), i + DEPTH)
+        self.assertCountEqual(started, paths)
@@ -0,0 +1,149 @@
+import collections
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+
+import numpy as np
+
+from ensemble.pylib import benchmark as bm
+from ensemble.pylib import label_transformer as lt
+
+THREADS = 8
+SKEW_ERROR = 0.15  # Degrees, a little more than the search resolution
+BUILD_SECONDS = 0.01  # Long enough for the threads to race for a stage
+
+
+class CountingStages:
+    """Transform stages that count how often they are built."""
+
+    def __init__(self):
+        self.calls = collections.Counter()
+        self.lock = threading.Lock()
+
+    def stage(self, name):
+        def build(image):
+            with self.lock:
+                self.calls[name] += 1
+            time.sleep(BUILD_SECONDS)
+            return f"{image}>{name}"
+
+        return build
+
+    def stages(self):
+        return {
+            name: (parent, self.stage(name))
+            for name, (parent, _) in lt.TRANSFORM_STAGES.items()
+        }
+
+
+class TestLabelTransforms(unittest.TestCase):
+    def setUp(self):
+        self.counting = CountingStages()
+        patcher = patch.dict(lt.TRANSFORM_STAGES, self.counting.stages())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_label_transforms_01(self):
+        """Each stage is built once and the shared stages are reused."""
+        transforms = lt.LabelTransforms("label")
+        self.assertEqual(
+            transforms["binarize_full"], "label>deskew>binarize>binarize_full"
+        )
+        self.assertEqual(
+            transforms["denoise_full"], "label>deskew>binarize>denoise>denoise_full"
+        )
+        self.assertEqual(transforms["deskew_full"], "label>deskew>deskew_full")
+        self.assertEqual(set(self.counting.calls.values()), {1})
+        self.assertEqual(len(self.counting.calls), 6)
+
+    def test_label_transforms_02(self):
+        """Stages asked for from several threads at once are still built once."""
+        transforms = lt.LabelTransforms("label")
+        names = ["deskew_full", "binarize_full", "denoise_full"] * THREADS
+        with ThreadPoolExecutor(max_workers=THREADS) as executor:
+            images = list(executor.map(transforms.__getitem__, names))
+        self.assertEqual(images[:3], images[3:6])
+        self.assertEqual(set(self.counting.calls.values()), {1})
+
+    def test_label_transforms_03(self):
+        """Every stage is timed."""
+        transforms = lt.LabelTransforms("label")
+        _ = transforms["denoise_full"]
+        self.assertEqual(
+            set(transforms.seconds),
+            {"none", "deskew", "binarize", "denoise", "denoise_full"},
+        )
+
+
+class TestTransformCost(unittest.TestCase):
+    def test_transform_cost_01(self):
+        """Shared stages are counted once."""
+        seconds = {"deskew": 1.0, "binarize": 2.0, "binarize_full": 0.5}
+        seconds |= {"denoise": 4.0, "denoise_full": 0.25}
+        cost = lt.transform_cost(seconds, ["binarize_full", "denoise_full"])
+        self.assertEqual(cost, 7.75)
+
+    def test_transform_cost_02(self):
+        """Stages that were not built, e.g. when they failed, cost nothing."""
+        self.assertEqual(lt.transform_cost({"deskew": 1.0}, ["deskew_full"]), 1.0)
+        self.assertEqual(lt.transform_cost({}, ["none"]), 0.0)
+
+
+class TestTransformVersion(unittest.TestCase):
+    def test_transform_version_01(self):
+        self.assertEqual(lt.transform_version("none"), "none=1")
+
+    def test_transform_version_02(self):
+        """A variant's version includes the stages it is built from."""
+        versions = {"none": 1, "deskew": 3, "binarize": 2, "binarize_full": 1}
+        with patch.dict(lt.STAGE_VERSIONS, versions):
+            self.assertEqual(
+                lt.transform_version("binarize_full"),
+                "none=1 deskew=3 binarize=2 binarize_full=1",
+            )
+
+    def test_transform_version_03(self):
+        """Bumping a stage changes the version of every variant built from it."""
+        before = {n: lt.transform_version(n) for n in lt.TRANSFORM_STAGES}
+        with patch.dict(lt.STAGE_VERSIONS, {"binarize": 99}):
+            after = {n: lt.transform_version(n) for n in lt.TRANSFORM_STAGES}
+        changed = {n for n in before if before[n] != after[n]}
+        self.assertEqual(
+            changed, {"binarize", "binarize_full", "denoise", "denoise_full"}
+        )
+
+
+class TestFindSkew(unittest.TestCase):
+    def test_find_skew_01(self):
+        """The skew straightens rotated labels, also between the coarse angles."""
+        for angle in (0.0, 0.8, -1.3, 1.7):
+            label = bm.synthetic_label(angle=angle, noise=8.0)
+            with self.subTest(angle=angle):
+                skew = lt.find_skew(lt.image_to_array(label))
+                self.assertLessEqual(abs(skew.angle + angle), SKEW_ERROR)
+                self.assertGreater(skew.confidence, 0.5)
+
+    def test_find_skew_02(self):
+        """The skew is the same for RGB, grayscale, and binary labels."""
+        label = bm.synthetic_label(angle=0.8)
+        gray = lt.image_to_array(label)
+        angles = {
+            lt.find_skew(np.asarray(label)).angle,
+            lt.find_skew(gray).angle,
+            lt.find_skew(gray > lt.PIX_MAX / 2).angle,
+        }
+        self.assertEqual(angles, {-0.8})
+
+    def test_find_skew_03(self):
+        """The skew stays within the angle range."""
+        label = bm.synthetic_label(angle=3.0)
+        skew = lt.find_skew(lt.image_to_array(label), angle_range=2.0)
+        self.assertEqual(skew.angle, -2.0)
+
+    def test_find_skew_04(self):
+        """A blank label is not rotated."""
+        blank = np.full((50, 80), 255, dtype=np.uint8)
+        self.assertEqual(lt.find_skew(blank), lt.Skew(lt.NO_ANGLE, 0.0))
+        self.assertIs(lt.deskew(blank), blank)
@@ -0,0 +1,113 @@
+import os
+import tempfile
+import unittest
+from pathlib import Path
+
+from ensemble.pylib import text_sink
+from ensemble.pylib.ensemble import Ensemble
+from ensemble.pylib.manifest import MANIFEST_NAME, Manifest
+
+PIPELINE = "[,tesseract]"
+
+
+class TestManifest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.dir = Path(self.temp_dir.name)
+        self.text_dir = self.dir / "text"
+        self.text_dir.mkdir()
+        self.sink = text_sink.TextSink(self.text_dir)
+        self.labels = []
+        for name in ("a", "b", "c"):
+            path = self.dir / f"{name}.jpg"
+            path.write_bytes(name.encode() * 10)
+            self.labels.append(path)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def finish(self, manifest: Manifest, path: Path) -> None:
+        self.sink.write(path, {"text": "text", "members": {}})
+        manifest.add(path)
+
+    def test_remaining_01(self):
+        """Finished labels are skipped."""
+        manifest = Manifest(self.text_dir, PIPELINE)
+        self.finish(manifest, self.labels[0])
+        self.assertEqual(
+            list(manifest.remaining(self.labels, self.sink)), self.labels[1:]
+        )
+
+    def test_remaining_02(self):
+        """The manifest is read back by the next run."""
+        self.finish(Manifest(self.text_dir, PIPELINE), self.labels[1])
+        manifest = Manifest(self.text_dir, PIPELINE)
+        self.assertEqual(
+            list(manifest.remaining(self.labels, self.sink)),
+            [self.labels[0], self.labels[2]],
+        )
+
+    def test_remaining_03(self):
+        """Labels finished with another pipeline are redone."""
+        self.finish(Manifest(self.text_dir, PIPELINE), self.labels[0])
+        manifest = Manifest(self.text_dir, f"{PIPELINE},[max_dim=1000]")
+        self.assertEqual(list(manifest.remaining(self.labels, self.sink)), self.labels)
+
+    def test_remaining_04(self):
+        """Labels whose text is gone are redone."""
+        manifest = Manifest(self.text_dir, PIPELINE)
+        self.finish(manifest, self.labels[0])
+        (self.text_dir / "a.txt").unlink()
+        self.assertEqual(list(manifest.remaining(self.labels, self.sink)), self.labels)
+
+    def test_is_done_01(self):
+        """A label that was changed is redone, one that was only touched is not."""
+        manifest = Manifest(self.text_dir, PIPELINE)
+        self.finish(manifest, self.labels[0])
+        self.finish(manifest, self.labels[1])
+
+        stat = self.labels[0].stat()
+        os.utime(self.labels[0], ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        self.labels[1].write_bytes(b"B" * 10)
+
+        self.assertTrue(manifest.is_done(self.labels[0], self.sink))
+        self.assertFalse(manifest.is_done(self.labels[1], self.sink))
+
+    def test_load_01(self):
+        """A line cut off by a crash is ignored."""
+        manifest = Manifest(self.text_dir, PIPELINE)
+        self.finish(manifest, self.labels[0])
+        with (self.text_dir / MANIFEST_NAME).open("a") as f:
+            f.write('{"name": "b.jpg", "ha')
+        manifest = Manifest(self.text_dir, PIPELINE)
+        self.assertEqual(list(manifest.entries), ["a.jpg"])
+
+
+class TestSignature(unittest.TestCase):
+    def test_build_signature_01(self):
+        self.assertEqual(
+            Ensemble.build_signature(
+                none_tesseract=True,
+                pre_process=True,
+                max_dim=1000,
+                tesseract_backend="pytesseract",
+            ),
+            "[,tesseract],[pre_process],[max_dim=1000],[backend=pytesseract]",
+        )
+
+    def test_build_signature_02(self):
+        """The options that change the text change the signature."""
+        base = {"none_tesseract": True, "tesseract_backend": "pytesseract"}
+        signatures = {
+            Ensemble.build_signature(**base),
+            Ensemble.build_signature(**base, max_dim=1000),
+            Ensemble.build_signature(**base, pre_process=True),
+        }
+        self.assertEqual(len(signatures), 3)
+
+    def test_build_signature_03(self):
+        """The Tesseract backend does not matter without Tesseract members."""
+        self.assertEqual(
+            Ensemble.build_signature(none_easyocr=True, tesseract_backend="auto"),
+            "[,easyocr]",
+        )
@@ -0,0 +1,75 @@
+import tempfile
+import unittest
+from pathlib import Path
+
+from ensemble.pylib import label_transformer as lt
+from ensemble.pylib.ensemble import Ensemble
+from ensemble.pylib.ocr_cache import OcrCache
+from ensemble.pylib.ocr_runner import Boxes
+
+
+class TestOcrCache(unittest.TestCase):
+    def test_key_01(self):
+        """A new transform version gets a new key."""
+        key1 = OcrCache.key("abc", "deskew", "tesseract", "-l eng", "deskew=1")
+        key2 = OcrCache.key("abc", "deskew", "tesseract", "-l eng", "deskew=2")
+        self.assertNotEqual(key1, key2)
+
+    def test_transform_version_01(self):
+        """A variant's version includes the stages it is built from."""
+        self.assertEqual(
+            lt.transform_version("binarize_full"),
+            (
+                f"none={lt.STAGE_VERSIONS['none']} "
+                f"deskew={lt.STAGE_VERSIONS['deskew']} "
+                f"binarize={lt.STAGE_VERSIONS['binarize']} "
+                f"binarize_full={lt.STAGE_VERSIONS['binarize_full']}"
+            ),
+        )
+
+    def test_transform_version_02(self):
+        """Every transform stage has a version."""
+        self.assertEqual(set(lt.STAGE_VERSIONS), {"none"} | set(lt.TRANSFORM_STAGES))
+
+    def test_get_01(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            cache = OcrCache(Path(temp_dir) / "cache.sqlite")
+            boxes = Boxes(
+                conf=[0.9], left=[1], top=[2], right=[3], bottom=[4], text=["a"]
+            )
+            key = cache.key("abc", "none", "tesseract", "-l eng", "none=1")
+            cache.put(key, boxes)
+            self.assertEqual(cache.get(key).text, ["a"])
+            self.assertIsNone(
+                cache.get(cache.key("abc", "none", "tesseract", "-l eng", "none=2"))
+            )
+            cache.cxn.close()
+
+    def test_cache_keys_01(self):
+        """Adding a member that needs the label in color keeps the other keys."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            cache = Path(temp_dir) / "cache.sqlite"
+            gray = Ensemble(deskew_tesseract=True, ocr_cache=cache)
+            color = Ensemble(
+                deskew_tesseract=True, none_tesseract=True, ocr_cache=cache
+            )
+            self.assertEqual(gray.image_mode, "L")
+            self.assertEqual(color.image_mode, "RGB")
+            keys1 = gray.cache_keys(None, "abc")
+            keys2 = color.cache_keys(None, "abc")
+            self.assertEqual(keys1["deskew_tesseract"], keys2["deskew_tesseract"])
+            self.assertNotEqual(keys2["deskew_tesseract"], keys2["none_tesseract"])
+            gray.cache.cxn.close()
+            color.cache.cxn.close()
+
+    def test_cache_keys_02(self):
+        """Decoding the label smaller changes the keys."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            cache = Path(temp_dir) / "cache.sqlite"
+            full = Ensemble(none_tesseract=True, ocr_cache=cache)
+            small = Ensemble(none_tesseract=True, ocr_cache=cache, max_dim=1000)
+            self.assertNotEqual(
+                full.cache_keys(None, "abc"), small.cache_keys(None, "abc")
+            )
+            full.cache.cxn.close()
+            small.cache.cxn.close()
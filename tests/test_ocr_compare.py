@@ -0,0 +1,74 @@
+import argparse
+import tempfile
+import unittest
+from pathlib import Path
+from unittest.mock import patch
+
+from PIL import Image
+
+from ensemble.pylib import ocr_compare
+from ensemble.pylib.ensemble import Ensemble
+from ensemble.pylib.ocr_runner import Boxes
+
+
+def crash(_image):
+    msg = "engine crashed"
+    raise RuntimeError(msg)
+
+
+def read(_image):
+    return Boxes(conf=[0.9], left=[0], top=[0], right=[40], bottom=[20], text=["Ok"])
+
+
+class TestOcrCompare(unittest.TestCase):
+    def test_ocr_gold_01(self):
+        """A member that fails is recorded with empty text."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = Path(temp_dir) / "label.png"
+            Image.new("RGB", (64, 32), color="white").save(path)
+            gold = {"label": "label.png", "gold_text": "Ok", "path": path}
+            engines = {"tesseract": read, "easyocr": crash}
+            with patch.dict(Ensemble.engines, engines), self.assertLogs(level="ERROR"):
+                result = ocr_compare.ocr_gold(
+                    (gold, ["none_easyocr", "none_tesseract"], False)
+                )
+        self.assertEqual(result["texts"], {"none_easyocr": "", "none_tesseract": "Ok"})
+        self.assertEqual(result["failed"], ["none_easyocr"])
+
+    def test_ocr_golds_01(self):
+        """No workers are started when every label is in the results already."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            ocr_results = Path(temp_dir) / "results.jsonl"
+            ocr_results.write_text(
+                '{"label": "a", "texts": {"none_tesseract": "Ok"}}\n'
+            )
+            args = argparse.Namespace(
+                ocr_results=ocr_results,
+                members=["none_tesseract"],
+                pre_process=False,
+                workers=1,
+            )
+            golds = [{"label": "a", "gold_text": "Ok"}]
+            with patch.object(ocr_compare, "ocr_jobs") as ocr_jobs:
+                results = ocr_compare.ocr_golds(args, golds)
+        ocr_jobs.assert_not_called()
+        self.assertEqual(results["a"]["texts"], {"none_tesseract": "Ok"})
+
+    def test_summarize_01(self):
+        """The post-processing time is part of the cost of post-processing."""
+        args = argparse.Namespace(post_process=True, align_lines=False)
+        golds = [{"label": "a", "gold_text": "Ok"}]
+        results = {
+            "a": {
+                "engine_seconds": {"none_tesseract": 1.0},
+                "transform_seconds": {"none": 0.0},
+            }
+        }
+        combos = [("none_tesseract",)]
+        distances = [([0, 1], [0.5])]
+        rows = ocr_compare.summarize(args, golds, results, combos, distances)
+        costs = {r["pipeline"]: (r["post_s"], r["cost_s"]) for r in rows}
+        self.assertEqual(
+            costs,
+            {"[,tesseract]": (0.0, 1.0), "[,tesseract],[post_process]": (0.5, 1.5)},
+        )
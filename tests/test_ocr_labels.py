@@ -0,0 +1,56 @@
+import threading
+import unittest
+from multiprocessing.pool import ThreadPool
+
+from ensemble.pylib.ocr_labels import imap_bounded
+
+BAD = 3
+
+
+def double(x):
+    return 2 * x
+
+
+def fail(x):
+    if x == BAD:
+        msg = "bad label"
+        raise ValueError(msg)
+    return x
+
+
+class TestImapBounded(unittest.TestCase):
+    def test_imap_bounded_01(self):
+        """It keeps the results in item order."""
+        with ThreadPool(3) as pool:
+            results = list(imap_bounded(pool, double, range(20), window=4))
+        self.assertEqual(results, [2 * i for i in range(20)])
+
+    def test_imap_bounded_02(self):
+        """It gets every result when not ordered."""
+        with ThreadPool(3) as pool:
+            results = imap_bounded(pool, double, range(20), window=4, ordered=False)
+            self.assertEqual(sorted(results), [2 * i for i in range(20)])
+
+    def test_imap_bounded_03(self):
+        """It only reads the items that fit in the window."""
+        read = []
+        lock = threading.Lock()
+
+        def items():
+            for i in range(100):
+                with lock:
+                    read.append(i)
+                yield i
+
+        with ThreadPool(2) as pool:
+            results = imap_bounded(pool, double, items(), window=5)
+            self.assertEqual(next(results), 0)
+            self.assertEqual(len(read), 5)
+            self.assertEqual(next(results), 2)
+            self.assertEqual(len(read), 6)
+
+    def test_imap_bounded_04(self):
+        """It raises the worker's error."""
+        for ordered in (True, False):
+            with ThreadPool(2) as pool, self.assertRaises(ValueError):
+                list(imap_bounded(pool, fail, range(6), window=2, ordered=ordered))
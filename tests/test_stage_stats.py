@@ -0,0 +1,118 @@
+import json
+import tempfile
+import unittest
+from pathlib import Path
+
+from ensemble.pylib import stage_stats
+
+ERROR = 0.1  # The log buckets are within about 9% of a value
+
+
+def histogram(values) -> stage_stats.Histogram:
+    hist = stage_stats.Histogram()
+    for value in values:
+        hist.add(value)
+    return hist
+
+
+class TestHistogram(unittest.TestCase):
+    def test_percentile_01(self):
+        hist = histogram(range(1, 101))
+        for pct in stage_stats.PERCENTILES:
+            with self.subTest(pct=pct):
+                self.assertAlmostEqual(hist.percentile(pct), pct, delta=pct * ERROR)
+
+    def test_percentile_02(self):
+        """Percentiles stay within the smallest and largest values."""
+        hist = histogram([3.0] * 10)
+        self.assertEqual(hist.percentile(50), 3.0)
+        self.assertEqual(hist.percentile(99), 3.0)
+
+    def test_percentile_03(self):
+        """Zeros, e.g. labels with no boxes, are counted below every bucket."""
+        hist = histogram([0, 0, 0, 10])
+        self.assertEqual(hist.percentile(50), 0.0)
+        self.assertAlmostEqual(hist.percentile(99), 10.0, delta=10.0 * ERROR)
+        self.assertEqual(stage_stats.Histogram().percentile(50), 0.0)
+
+    def test_summary_01(self):
+        summary = histogram([1.0, 2.0, 3.0]).summary()
+        self.assertEqual(
+            {k: summary[k] for k in ("count", "total", "mean", "min", "max")},
+            {"count": 3, "total": 6.0, "mean": 2.0, "min": 1.0, "max": 3.0},
+        )
+        self.assertEqual(stage_stats.Histogram().summary(), {"count": 0})
+
+    def test_merge_01(self):
+        """Merging histograms is the same as adding all of the values to one."""
+        merged = histogram([0, 1, 2])
+        merged.merge(histogram([4, 8, 16]))
+        self.assertEqual(merged.to_dict(), histogram([0, 1, 2, 4, 8, 16]).to_dict())
+
+    def test_to_dict_01(self):
+        """Histograms survive the trip through JSON to another process."""
+        hist = histogram([0, 0.5, 2, 300])
+        data = json.loads(json.dumps(hist.to_dict()))
+        self.assertEqual(
+            stage_stats.Histogram.from_dict(data).to_dict(), hist.to_dict()
+        )
+
+
+class TestStageStats(unittest.TestCase):
+    def test_summarize_01(self):
+        """The stats from every process are merged and the slowest stage is first."""
+        snapshots = []
+        for seconds in (0.5, 1.0):
+            stats = stage_stats.StageStats()
+            stats.add_time("decode", seconds, seconds)
+            stats.add_time("get_lines", 0.1, 0.1)
+            stats.count("boxes", 10)
+            snapshots.append(stats.to_dict())
+        summary = stage_stats.summarize(snapshots)
+        self.assertEqual(summary["processes"], 2)
+        self.assertEqual(list(summary["stages"]), ["decode", "get_lines"])
+        self.assertEqual(summary["stages"]["decode"]["wall"]["total"], 1.5)
+        self.assertEqual(summary["counts"]["boxes"]["count"], 2)
+
+    def test_timed_01(self):
+        stats = stage_stats.StageStats()
+        func = stats.timed("stage")(lambda x: x + 1)
+        self.assertEqual(func(1), 2)
+        self.assertEqual(stats.wall["stage"].count, 1)
+        self.assertEqual(stats.cpu["stage"].count, 1)
+
+
+class TestReport(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.path = Path(self.temp_dir.name) / "stats.json"
+        stats = stage_stats.StageStats()
+        stats.add_time("decode", 0.5, 0.5)
+        self.snapshots = [stats.to_dict()]
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_report_01(self):
+        """Snapshots are only written once the interval has passed."""
+        report = stage_stats.Report(self.path, every=3600.0)
+        report.snapshot(self.snapshots)
+        self.assertFalse(self.path.exists())
+        report.last -= 3600.0
+        report.snapshot(self.snapshots)
+        self.assertTrue(self.path.exists())
+
+    def test_report_02(self):
+        """Without an interval the report is only written at the end."""
+        report = stage_stats.Report(self.path)
+        report.snapshot(self.snapshots)
+        self.assertFalse(self.path.exists())
+        report.write(self.snapshots)
+        summary = json.loads(self.path.read_text())
+        self.assertEqual(summary["stages"]["decode"]["wall"]["count"], 1)
+        self.assertEqual(list(self.path.parent.iterdir()), [self.path])
+
+    def test_report_03(self):
+        """Without a path nothing is written."""
+        stage_stats.Report(every=1.0).write(self.snapshots)
+        self.assertEqual(list(self.path.parent.iterdir()), [])
@@ -0,0 +1,34 @@
+import threading
+import unittest
+
+from ensemble.pylib import tesseract_api
+
+
+@unittest.skipUnless(tesseract_api.tesserocr, "tesserocr is not installed")
+class TestTesseractApi(unittest.TestCase):
+    def setUp(self):
+        tesseract_api.set_max_engines(1)
+
+    def test_get_api_01(self):
+        """Engines do not learn from the labels they read."""
+        with tesseract_api.get_api("eng", tesseract_api.tesserocr.PSM.AUTO, {}) as api:
+            self.assertEqual(api.GetVariableAsString("classify_enable_learning"), "0")
+
+    def test_get_api_02(self):
+        """Threads take turns with the engines instead of loading their own."""
+        psm = tesseract_api.tesserocr.PSM.SINGLE_BLOCK
+        key = ("eng", psm, ())
+        used = []
+
+        def borrow():
+            with tesseract_api.get_api("eng", psm, {}) as api:
+                used.append(id(api))
+
+        threads = [threading.Thread(target=borrow) for _ in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(tesseract_api.LOADED[key], 1)
+        self.assertEqual(len(set(used)), 1)
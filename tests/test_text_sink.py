@@ -0,0 +1,112 @@
+import json
+import sqlite3
+import tempfile
+import unittest
+from pathlib import Path
+from unittest.mock import patch
+
+from ensemble.pylib import text_sink
+
+RESULT = {"text": "Lake Placid", "members": {"none_tesseract": "Lake"}, "seconds": 1.5}
+
+
+class BrokenSink(text_sink.BatchSink):
+    """A sink whose writer cannot open its file."""
+
+    put_wait = 0.01
+
+    def open_writer(self) -> None:
+        msg = "No space left on device"
+        raise OSError(msg)
+
+    def save(self, records: list[dict]) -> None:
+        pass
+
+
+class FullDiskSink(text_sink.BatchSink):
+    """A sink whose writer cannot save its batches."""
+
+    put_wait = 0.01
+
+    def save(self, records: list[dict]) -> None:
+        msg = "No space left on device"
+        raise OSError(msg)
+
+
+class TestTextSink(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.text_dir = Path(self.temp_dir.name)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_text_sink_01(self):
+        """The member texts are kept next to the text file."""
+        with text_sink.open_sink("text", self.text_dir, "[,tesseract]") as sink:
+            sink.write(Path("dir/a.jpg"), RESULT)
+            self.assertTrue(sink.has(Path("a.jpg")))
+
+        text = (self.text_dir / "a.txt").read_text()
+        members = json.loads((self.text_dir / "a.members.json").read_text())
+        self.assertEqual(text, "Lake Placid")
+        self.assertEqual(members, {"none_tesseract": "Lake"})
+
+    def test_jsonl_sink_01(self):
+        with text_sink.open_sink("jsonl", self.text_dir, "[,tesseract]", 2) as sink:
+            sink.write(Path("a.jpg"), RESULT)
+            sink.write(Path("b.jpg"), RESULT)
+            sink.write(Path("c.jpg"), RESULT)
+
+        with (self.text_dir / text_sink.JSONL_NAME).open() as f:
+            records = [json.loads(ln) for ln in f]
+        self.assertEqual([r["name"] for r in records], ["a.jpg", "b.jpg", "c.jpg"])
+        self.assertEqual(records[0]["text"], "Lake Placid")
+
+        with text_sink.open_sink("jsonl", self.text_dir, "[,tesseract]") as sink:
+            self.assertTrue(sink.has(Path("dir/b.jpg")))
+            self.assertFalse(sink.has(Path("d.jpg")))
+
+    def test_sqlite_sink_01(self):
+        with text_sink.open_sink("sqlite", self.text_dir, "[,tesseract]", 2) as sink:
+            sink.write(Path("a.jpg"), RESULT)
+            sink.write(Path("a.jpg"), RESULT | {"text": "Lake Wales"})
+            sink.write(Path("b.jpg"), RESULT)
+
+        with text_sink.open_sink("sqlite", self.text_dir, "[,tesseract]") as sink:
+            self.assertTrue(sink.has(Path("a.jpg")))
+            self.assertFalse(sink.has(Path("c.jpg")))
+
+        cxn = sqlite3.connect(self.text_dir / text_sink.SQLITE_NAME)
+        rows = cxn.execute("SELECT name, text FROM texts ORDER BY name").fetchall()
+        cxn.close()
+        self.assertEqual(rows, [("a.jpg", "Lake Wales"), ("b.jpg", "Lake Placid")])
+
+    def test_batch_sink_01(self):
+        """A batch sink must say how to save a batch."""
+        with self.assertRaises(TypeError):
+            text_sink.BatchSink(self.text_dir / "x.jsonl", "[,tesseract]")
+
+    def test_batch_sink_02(self):
+        """Writing to a sink whose writer failed raises instead of hanging."""
+        with patch("threading.excepthook"):  # Keep the thread's traceback quiet
+            sink = BrokenSink(self.text_dir / "x.jsonl", "[,tesseract]", 1)
+            sink.writer.join()
+        with self.assertRaises(RuntimeError) as context:
+            for i in range(10):  # More than the queue holds
+                sink.write(Path(f"{i}.jpg"), RESULT)
+        self.assertIsInstance(context.exception.__cause__, OSError)
+        with self.assertRaises(RuntimeError):
+            sink.close()
+
+    def test_batch_sink_03(self):
+        """A batch that cannot be saved stops the writer and raises its error."""
+        sink = FullDiskSink(self.text_dir / "x.jsonl", "[,tesseract]", 1)
+        with self.assertLogs(level="ERROR"):
+            sink.write(Path("a.jpg"), RESULT)
+            sink.writer.join()
+        with self.assertRaises(RuntimeError) as context:
+            sink.write(Path("b.jpg"), RESULT)
+        self.assertIsInstance(context.exception.__cause__, OSError)
+        with self.assertRaises(RuntimeError):
+            sink.close()